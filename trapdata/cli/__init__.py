@@ -1,8 +1,10 @@
 from trapdata.settings import read_settings
-from trapdata.db import check_db
-
+from trapdata.db import check_db, configure_engines
+from trapdata.common.cache import crop_cache
 
 settings = read_settings()
+configure_engines(**settings.database_options())
+crop_cache.resize(settings.crop_cache_size)
 check_db(settings.database_url, create=True, update=True, quiet=True)
 
 
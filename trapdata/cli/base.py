@@ -1,7 +1,6 @@
 import typer
 
-from trapdata.cli import export, shell, test, show, tracking
-
+from trapdata.cli import export, shell, test, show, tracking, queue, collect
 
 cli = typer.Typer(no_args_is_help=True)
 cli.add_typer(export.cli, name="export", help="Export data in various formats")
@@ -11,6 +10,8 @@ cli.add_typer(show.cli, name="show", help="Show data for use in other commands")
 cli.add_typer(
     tracking.cli, name="tracking", help="Group detections into single organisms"
 )
+cli.add_typer(queue.cli, name="queue", help="Manage the processing queues")
+cli.add_typer(collect.cli, name="collect", help="Find and watch for trap images")
 
 
 @cli.command()
@@ -1,44 +1,17 @@
-# @TODO this needs to be converted to typer
-import argparse
+import pathlib
+from typing import Optional
+
+import typer
 
 from trapdata import logger
+from trapdata.cli import settings
 from trapdata.common.filemanagement import find_images
+from trapdata.watch import ImageWatcher
+from trapdata.pipeline import LivePipeline
 
 from trapdata.ml.utils import StopWatch
 
-
-parser = argparse.ArgumentParser(description="Scan and add trap images to database")
-parser.add_argument(
-    "directory",
-    help="Path to directory of trap images to scan",
-)
-parser.add_argument(
-    "--max-num",
-    type=int,
-    nargs="?",
-    help="Stop after finding N number of images",
-)
-parser.add_argument(
-    "--queue",
-    action="store_const",
-    const=True,
-    default=False,
-    help="Automatically add all images to the process queue",
-)
-parser.add_argument(
-    "--count-only",
-    action="store_const",
-    const=True,
-    default=False,
-    help="Just count the number of images found",
-)
-parser.add_argument(
-    "--watch",
-    action="store_const",
-    const=True,
-    default=False,
-    help="Keep collector running and watch for new images",
-)
+cli = typer.Typer(no_args_is_help=True)
 
 
 def collect_images(path, max_num=None):
@@ -62,10 +35,64 @@ def count_images(path):
     logger.info(t)
 
 
-if __name__ == "__main__":
-    args = parser.parse_args()
-    logger.debug(args)
-    if args.count_only:
-        count_images(args.directory)
+@cli.command()
+def scan(
+    directory: pathlib.Path,
+    max_num: Optional[int] = typer.Option(
+        None, help="Stop after finding N number of images"
+    ),
+    count_only: bool = typer.Option(
+        False, help="Just count the number of images found"
+    ),
+):
+    """
+    Scan a directory of trap images.
+    """
+    if count_only:
+        count_images(directory)
     else:
-        collect_images(args.directory, max_num=args.max_num)
+        collect_images(directory, max_num=max_num)
+
+
+@cli.command()
+def watch(
+    directory: Optional[pathlib.Path] = typer.Argument(
+        None, help="Directory of trap images, defaults to the image base path"
+    ),
+    queue: bool = typer.Option(
+        False, help="Add the new images to the processing queue as they arrive"
+    ),
+    polling: bool = typer.Option(
+        False, help="Poll the directories instead of using filesystem events"
+    ),
+    settle_seconds: float = typer.Option(
+        2.0, help="Wait until an image has not changed for this long before adding it"
+    ),
+    rescan: bool = typer.Option(
+        True, help="First add the images that changed while not watching"
+    ),
+    live: bool = typer.Option(
+        False, help="Detect, classify & track each new image as soon as it arrives"
+    ),
+):
+    """
+    Keep running and add new images to their monitoring sessions as they arrive.
+    """
+    directory = directory or settings.image_base_path
+    on_new_images = None
+    if live:
+        pipeline = LivePipeline.from_config(settings.database_url, directory, settings)
+        on_new_images = pipeline.process_images
+    watcher = ImageWatcher(
+        settings.database_url,
+        directory,
+        # The live pipeline processes the images in the queue
+        queue=queue or live,
+        polling=polling,
+        settle_seconds=settle_seconds,
+        on_new_images=on_new_images,
+    )
+    try:
+        watcher.run(rescan=rescan)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")
@@ -2,27 +2,36 @@ import sys
 import enum
 import pathlib
 import csv
-from typing import Optional, Union
+import contextlib
+from typing import Any, Iterable, Optional, Union
 
 import typer
 from rich import print
 import pandas as pd
 
-from trapdata.db.models.detections import get_detected_objects
+from trapdata.db.models.detections import iter_detection_reports
 from trapdata.db.models.events import get_monitoring_sessions_from_db
+from trapdata.db.snapshots import write_snapshot
 from trapdata import logger
 from trapdata.cli import settings
-
+from trapdata.common.utils import write_records
 
 cli = typer.Typer(no_args_is_help=True)
 
 
 class ExportFormat(str, enum.Enum):
     json = "json"
+    jsonl = "jsonl"
     html = "html"
     csv = "csv"
 
 
+# Formats that are written one record at a time, and of those the ones
+# that a resumed export can append to
+STREAMING_FORMATS = (ExportFormat.json, ExportFormat.jsonl, ExportFormat.csv)
+APPENDABLE_FORMATS = (ExportFormat.jsonl, ExportFormat.csv)
+
+
 def export(
     df: pd.DataFrame,
     format: ExportFormat = ExportFormat.json,
@@ -43,8 +52,8 @@ def export(
             index=False,
         )
     else:
-        export_method = getattr(df, f"to_{format}")
-        output = export_method(path_or_buf=outfile, index=False)
+        export_method = getattr(df, f"to_{format.value}")
+        output = export_method(outfile, index=False)
     if outfile:
         return str(outfile.absolute())
     else:
@@ -55,26 +64,92 @@ def export(
         return output
 
 
+def export_stream(
+    records: Iterable[dict[str, Any]],
+    format: ExportFormat = ExportFormat.json,
+    outfile: Optional[pathlib.Path] = None,
+    append: bool = False,
+) -> Union[str, None]:
+    if append and format not in APPENDABLE_FORMATS:
+        formats = ", ".join(f.value for f in APPENDABLE_FORMATS)
+        raise typer.BadParameter(f"Only {formats} exports can be resumed")
+
+    if format not in STREAMING_FORMATS:
+        df = pd.DataFrame(list(records))
+        return export(df=df, format=format, outfile=outfile)
+
+    append = bool(append and outfile and outfile.exists() and outfile.stat().st_size)
+
+    with contextlib.ExitStack() as stack:
+        if outfile:
+            f = stack.enter_context(
+                open(outfile, "a" if append else "w", newline="", encoding="utf-8")
+            )
+        else:
+            f = sys.stdout
+        count = write_records(records, f, format=format.value, header=not append)
+    logger.info(f"Exported {count} records as {format.value}")
+    if outfile:
+        return str(outfile.absolute())
+    return None
+
+
 @cli.command()
 def detections(
     # trap: Optional[str] = None,
-    format: ExportFormat = ExportFormat.json,
+    format: Optional[ExportFormat] = typer.Option(
+        None, help="Defaults to json, or jsonl when resuming an export with --after."
+    ),
     limit: Optional[int] = 10,
     offset: int = 0,
+    after: Optional[int] = typer.Option(
+        None,
+        help="Resume an export after this detection ID. "
+        "The records are appended to an existing csv or jsonl outfile.",
+    ),
     outfile: Optional[pathlib.Path] = None,
 ) -> Optional[str]:
     """
     Export detected objects from database in the specified format.
+
+    The detections are read & written in pages, so exports of any size use
+    a constant amount of memory (except for the html format).
     """
-    objects = get_detected_objects(
+    if format is None:
+        format = ExportFormat.json if after is None else ExportFormat.jsonl
+    elif after is not None and format not in APPENDABLE_FORMATS:
+        formats = ", ".join(f.value for f in APPENDABLE_FORMATS)
+        raise typer.BadParameter(
+            f"Only {formats} exports can be resumed with --after",
+            param_hint="--format",
+        )
+
+    last_id = after
+    records = iter_detection_reports(
         settings.database_url,
+        image_base_path=settings.image_base_path,
         limit=limit,
         offset=offset,
-        image_base_path=settings.image_base_path,
+        after_id=after,
     )
-    logger.info(f"Preparing to export {len(objects)} records as {format}")
-    df = pd.DataFrame([obj.report_data() for obj in objects])
-    return export(df=df, format=format, outfile=outfile)
+
+    def track_cursor():
+        nonlocal last_id
+        for record in records:
+            yield record
+            last_id = record["id"]
+
+    logger.info(f"Exporting detections as {format.value}")
+    try:
+        return export_stream(
+            track_cursor(), format=format, outfile=outfile, append=after is not None
+        )
+    finally:
+        if last_id is not None:
+            logger.info(
+                f"Last detection exported: {last_id}. "
+                f"Continue the export with --after {last_id}"
+            )
 
 
 @cli.command()
@@ -88,8 +163,28 @@ def events(
     objects = get_monitoring_sessions_from_db(
         db_path=settings.database_url, base_directory=settings.image_base_path
     )
-    df = pd.DataFrame([obj.report_data() for obj in objects])
-    return export(df=df, format=format, outfile=outfile)
+    # There is one event per night, only their report data is exported as it is read
+    records = (obj.report_data() for obj in objects)
+    return export_stream(records, format=format, outfile=outfile)
+
+
+@cli.command()
+def snapshot(
+    directory: pathlib.Path,
+    incremental: bool = typer.Option(
+        False,
+        help="Only append the images & detections added or changed "
+        "since the previous snapshot in the directory.",
+    ),
+) -> Optional[str]:
+    """
+    Save the detections, images, events & tracks as Parquet files for analysis.
+
+    The files in each table directory can be read as one dataset with pandas,
+    pyarrow or DuckDB, without opening the database. Requires pyarrow.
+    """
+    write_snapshot(settings.database_url, directory, incremental=incremental)
+    return str(directory.absolute())
 
 
 if __name__ == "__main__":
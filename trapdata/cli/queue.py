@@ -0,0 +1,85 @@
+import typer
+from rich.console import Console
+from rich.table import Table
+
+from trapdata.cli import settings
+from trapdata.db.base import get_session
+from trapdata.db.models.queue import queue_status
+from trapdata.db.models.counters import get_stage_counters, reconcile_stage_counters
+from trapdata.pipeline import start_pipeline
+from trapdata import logger
+
+cli = typer.Typer(no_args_is_help=True)
+
+console = Console()
+
+
+@cli.command()
+def status(
+    counters: bool = typer.Option(
+        False, help="Read the stored stage counters instead of counting every item"
+    )
+):
+    """
+    Show the number of unprocessed, queued and completed items in each queue.
+    """
+    image_base_path = str(settings.image_base_path)
+    logger.info(f"Show queue status for images in {image_base_path}")
+    if counters:
+        counts = get_stage_counters(settings.database_url, image_base_path)
+    else:
+        counts = queue_status(settings.database_url, image_base_path)
+
+    table = Table("Queue", "Unprocessed", "Queued", "Done")
+    for name, queue_counts in counts.items():
+        table.add_row(
+            name,
+            str(queue_counts["unprocessed"]),
+            str(queue_counts["queued"]),
+            str(queue_counts["done"]),
+        )
+
+    console.print(table)
+
+
+@cli.command()
+def reconcile():
+    """
+    Rebuild the stored stage counters of all deployments by counting every item.
+    """
+    with get_session(settings.database_url) as sesh:
+        reconcile_stage_counters(sesh)
+        sesh.commit()
+    status(counters=True)
+
+
+@cli.command()
+def process(
+    staged: bool = typer.Option(
+        True, help="Run the stages concurrently instead of one after the other"
+    ),
+    localization_workers: int = typer.Option(1, help="Threads for object detection"),
+    classification_workers: int = typer.Option(
+        1, help="Threads for each of the binary & species classifiers"
+    ),
+    feature_workers: int = typer.Option(1, help="Threads for feature extraction"),
+):
+    """
+    Process all queued items with the models selected in the settings.
+    """
+    start_pipeline(
+        settings.database_url,
+        settings.image_base_path,
+        settings,
+        staged=staged,
+        stage_workers={
+            "localization": localization_workers,
+            "binary_classification": classification_workers,
+            "species_classification": classification_workers,
+            "feature_extraction": feature_workers,
+        },
+    )
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,126 @@
+"""
+In-memory caches of decoded images, shared by the stages of the pipeline that run
+in the same process (e.g. `LivePipeline` and `StagedPipeline`, or a single worker).
+"""
+
+import threading
+import collections
+from typing import Hashable, Optional
+
+import PIL.Image
+
+from trapdata.common.types import FilePath
+
+
+def image_size_bytes(image: PIL.Image.Image) -> int:
+    """
+    The number of bytes of the decoded pixels of an image.
+    """
+    return image.width * image.height * len(image.getbands())
+
+
+class ImageCache:
+    """
+    Least recently used cache of decoded images, bounded by the total number of
+    bytes of their pixels. The cache is disabled while its size is 0.
+
+    The images are shared between threads and must not be modified.
+    """
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.images: collections.OrderedDict[Hashable, tuple[PIL.Image.Image, int]] = (
+            collections.OrderedDict()
+        )
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.images)
+
+    def __contains__(self, key: Hashable):
+        return key in self.images
+
+    def resize(self, max_bytes: int):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def get(self, key: Hashable) -> Optional[PIL.Image.Image]:
+        if not self.max_bytes:
+            return None
+        with self.lock:
+            item = self.images.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.images.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: Hashable, image: PIL.Image.Image):
+        size = image_size_bytes(image)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self._pop(key)
+            self.images[key] = (image, size)
+            self.num_bytes += size
+            self._evict()
+
+    def pop(self, key: Hashable) -> Optional[PIL.Image.Image]:
+        with self.lock:
+            return self._pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.num_bytes = 0
+
+    def _pop(self, key: Hashable) -> Optional[PIL.Image.Image]:
+        item = self.images.pop(key, None)
+        if item is None:
+            return None
+        self.num_bytes -= item[1]
+        return item[0]
+
+    def _evict(self):
+        while self.images and self.num_bytes > self.max_bytes:
+            _, (_, size) = self.images.popitem(last=False)
+            self.num_bytes -= size
+
+
+# Crops of detected objects made after detection, keyed by the path of their crop
+# file, so the classifiers don't decode the file again
+crop_cache = ImageCache()
+
+# Room for a few full frames of the largest trap cameras (4096x2160 RGB)
+FRAME_CACHE_SIZE = 4 * 4096 * 2160 * 3
+
+# Decoded source images, keyed by their path, so an image is decoded once for the
+# object detector and all the crops of its detections
+frame_cache = ImageCache(FRAME_CACHE_SIZE)
+
+
+def load_image(path: FilePath) -> PIL.Image.Image:
+    """
+    Decode an image file completely and close it.
+    """
+    with PIL.Image.open(path) as image:
+        image.load()
+    return image
+
+
+def open_frame(path: FilePath) -> PIL.Image.Image:
+    """
+    Return the decoded pixels of a source image, from the `frame_cache` if it was
+    decoded recently.
+    """
+    key = str(path)
+    image = frame_cache.get(key)
+    if image is None:
+        image = load_image(key)
+        frame_cache.put(key, image)
+    return image
@@ -1,4 +1,4 @@
-from typing import Union, Literal, Optional
+from typing import Union, Literal, Optional, Any, BinaryIO, Iterator
 import pathlib
 import datetime
 import time
@@ -8,6 +8,7 @@ import os
 import math
 import re
 import hashlib
+import struct
 import tempfile
 
 import PIL.Image
@@ -18,9 +19,16 @@ import imagesize
 
 from .logs import logger
 from . import constants
+from .utils import threaded_imap
 
 EXIF_DATETIME_STR_FORMAT = "%Y:%m:%d %H:%M:%S"
 
+# The EXIF tags read from the header of each image while scanning
+EXIF_HEADER_TAGS = {0x0132: "DateTime", 0x882A: "TimeZoneOffset"}
+
+# Start Of Frame markers, all but DHT (0xC4), JPG (0xC8) & DAC (0xCC)
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
 
 def absolute_path(
     path: str, base_path: Union[pathlib.Path, str, None]
@@ -183,8 +191,17 @@ def get_image_timestamp_with_timezone(img_path, default_offset="+0"):
     However dateutil.parse seems to handle "-4" or "+4" just fine.
     """
     exif = get_exif(img_path)
-    datestring = exif["DateTime"].replace(":", "-", 2)
-    offset = exif.get("TimeZoneOffset") or str(default_offset)
+    return parse_exif_timestamp(
+        exif["DateTime"], exif.get("TimeZoneOffset"), default_offset
+    )
+
+
+def parse_exif_timestamp(datestring: str, offset=None, default_offset="+0"):
+    """
+    Parse the DateTime and TimeZoneOffset values of the EXIF data of an image.
+    """
+    datestring = datestring.replace(":", "-", 2)
+    offset = offset or str(default_offset)
     if int(offset) > 0:
         offset = f"+{offset}"
     datestring = f"{datestring} {offset}"
@@ -192,14 +209,144 @@ def get_image_timestamp_with_timezone(img_path, default_offset="+0"):
     return date
 
 
-def find_images(
-    base_directory,
-    absolute_paths=False,
-    include_timestamps=True,
-    skip_bad_exif=True,
-):
-    logger.info(f"Scanning '{base_directory}' for images")
-    base_directory = pathlib.Path(base_directory)
+def read_exif_header_tags(data: bytes) -> dict[str, Any]:
+    """
+    Read the tags in `EXIF_HEADER_TAGS` from the first IFD of the TIFF structure
+    in the EXIF data of an image (the same tags `PIL.Image.getexif` returns).
+    """
+    byte_order = {b"II": "<", b"MM": ">"}.get(data[:2])
+    if not byte_order:
+        raise ValueError("Invalid byte order in EXIF data")
+    tags = {}
+    try:
+        (ifd_offset,) = struct.unpack_from(f"{byte_order}I", data, 4)
+        (num_entries,) = struct.unpack_from(f"{byte_order}H", data, ifd_offset)
+        for i in range(num_entries):
+            entry_offset = ifd_offset + 2 + i * 12
+            tag, tag_type, count = struct.unpack_from(
+                f"{byte_order}HHI", data, entry_offset
+            )
+            value_offset = entry_offset + 8
+            name = EXIF_HEADER_TAGS.get(tag)
+            if name and tag_type == 2:  # ASCII
+                if count > 4:
+                    (value_offset,) = struct.unpack_from(
+                        f"{byte_order}I", data, value_offset
+                    )
+                value = data[value_offset : value_offset + count]
+                tags[name] = value.split(b"\0")[0].decode("ascii", errors="replace")
+            elif name and tag_type in (3, 8):  # SHORT & SSHORT
+                if count > 2:
+                    (value_offset,) = struct.unpack_from(
+                        f"{byte_order}I", data, value_offset
+                    )
+                short_format = "h" if tag_type == 8 else "H"
+                (tags[name],) = struct.unpack_from(
+                    f"{byte_order}{short_format}", data, value_offset
+                )
+    except struct.error as e:
+        raise ValueError(f"Truncated EXIF data: {e}")
+    return tags
+
+
+def read_jpeg_header(f: BinaryIO) -> tuple[tuple[int, int], dict[str, Any]]:
+    """
+    Read the dimensions and the EXIF tags in `EXIF_HEADER_TAGS` of a JPEG image
+    from the segments before its frame header, without decoding the image.
+
+    Returns the (width, height) of the image and the tags that were found.
+    Raises a ValueError if the file is not a JPEG or the header is invalid.
+    """
+    if f.read(2) != b"\xff\xd8":
+        raise ValueError("Missing JPEG start of image marker")
+    tags = None
+    while True:
+        byte = f.read(1)
+        if byte != b"\xff":
+            raise ValueError("Invalid JPEG marker")
+        while byte == b"\xff":
+            # Markers can be padded with any number of fill bytes
+            byte = f.read(1)
+        if not byte:
+            raise ValueError("Unexpected end of JPEG header")
+        marker = byte[0]
+        if marker in (0xD9, 0xDA):
+            raise ValueError("No frame header before the JPEG image data")
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            # Markers without a segment
+            continue
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            raise ValueError("Unexpected end of JPEG header")
+        (length,) = struct.unpack(">H", length_bytes)
+        if marker in JPEG_SOF_MARKERS:
+            segment = f.read(5)
+            if len(segment) < 5:
+                raise ValueError("Unexpected end of JPEG header")
+            height, width = struct.unpack(">HH", segment[1:5])
+            return (width, height), tags or {}
+        elif marker == 0xE1 and tags is None:
+            segment = f.read(length - 2)
+            # APP1 segments also hold XMP data
+            if segment.startswith(b"Exif\0\0"):
+                tags = read_exif_header_tags(segment[6:])
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+
+
+def read_image_metadata(
+    path: pathlib.Path,
+    filepath: pathlib.Path,
+    include_timestamps: bool = True,
+    skip_bad_exif: bool = True,
+) -> Optional[dict[str, Any]]:
+    """
+    Read the dimensions, filesize and timestamp of the image at `filepath`
+    for `find_images`, which returns it with `path`.
+
+    The file is opened once and only the header of a JPEG is read. Other images,
+    or JPEGs with a header that can't be parsed, are read with imagesize & PIL.
+    Returns None for an image without an EXIF date if `skip_bad_exif` is set.
+    """
+    shape, tags = None, None
+    with open(filepath, "rb") as f:
+        filesize = os.fstat(f.fileno()).st_size
+        if filepath.suffix.lower() in (".jpg", ".jpeg"):
+            try:
+                shape, tags = read_jpeg_header(f)
+            except ValueError as e:
+                logger.debug(f"Could not read the JPEG header of {filepath}: {e}")
+    if shape is None:
+        shape = get_image_dimensions(filepath)
+
+    date = None
+    if include_timestamps:
+        try:
+            if tags and "DateTime" in tags:
+                date = parse_exif_timestamp(
+                    tags["DateTime"], tags.get("TimeZoneOffset")
+                )
+            else:
+                date = get_image_timestamp_with_timezone(filepath)
+        except Exception as e:
+            logger.error(f"Could not get EXIF date for image: {filepath}\n {e}")
+            if skip_bad_exif:
+                return None
+
+    return {
+        "path": path,
+        "timestamp": date,
+        "shape": shape,
+        "filesize": filesize,
+        # "hash": None,
+    }
+
+
+def walk_images(base_directory: pathlib.Path) -> Iterator[pathlib.Path]:
+    """
+    Find the files with a supported image extension in a directory.
+    The paths start with the directory, as given.
+    """
     if not base_directory.exists():
         raise Exception(f"Directory does not exist: {base_directory}")
     extensions_list = "|".join(
@@ -209,33 +356,45 @@ def find_images(
     for walk_path, dirs, files in os.walk(base_directory):
         for name in files:
             if re.search(pattern, name, re.IGNORECASE):
-                relative_path = pathlib.Path(walk_path) / name
-                full_path = base_directory / relative_path
-                path = full_path if absolute_paths else relative_path
-                shape = get_image_dimensions(path)
-                filesize = get_image_filesize(path)
-
-                if include_timestamps:
-                    try:
-                        date = get_image_timestamp_with_timezone(full_path)
-                    except Exception as e:
-                        logger.error(
-                            f"Could not get EXIF date for image: {full_path}\n {e}"
-                        )
-                        if skip_bad_exif:
-                            continue
-                        else:
-                            date = None
-                else:
-                    date = None
-
-                yield {
-                    "path": path,
-                    "timestamp": date,
-                    "shape": shape,
-                    "filesize": filesize,
-                    # "hash": None,
-                }
+                yield pathlib.Path(walk_path) / name
+
+
+def find_images(
+    base_directory,
+    absolute_paths=False,
+    include_timestamps=True,
+    skip_bad_exif=True,
+    num_workers=8,
+    ordered=True,
+):
+    """
+    Find the images in a directory and read their metadata.
+
+    The files are read by a pool of `num_workers` threads, since the time spent
+    on each file is mostly waiting for the filesystem (e.g. a network mount).
+    The images are yielded in the order they are found, or as soon as they are
+    read if `ordered` is False.
+    """
+    logger.info(f"Scanning '{base_directory}' for images")
+    base_directory = pathlib.Path(base_directory)
+
+    def image_paths():
+        for relative_path in walk_images(base_directory):
+            full_path = base_directory / relative_path
+            path = full_path if absolute_paths else relative_path
+            # The path of the walk is where the file is, even if relative
+            yield path, relative_path
+
+    def read_metadata(paths):
+        return read_image_metadata(*paths, include_timestamps, skip_bad_exif)
+
+    if num_workers > 1:
+        images = threaded_imap(read_metadata, image_paths(), num_workers, ordered)
+    else:
+        images = map(read_metadata, image_paths())
+    for image in images:
+        if image:
+            yield image
 
 
 def group_images_by_day(images, maximum_gap_minutes=6 * 60):
@@ -325,10 +484,21 @@ def save_image(
 
     fpath = (base_path / name).with_suffix(suffix)
     logger.debug(f"Saving image to {fpath}")
-    if exif_data:
-        image.save(fpath, exif=exif_data)
-    else:
-        image.save(fpath)
+    # Written to a temporary file first, because images are named by their content
+    # and another thread may be reading the same image while it is saved again
+    with tempfile.NamedTemporaryFile(
+        dir=base_path, suffix=suffix, delete=False
+    ) as tmp_file:
+        tmp_path = tmp_file.name
+    try:
+        if exif_data:
+            image.save(tmp_path, exif=exif_data)
+        else:
+            image.save(tmp_path)
+        os.replace(tmp_path, fpath)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
     return fpath
 
 
@@ -1,9 +1,13 @@
 import csv
+import json
 import datetime
 import pathlib
 import random
 import string
-from typing import Union, Any
+import itertools
+import collections
+import concurrent.futures
+from typing import Union, Any, Callable, Iterable, Iterator, TextIO
 
 
 def get_sequential_sample(direction, images, last_sample=None):
@@ -82,6 +86,37 @@ def export_report(
     return filepath
 
 
+def write_records(
+    records: Iterable[dict[str, Any]],
+    f: TextIO,
+    format: str = "json",
+    header: bool = True,
+) -> int:
+    """
+    Write the records to a file in json, jsonl or csv format as they are read,
+    without keeping them in memory. Returns the number of records written.
+    """
+    count = 0
+    if format == "json":
+        f.write("[")
+        for count, record in enumerate(records, 1):
+            f.write("\n" if count == 1 else ",\n")
+            f.write(json.dumps(record, indent=2, default=str))
+        f.write("\n]\n")
+    elif format == "jsonl":
+        for count, record in enumerate(records, 1):
+            f.write(json.dumps(record, default=str) + "\n")
+    elif format == "csv":
+        writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+        for count, record in enumerate(records, 1):
+            if count == 1 and header:
+                writer.writerow(record.keys())
+            writer.writerow(record.values())
+    else:
+        raise NotImplementedError(f"Streaming is not supported for {format}")
+    return count
+
+
 def format_timedelta(td: datetime.timedelta) -> str:
     minutes, seconds = divmod(td.seconds + td.days * 86400, 60)
     hours, minutes = divmod(minutes, 60)
@@ -107,3 +142,41 @@ def random_color():
     color = [random.random() for _ in range(3)]
     color.append(0.8)  # alpha
     return color
+
+
+def threaded_imap(
+    func: Callable[[Any], Any],
+    iterable: Iterable[Any],
+    num_workers: int,
+    ordered: bool = True,
+) -> Iterator[Any]:
+    """
+    Like `map`, but call the function in a pool of threads. Only a few items per
+    thread are taken from the iterable ahead of the results, so it can be a
+    generator of any length. If `ordered` is False, the results are yielded as
+    soon as they are ready instead of in the order of the items.
+    """
+    max_pending = num_workers * 4
+    items = iter(iterable)
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+        try:
+            while True:
+                for item in itertools.islice(items, max_pending - len(pending)):
+                    pending.append(executor.submit(func, item))
+                if not pending:
+                    return
+                if ordered:
+                    yield pending.popleft().result()
+                else:
+                    done, _ = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        pending.remove(future)
+                    for future in done:
+                        yield future.result()
+        finally:
+            # The caller stopped early or a call failed
+            for future in pending:
+                future.cancel()
@@ -1,9 +1,15 @@
 import sqlalchemy as sa
 from sqlalchemy import orm
-from .base import get_db, check_db, get_session, get_session_class
+from .base import (
+    get_db,
+    check_db,
+    get_session,
+    get_session_class,
+    configure_engines,
+)
 
 
-__all__ = [sa, orm, get_db, check_db, get_session, get_session_class]
+__all__ = [sa, orm, get_db, check_db, get_session, get_session_class, configure_engines]
 
 # Only call this once & reuse it
 Base = orm.declarative_base()
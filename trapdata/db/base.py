@@ -1,6 +1,11 @@
 import contextlib
+import functools
+import os
 import pathlib
-from typing import Generator
+import random
+import threading
+import time
+from typing import Any, Generator, Union
 from rich import print
 
 import sqlalchemy as sa
@@ -24,6 +29,204 @@ def get_alembic_config(db_path: str) -> Config:
     return alembic_cfg
 
 
+# Engines are expensive to construct (dialect setup, connection pool, SQLite
+# connection handshake) so only one is created per database URL and process.
+_engines: dict[str, tuple[int, sa.engine.Engine]] = {}
+_session_classes: dict[str, orm.sessionmaker[orm.Session]] = {}
+_engine_options: dict[str, Any] = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_pre_ping": True,
+    "sqlite_journal_mode": "wal",
+    "sqlite_synchronous": "normal",
+    "sqlite_mmap_size": 256 * 1024 * 1024,
+    "sqlite_cache_size": -64 * 1024,  # Negative values are in KiB
+    "sqlite_temp_store": "memory",
+    "sqlite_busy_timeout": 10,
+    "lock_retries": 5,
+    "lock_retry_delay": 0.1,
+}
+_engines_lock = threading.Lock()
+
+SQLITE_JOURNAL_MODES = ("delete", "truncate", "persist", "memory", "wal", "off")
+SQLITE_SYNCHRONOUS_MODES = ("off", "normal", "full", "extra")
+SQLITE_TEMP_STORES = ("default", "file", "memory")
+
+
+def configure_engines(**options):
+    """
+    Update the options used when constructing database engines.
+
+    Accepts `pool_size`, `max_overflow` and `pool_pre_ping`, which only apply
+    to client/server databases like PostgreSQL, the `sqlite_*` pragmas that
+    are set on every new SQLite connection, and `lock_retries` /
+    `lock_retry_delay` used by `retry_if_locked`. Existing engines are
+    disposed so the next session is created with the new options.
+    """
+    unknown = set(options) - set(_engine_options)
+    if unknown:
+        raise TypeError(f"Unknown database engine options: {', '.join(unknown)}")
+    for key, choices in [
+        ("sqlite_journal_mode", SQLITE_JOURNAL_MODES),
+        ("sqlite_synchronous", SQLITE_SYNCHRONOUS_MODES),
+        ("sqlite_temp_store", SQLITE_TEMP_STORES),
+    ]:
+        if key in options:
+            options[key] = str(options[key]).lower()
+            if options[key] not in choices:
+                raise ValueError(
+                    f"Invalid value for {key}: '{options[key]}'. Choose from {choices}"
+                )
+    if any(_engine_options[k] != v for k, v in options.items()):
+        _engine_options.update(options)
+        dispose_engines()
+
+
+def dispose_engines():
+    """
+    Close all pooled connections and forget the cached engines.
+    """
+    with _engines_lock:
+        for _, engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+        _session_classes.clear()
+
+
+def _reset_engines_after_fork():
+    """
+    Connections must never be shared between processes. PyTorch DataLoader
+    workers are forked from the main process, so drop the inherited pool
+    without closing the parent's connections. The engine itself is kept and
+    opens new connections on demand.
+    """
+    global _engines_lock
+    _engines_lock = threading.Lock()
+    for _, engine in _engines.values():
+        engine.dispose(close=False)
+    _engines.update(
+        {key: (os.getpid(), engine) for key, (_, engine) in _engines.items()}
+    )
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_engines_after_fork)
+
+
+def _engine_key(db_path: Union[str, sa.engine.URL]) -> str:
+    return sa.engine.make_url(db_path).render_as_string(hide_password=False)
+
+
+def _sqlite_pragmas() -> dict[str, Union[str, int]]:
+    return {
+        "journal_mode": _engine_options["sqlite_journal_mode"],
+        "synchronous": _engine_options["sqlite_synchronous"],
+        "mmap_size": int(_engine_options["sqlite_mmap_size"]),
+        "cache_size": int(_engine_options["sqlite_cache_size"]),
+        "temp_store": _engine_options["sqlite_temp_store"],
+        "busy_timeout": int(float(_engine_options["sqlite_busy_timeout"]) * 1000),
+    }
+
+
+def _set_sqlite_pragmas(pragmas, dbapi_connection, connection_record):
+    """
+    Write-ahead logging lets the GUI, the pipeline and the DataLoader workers
+    read while another connection is writing. The WAL journal mode is
+    persistent, the other pragmas only apply to the current connection.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+    finally:
+        cursor.close()
+
+
+def _create_engine(db_url: str) -> sa.engine.Engine:
+    url = sa.engine.make_url(db_url)
+    kwargs: dict[str, Any] = {}
+    is_sqlite = url.get_backend_name() == "sqlite"
+    if is_sqlite:
+        kwargs["connect_args"] = {
+            # A longer timeout is necessary for SQLite and multiple PyTorch workers
+            "timeout": float(_engine_options["sqlite_busy_timeout"]),
+            "check_same_thread": False,
+        }
+    else:
+        kwargs["pool_size"] = _engine_options["pool_size"]
+        kwargs["max_overflow"] = _engine_options["max_overflow"]
+        kwargs["pool_pre_ping"] = _engine_options["pool_pre_ping"]
+
+    logger.debug(f"Creating database engine for {get_safe_db_path(db_url)}")
+    engine = sa.create_engine(url, echo=False, future=True, **kwargs)
+    if is_sqlite:
+        sa.event.listen(
+            engine, "connect", functools.partial(_set_sqlite_pragmas, _sqlite_pragmas())
+        )
+    return engine
+
+
+def is_locked_error(e: Exception) -> bool:
+    message = str(getattr(e, "orig", e)).lower()
+    return "database is locked" in message or "database table is locked" in message
+
+
+def retry_if_locked(func):
+    """
+    Retry a database write that failed because SQLite was locked by another
+    connection, waiting a little longer after each attempt.
+
+    The decorated function must be safe to run again from the beginning,
+    which is true when it opens and commits its own session.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except sqlalchemy.exc.OperationalError as e:
+                if not is_locked_error(e) or attempt >= _engine_options["lock_retries"]:
+                    raise
+                delay = _engine_options["lock_retry_delay"] * 2**attempt
+                delay += random.uniform(0, delay)  # Keep workers from retrying in step
+                attempt += 1
+                logger.warn(
+                    f"Database is locked, retrying {func.__name__} in {round(delay, 2)} seconds "
+                    f"(attempt {attempt} of {_engine_options['lock_retries']})"
+                )
+                time.sleep(delay)
+
+    return wrapper
+
+
+def get_engine(db_path) -> sa.engine.Engine:
+    """
+    Return the shared engine for a database URL, creating it the first time.
+
+    If the current process was forked after the engine was created (without
+    the fork hook having run) the inherited connection pool is replaced.
+    """
+    if not db_path:
+        raise Exception("No database URL specified")
+
+    key = _engine_key(db_path)
+    pid = os.getpid()
+    with _engines_lock:
+        cached = _engines.get(key)
+        if cached:
+            engine_pid, engine = cached
+            if engine_pid != pid:
+                engine.dispose(close=False)
+                _engines[key] = (pid, engine)
+            return engine
+
+        engine = _create_engine(key)
+        _engines[key] = (pid, engine)
+        return engine
+
+
 def get_db(db_path, create=False, update=False):
     """
     db_path supports any database URL format supported by sqlalchemy
@@ -32,22 +235,7 @@ def get_db(db_path, create=False, update=False):
     db_path = ":memory:"
     db_path = "postgresql://[user[:password]@][netloc][:port][/dbname][?param1=value1&...]"
     """
-    if not db_path:
-        Exception("No database URL specified")
-    else:
-        pass
-        # logger.debug(f"Using DB from path: {db_path}")
-        # logger.debug(f"Using DB from path: {get_safe_db_path()}")
-
-    db = sa.create_engine(
-        str(db_path),
-        echo=False,
-        future=True,
-        connect_args={
-            "timeout": 10,  # A longer timeout is necessary for SQLite and multiple PyTorch workers
-            "check_same_thread": False,
-        },
-    )
+    db = get_engine(db_path)
 
     alembic_cfg = get_alembic_config(db_path)
 
@@ -84,14 +272,22 @@ def get_session_class(db_path, **kwargs) -> orm.sessionmaker[orm.Session]:
     Use this to create a pre-configured Session class.
     Attach it to the running app.
     Then we don't have to pass around the db_path
+
+    Session classes without extra arguments are shared by all callers
+    using the same database URL.
     """
-    Session = orm.sessionmaker(
-        bind=get_db(db_path, create=False, update=False),
-        expire_on_commit=False,  # Currently only need this for `pull_n_from_queue`
-        autoflush=False,
-        autocommit=False,
-        **kwargs,
-    )
+    key = _engine_key(db_path)
+    Session = None if kwargs else _session_classes.get(key)
+    if Session is None:
+        Session = orm.sessionmaker(
+            bind=get_engine(db_path),
+            expire_on_commit=False,  # Currently only need this for `pull_n_from_queue`
+            autoflush=False,
+            autocommit=False,
+            **kwargs,
+        )
+        if not kwargs:
+            _session_classes[key] = Session
     return Session
 
 
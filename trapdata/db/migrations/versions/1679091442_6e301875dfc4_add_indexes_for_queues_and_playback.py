@@ -0,0 +1,95 @@
+"""add indexes for queues and playback
+
+Revision ID: 6e301875dfc4
+Revises: 1544478c3031
+Create Date: 2023-03-17 15:17:22.482931
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "6e301875dfc4"
+down_revision = "1544478c3031"
+branch_labels = None
+depends_on = None
+
+
+# The same expressions are declared on the models, they are rendered
+# as `in_queue IS 1` for SQLite and `in_queue IS true` for PostgreSQL.
+queued = sa.column("in_queue", sa.Boolean).is_(True)
+unprocessed = sa.column("last_processed", sa.DateTime).is_(None)
+without_features = sa.column("cnn_features", sa.JSON).is_(None)
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_monitoring_sessions_base_directory_day",
+        "monitoring_sessions",
+        ["base_directory", "day"],
+    )
+
+    op.create_index(
+        "ix_images_monitoring_session_id_timestamp",
+        "images",
+        ["monitoring_session_id", "timestamp"],
+    )
+    op.create_index("ix_images_timestamp", "images", ["timestamp"])
+    op.create_index(
+        "ix_images_queued",
+        "images",
+        ["monitoring_session_id"],
+        sqlite_where=queued,
+        postgresql_where=queued,
+    )
+    op.create_index(
+        "ix_images_unprocessed",
+        "images",
+        ["monitoring_session_id"],
+        sqlite_where=unprocessed,
+        postgresql_where=unprocessed,
+    )
+
+    op.create_index("ix_detections_image_id", "detections", ["image_id"])
+    op.create_index(
+        "ix_detections_monitoring_session_id_binary_label",
+        "detections",
+        ["monitoring_session_id", "binary_label"],
+    )
+    op.create_index(
+        "ix_detections_sequence_id_sequence_frame",
+        "detections",
+        ["sequence_id", "sequence_frame"],
+    )
+    op.create_index(
+        "ix_detections_queued",
+        "detections",
+        ["monitoring_session_id"],
+        sqlite_where=queued,
+        postgresql_where=queued,
+    )
+    op.create_index(
+        "ix_detections_without_features",
+        "detections",
+        ["monitoring_session_id"],
+        sqlite_where=without_features,
+        postgresql_where=without_features,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_detections_without_features", table_name="detections")
+    op.drop_index("ix_detections_queued", table_name="detections")
+    op.drop_index("ix_detections_sequence_id_sequence_frame", table_name="detections")
+    op.drop_index(
+        "ix_detections_monitoring_session_id_binary_label", table_name="detections"
+    )
+    op.drop_index("ix_detections_image_id", table_name="detections")
+    op.drop_index("ix_images_unprocessed", table_name="images")
+    op.drop_index("ix_images_queued", table_name="images")
+    op.drop_index("ix_images_timestamp", table_name="images")
+    op.drop_index("ix_images_monitoring_session_id_timestamp", table_name="images")
+    op.drop_index(
+        "ix_monitoring_sessions_base_directory_day", table_name="monitoring_sessions"
+    )
@@ -0,0 +1,51 @@
+"""canonical detections
+
+Revision ID: d47182110c74
+Revises: 6e301875dfc4
+Create Date: 2023-03-21 18:45:11.203518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "d47182110c74"
+down_revision = "6e301875dfc4"
+branch_labels = None
+depends_on = None
+
+
+canonical = sa.column("canonical", sa.Boolean).is_(True)
+
+
+def upgrade() -> None:
+    op.add_column("detections", sa.Column("canonical", sa.Boolean(), nullable=True))
+
+    # Mark the latest detection of each bounding box in each image
+    detections = sa.table(
+        "detections",
+        sa.column("id", sa.Integer),
+        sa.column("image_id", sa.Integer),
+        sa.column("bbox", sa.JSON),
+        sa.column("canonical", sa.Boolean),
+    )
+    latest = (
+        sa.select(sa.func.max(detections.c.id))
+        .where(detections.c.bbox.is_not(None))
+        .group_by(detections.c.image_id, sa.cast(detections.c.bbox, sa.Text))
+    )
+    op.execute(detections.update().values(canonical=detections.c.id.in_(latest)))
+
+    op.create_index(
+        "ix_detections_canonical",
+        "detections",
+        ["monitoring_session_id", "binary_label"],
+        sqlite_where=canonical,
+        postgresql_where=canonical,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_detections_canonical", table_name="detections")
+    op.drop_column("detections", "canonical")
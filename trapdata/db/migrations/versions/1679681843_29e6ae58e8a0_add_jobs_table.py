@@ -0,0 +1,42 @@
+"""add jobs table
+
+Revision ID: 29e6ae58e8a0
+Revises: d47182110c74
+Create Date: 2023-03-24 18:17:23.640127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "29e6ae58e8a0"
+down_revision = "d47182110c74"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "jobs",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("stage", sa.String(length=255), nullable=False),
+        sa.Column("item_id", sa.Integer(), nullable=False),
+        sa.Column("status", sa.String(length=255), nullable=False),
+        sa.Column("worker_id", sa.String(length=255), nullable=True),
+        sa.Column("claimed_at", sa.DateTime(), nullable=True),
+        sa.Column("lease_expires_at", sa.DateTime(), nullable=True),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("stage", "item_id", name="uq_jobs_stage_item_id"),
+    )
+    op.create_index(
+        "ix_jobs_stage_status_lease_expires_at",
+        "jobs",
+        ["stage", "status", "lease_expires_at"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_jobs_stage_status_lease_expires_at", table_name="jobs")
+    op.drop_table("jobs")
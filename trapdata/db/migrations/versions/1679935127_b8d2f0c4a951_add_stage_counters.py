@@ -0,0 +1,37 @@
+"""add stage counters
+
+Revision ID: b8d2f0c4a951
+Revises: 29e6ae58e8a0
+Create Date: 2023-03-27 16:38:47.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "b8d2f0c4a951"
+down_revision = "29e6ae58e8a0"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # The counters of each deployment are filled in the first time they are read
+    op.create_table(
+        "stage_counters",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("base_directory", sa.String(length=255), nullable=False),
+        sa.Column("stage", sa.String(length=255), nullable=False),
+        sa.Column("unprocessed", sa.Integer(), nullable=False),
+        sa.Column("queued", sa.Integer(), nullable=False),
+        sa.Column("done", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint(
+            "base_directory", "stage", name="uq_stage_counters_base_directory_stage"
+        ),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("stage_counters")
@@ -0,0 +1,83 @@
+"""binary cnn features
+
+Revision ID: 5c1e7a9b3d28
+Revises: b8d2f0c4a951
+Create Date: 2023-03-28 17:57:34.318263
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+import numpy as np
+
+# revision identifiers, used by Alembic.
+revision = "5c1e7a9b3d28"
+down_revision = "b8d2f0c4a951"
+branch_labels = None
+depends_on = None
+
+
+BATCH_SIZE = 1000
+
+without_features = sa.column("cnn_features").is_(None)
+
+
+def convert_features(from_type, to_type, convert):
+    """
+    Copy the features of every detection to a new column of another type,
+    then replace the old column with it.
+    """
+    op.drop_index("ix_detections_without_features", table_name="detections")
+    op.add_column("detections", sa.Column("cnn_features_new", to_type, nullable=True))
+
+    detections = sa.table(
+        "detections",
+        sa.column("id", sa.Integer),
+        sa.column("cnn_features", from_type),
+        sa.column("cnn_features_new", to_type),
+    )
+    conn = op.get_bind()
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select(detections.c.id, detections.c.cnn_features)
+            .where((detections.c.id > last_id) & detections.c.cnn_features.is_not(None))
+            .order_by(detections.c.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        conn.execute(
+            detections.update()
+            .where(detections.c.id == sa.bindparam("b_id"))
+            .values(cnn_features_new=sa.bindparam("b_features")),
+            [{"b_id": row.id, "b_features": convert(row.cnn_features)} for row in rows],
+        )
+        last_id = rows[-1].id
+
+    op.drop_column("detections", "cnn_features")
+    op.alter_column("detections", "cnn_features_new", new_column_name="cnn_features")
+    op.create_index(
+        "ix_detections_without_features",
+        "detections",
+        ["monitoring_session_id"],
+        sqlite_where=without_features,
+        postgresql_where=without_features,
+    )
+
+
+def upgrade() -> None:
+    # Store the feature vectors as float32 bytes instead of JSON lists
+    convert_features(
+        sa.JSON,
+        sa.LargeBinary,
+        lambda features: np.asarray(features, dtype=np.float32).tobytes(),
+    )
+
+
+def downgrade() -> None:
+    convert_features(
+        sa.LargeBinary,
+        sa.JSON,
+        lambda features: np.frombuffer(features, dtype=np.float32).tolist(),
+    )
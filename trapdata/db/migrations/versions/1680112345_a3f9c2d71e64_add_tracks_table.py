@@ -0,0 +1,113 @@
+"""add tracks table
+
+Revision ID: a3f9c2d71e64
+Revises: 5c1e7a9b3d28
+Create Date: 2023-03-29 17:52:25.104386
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a3f9c2d71e64"
+down_revision = "5c1e7a9b3d28"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    tracks = op.create_table(
+        "tracks",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("sequence_id", sa.String(length=255), nullable=False),
+        sa.Column("monitoring_session_id", sa.Integer(), nullable=True),
+        sa.Column("start_time", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("end_time", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("num_frames", sa.Integer(), nullable=True),
+        sa.Column("num_detections", sa.Integer(), nullable=True),
+        sa.Column("best_detection_id", sa.Integer(), nullable=True),
+        sa.Column("best_label", sa.String(length=255), nullable=True),
+        sa.Column("best_score", sa.Numeric(asdecimal=False), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["best_detection_id"], ["detections.id"], ondelete="SET NULL"
+        ),
+        sa.ForeignKeyConstraint(["monitoring_session_id"], ["monitoring_sessions.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_tracks_sequence_id", "tracks", ["sequence_id"], unique=True)
+    op.create_index(
+        "ix_tracks_monitoring_session_id", "tracks", ["monitoring_session_id"]
+    )
+
+    # Fill in the tracks of the existing detections
+    detections = sa.table(
+        "detections",
+        sa.column("id", sa.Integer),
+        sa.column("monitoring_session_id", sa.Integer),
+        sa.column("timestamp", sa.DateTime),
+        sa.column("specific_label", sa.String),
+        sa.column("specific_label_score", sa.Numeric),
+        sa.column("sequence_id", sa.String),
+        sa.column("sequence_frame", sa.Integer),
+    )
+    tracked = detections.c.sequence_id.is_not(None)
+    ranked = (
+        sa.select(
+            detections.c.id,
+            detections.c.sequence_id,
+            detections.c.specific_label,
+            detections.c.specific_label_score,
+            sa.func.row_number()
+            .over(
+                partition_by=detections.c.sequence_id,
+                order_by=detections.c.specific_label_score.desc(),
+            )
+            .label("rank"),
+        )
+        .where(tracked & detections.c.specific_label_score.is_not(None))
+        .subquery()
+    )
+    best = sa.select(ranked).where(ranked.c.rank == 1).subquery()
+    aggregates = (
+        sa.select(
+            detections.c.sequence_id,
+            sa.func.min(detections.c.monitoring_session_id).label(
+                "monitoring_session_id"
+            ),
+            sa.func.min(detections.c.timestamp).label("start_time"),
+            sa.func.max(detections.c.timestamp).label("end_time"),
+            (sa.func.max(detections.c.sequence_frame) + 1).label("num_frames"),
+            sa.func.count(detections.c.id).label("num_detections"),
+        )
+        .where(tracked)
+        .group_by(detections.c.sequence_id)
+        .subquery()
+    )
+    op.execute(
+        tracks.insert().from_select(
+            [
+                "sequence_id",
+                "monitoring_session_id",
+                "start_time",
+                "end_time",
+                "num_frames",
+                "num_detections",
+                "best_detection_id",
+                "best_label",
+                "best_score",
+            ],
+            sa.select(
+                aggregates,
+                best.c.id,
+                best.c.specific_label,
+                best.c.specific_label_score,
+            ).outerjoin(best, best.c.sequence_id == aggregates.c.sequence_id),
+        )
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_tracks_monitoring_session_id", table_name="tracks")
+    op.drop_index("ix_tracks_sequence_id", table_name="tracks")
+    op.drop_table("tracks")
@@ -0,0 +1,43 @@
+"""add file manifest
+
+Revision ID: e7b41c9d0a52
+Revises: a3f9c2d71e64
+Create Date: 2023-03-30 17:52:45.381920
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e7b41c9d0a52"
+down_revision = "a3f9c2d71e64"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # The manifest is filled in by the next scan of each deployment
+    op.create_table(
+        "manifest_files",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("base_directory", sa.String(length=255), nullable=False),
+        sa.Column("path", sa.String(length=255), nullable=False),
+        sa.Column("filesize", sa.Integer(), nullable=True),
+        sa.Column("mtime_ns", sa.BigInteger(), nullable=True),
+        sa.Column("timestamp", sa.String(length=32), nullable=True),
+        sa.Column("width", sa.Integer(), nullable=True),
+        sa.Column("height", sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_manifest_files_base_directory_path",
+        "manifest_files",
+        ["base_directory", "path"],
+        unique=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_manifest_files_base_directory_path", table_name="manifest_files")
+    op.drop_table("manifest_files")
@@ -0,0 +1,33 @@
+"""add detections updated_at
+
+Revision ID: c4e8a1f5b7d3
+Revises: e7b41c9d0a52
+Create Date: 2023-03-31 18:37:12.504113
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "c4e8a1f5b7d3"
+down_revision = "e7b41c9d0a52"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("detections", sa.Column("updated_at", sa.DateTime(), nullable=True))
+    # The existing rows were last changed when they were detected at the latest
+    detections = sa.table(
+        "detections",
+        sa.column("updated_at", sa.DateTime),
+        sa.column("last_detected", sa.DateTime),
+    )
+    op.execute(detections.update().values(updated_at=detections.c.last_detected))
+    op.create_index("ix_detections_updated_at", "detections", ["updated_at"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_detections_updated_at", table_name="detections")
+    op.drop_column("detections", "updated_at")
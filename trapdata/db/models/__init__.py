@@ -1,6 +1,18 @@
 from .events import MonitoringSession
 from .images import TrapImage
 from .detections import DetectedObject
+from .tracks import Track
+from .jobs import Job
+from .counters import StageCounter
+from .manifest import ManifestFile
 
 
-__models__ = [MonitoringSession, TrapImage, DetectedObject]
+__models__ = [
+    MonitoringSession,
+    TrapImage,
+    DetectedObject,
+    Track,
+    Job,
+    StageCounter,
+    ManifestFile,
+]
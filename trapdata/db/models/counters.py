@@ -0,0 +1,222 @@
+import contextlib
+from typing import Iterator, Optional
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from trapdata.db import Base, get_session
+from trapdata.db.base import retry_if_locked
+from trapdata.common.logs import logger
+from trapdata.common.types import FilePath
+
+
+COUNTER_KEYS = ("unprocessed", "queued", "done")
+
+Counts = dict[tuple[str, str], dict[str, int]]
+
+
+class StageCounter(Base):
+    """
+    Running totals of the records of a deployment in each processing stage.
+
+    The counters are updated in the same transaction as the changes to the records
+    (see `track_stage_counters`), so reading them costs the same regardless of the
+    size of the deployment. They can be rebuilt from scratch with
+    `reconcile_stage_counters`.
+    """
+
+    __tablename__ = "stage_counters"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    base_directory = sa.Column(sa.String(255), nullable=False)
+    stage = sa.Column(sa.String(255), nullable=False)
+    unprocessed = sa.Column(sa.Integer, nullable=False, default=0)
+    queued = sa.Column(sa.Integer, nullable=False, default=0)
+    done = sa.Column(sa.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        sa.UniqueConstraint(
+            base_directory, stage, name="uq_stage_counters_base_directory_stage"
+        ),
+    )
+
+    def __repr__(self):
+        return (
+            f"StageCounter(base_directory={self.base_directory!r}, "
+            f"stage={self.stage!r}, unprocessed={self.unprocessed!r}, "
+            f"queued={self.queued!r}, done={self.done!r})"
+        )
+
+
+def count_stages(session: orm.Session, filters: dict[type, sa.ColumnElement]) -> Counts:
+    """
+    Count the records matching the filter of each model in every stage,
+    grouped by deployment.
+    """
+    from trapdata.db.models.events import MonitoringSession
+    from trapdata.db.models.queue import stage_status_columns
+
+    counts: Counts = {}
+    for model, where in filters.items():
+        columns = stage_status_columns(model)
+        stmt = (
+            sa.select(MonitoringSession.base_directory, *columns)
+            .join(
+                MonitoringSession, model.monitoring_session_id == MonitoringSession.id
+            )
+            .where(where)
+            .group_by(MonitoringSession.base_directory)
+        )
+        for row in session.execute(stmt):
+            base_directory, *values = row
+            for column, value in zip(columns, values):
+                stage, key = column.name.rsplit("_", 1)
+                counts.setdefault((base_directory, stage), {})[key] = value
+    return counts
+
+
+def apply_count_changes(session: orm.Session, before: Counts, after: Counts) -> int:
+    """
+    Add the difference between two counts of the same records to the counters.
+
+    Deployments that do not have counters yet are skipped, they are counted
+    from scratch the first time they are read.
+    """
+    changes = []
+    for base_directory, stage in set(before) | set(after):
+        previous = before.get((base_directory, stage), {})
+        current = after.get((base_directory, stage), {})
+        change = {
+            key: current.get(key, 0) - previous.get(key, 0) for key in COUNTER_KEYS
+        }
+        if any(change.values()):
+            changes.append(
+                {"b_base_directory": base_directory, "b_stage": stage, **change}
+            )
+    if not changes:
+        return 0
+
+    table = StageCounter.__table__
+    stmt = (
+        sa.update(table)
+        .where(
+            (table.c.base_directory == sa.bindparam("b_base_directory"))
+            & (table.c.stage == sa.bindparam("b_stage"))
+        )
+        .values({key: table.c[key] + sa.bindparam(key) for key in COUNTER_KEYS})
+    )
+    session.execute(stmt, changes)
+    return len(changes)
+
+
+@contextlib.contextmanager
+def track_stage_counters(
+    session: orm.Session, filters: dict[type, sa.ColumnElement]
+) -> Iterator[None]:
+    """
+    Update the stage counters with the changes made to the matching records
+    within the block. The caller commits the changes & counters together.
+
+    The filters should match every record the block inserts, updates or deletes,
+    e.g. `{TrapImage: TrapImage.id.in_(image_ids)}`. Only those records are counted.
+    """
+    before = count_stages(session, filters)
+    yield
+    after = count_stages(session, filters)
+    apply_count_changes(session, before, after)
+
+
+def reconcile_stage_counters(
+    session: orm.Session, base_directory: Optional[FilePath] = None
+) -> Counts:
+    """
+    Rebuild the counters of one deployment (or all of them) by counting every record.
+    """
+    from trapdata.db.models.images import TrapImage
+    from trapdata.db.models.detections import DetectedObject
+    from trapdata.db.models.events import MonitoringSession
+    from trapdata.db.models.queue import all_queues
+
+    if base_directory is not None:
+        base_directory = str(base_directory)
+        in_deployment = MonitoringSession.base_directory == base_directory
+        base_directories = [base_directory]
+    else:
+        in_deployment = sa.true()
+        base_directories = []
+    base_directories += (
+        session.execute(
+            sa.select(MonitoringSession.base_directory).where(in_deployment).distinct()
+        )
+        .scalars()
+        .all()
+    )
+
+    deployment_ids = sa.select(MonitoringSession.id).where(in_deployment)
+    counts = count_stages(
+        session,
+        {
+            model: model.monitoring_session_id.in_(deployment_ids)
+            for model in (TrapImage, DetectedObject)
+        },
+    )
+    stages = [queue.stage for queue in all_queues(None, None).values()]
+
+    stmt = sa.delete(StageCounter)
+    if base_directory is not None:
+        stmt = stmt.where(StageCounter.base_directory == base_directory)
+    session.execute(stmt)
+    counters = [
+        {
+            "base_directory": directory,
+            "stage": stage,
+            **{
+                key: counts.get((directory, stage), {}).get(key, 0)
+                for key in COUNTER_KEYS
+            },
+        }
+        for directory in sorted(set(base_directories))
+        for stage in stages
+    ]
+    if counters:
+        session.execute(sa.insert(StageCounter), counters)
+    logger.info(f"Rebuilt stage counters for {len(set(base_directories))} deployments")
+    return counts
+
+
+@retry_if_locked
+def get_stage_counters(
+    db_path: str, base_directory: FilePath
+) -> dict[str, dict[str, int]]:
+    """
+    Return the counters of every queue in the deployment, keyed by queue name
+    like `queue_status`. The counters are rebuilt the first time they are read.
+    """
+    from trapdata.db.models.queue import all_queues
+
+    queues = all_queues(db_path, base_directory).values()
+    with get_session(db_path) as sesh:
+        counters = {
+            counter.stage: counter
+            for counter in sesh.execute(
+                sa.select(StageCounter).where(
+                    StageCounter.base_directory == str(base_directory)
+                )
+            ).scalars()
+        }
+        if not counters:
+            reconcile_stage_counters(sesh, base_directory)
+            sesh.commit()
+            return get_stage_counters(db_path, base_directory)
+
+        return {
+            queue.name: {
+                key: (
+                    getattr(counters[queue.stage], key)
+                    if queue.stage in counters
+                    else 0
+                )
+                for key in COUNTER_KEYS
+            }
+            for queue in queues
+        }
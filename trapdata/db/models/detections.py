@@ -1,7 +1,17 @@
+import collections
 import datetime
 import pathlib
 import statistics
-from typing import Iterable, Union, Optional, Any, Sequence, TypedDict
+from typing import (
+    Iterable,
+    Iterator,
+    Mapping,
+    Union,
+    Optional,
+    Any,
+    Sequence,
+    TypedDict,
+)
 
 import sqlalchemy as sa
 from sqlalchemy import orm
@@ -10,12 +20,22 @@ from sqlalchemy_utils import UUIDType
 import PIL.Image
 
 from trapdata import db
+from trapdata.db.base import retry_if_locked
+from trapdata.db.types import FeatureVector
 from trapdata import constants
 from trapdata.common.types import FilePath
-from trapdata.db.models.images import completely_classified
+from trapdata.db.models.images import previous_image_ids
+from trapdata.db.models.jobs import delete_jobs
+from trapdata.db.models.counters import (
+    count_stages,
+    apply_count_changes,
+    track_stage_counters,
+)
+from trapdata.db.models.tracks import Track, update_tracks, sequences_of_objects
 from trapdata.db import models
 from trapdata.common.logs import logger
 from trapdata.common.utils import bbox_area, bbox_center, export_report
+from trapdata.common.cache import crop_cache, load_image, open_frame
 from trapdata.common.filemanagement import (
     save_image,
     absolute_path,
@@ -54,10 +74,53 @@ class DetectedObject(db.Base):
     sequence_frame = sa.Column(sa.Integer)
     sequence_previous_id = sa.Column(sa.Integer)
     sequence_previous_cost = sa.Column(sa.Float)
-    cnn_features = sa.Column(sa.JSON)
+    cnn_features = sa.Column(FeatureVector)
+    # The latest detection of each bounding box in an image. Older detections
+    # of the same box are kept but ignored by the processing queues.
+    canonical = sa.Column(sa.Boolean, default=True)
+    # Set by every change to the row, so incremental snapshots find the
+    # classifications, features & tracks saved since the previous snapshot
+    updated_at = sa.Column(
+        sa.DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now
+    )
 
     # @TODO add updated & created timestamps to all db models
 
+    __table_args__ = (
+        sa.Index("ix_detections_image_id", image_id),
+        sa.Index(
+            "ix_detections_monitoring_session_id_binary_label",
+            monitoring_session_id,
+            binary_label,
+        ),
+        sa.Index(
+            "ix_detections_sequence_id_sequence_frame",
+            sequence_id,
+            sequence_frame,
+        ),
+        # Partial indexes must use the exact expressions of the queue queries
+        sa.Index(
+            "ix_detections_queued",
+            monitoring_session_id,
+            sqlite_where=in_queue.is_(True),
+            postgresql_where=in_queue.is_(True),
+        ),
+        sa.Index(
+            "ix_detections_without_features",
+            monitoring_session_id,
+            sqlite_where=cnn_features.is_(None),
+            postgresql_where=cnn_features.is_(None),
+        ),
+        sa.Index(
+            "ix_detections_canonical",
+            monitoring_session_id,
+            binary_label,
+            sqlite_where=canonical.is_(True),
+            postgresql_where=canonical.is_(True),
+        ),
+        sa.Index("ix_detections_updated_at", updated_at),
+    )
+
     image = orm.relationship(
         "TrapImage",
         back_populates="detected_objects",
@@ -86,10 +149,16 @@ class DetectedObject(db.Base):
         self,
         source_image: Union[models.TrapImage, None] = None,
         base_path: Union[pathlib.Path, str, None] = None,
+        frame: Optional[PIL.Image.Image] = None,
     ):
         """
         Return a PIL image of this detected object.
+
+        The crop is made from `frame` if the decoded source image is already open.
         """
+        crop = crop_cache.get(str(self.path)) if self.path else None
+        if crop is not None:
+            return crop
         path = absolute_path(str(self.path), base_path)
         if path and path.exists():
             logger.debug(f"Using existing image crop: {path}")
@@ -101,32 +170,39 @@ class DetectedObject(db.Base):
             logger.debug(
                 f"Extracting cropped image data from source image {source_image.path}"
             )
-            image = PIL.Image.open(str(source_image.absolute_path))
-            return image.crop(self.bbox)  # type:ignore
+            if frame is None:
+                frame = open_frame(source_image.absolute_path)
+            return frame.crop(self.bbox)  # type: ignore
 
     def save_cropped_image_data(
         self,
         base_path: Union[pathlib.Path, str, None] = None,
         source_image: Union[models.TrapImage, None] = None,
+        frame: Optional[PIL.Image.Image] = None,
+        exif_data: Optional[PIL.Image.Exif] = None,
     ):
         """
+        Pass the decoded source image as `frame` and the EXIF data from `crop_exif`
+        when saving many crops of the same image, so they are only made once.
+
         @TODO need consistent way of discovering the user_data_path in the application settings
         and using that for the base_path.
         """
         source_image = source_image or self.image
-
-        exif_data: PIL.Image.Exif = PIL.Image.open(source_image.absolute_path).getexif()
-        exif_data = construct_exif(
-            description=f"Source image: {source_image.path}",
-            timestamp=source_image.timestamp,  # type:ignore
-            existing_exif=exif_data,
+        if exif_data is None:
+            # Only the header is read if the frame is not open
+            source = frame
+            if source is None:
+                source = PIL.Image.open(source_image.absolute_path)
+            exif_data = crop_exif(source_image, source)
+
+        crop = self.cropped_image_data(
+            base_path=base_path,
+            source_image=source_image,
+            frame=frame,
         )
-
         fpath = save_image(
-            image=self.cropped_image_data(
-                base_path=base_path,
-                source_image=source_image,
-            ),
+            image=crop,
             base_path=base_path,
             subdir="crops",
             exif_data=exif_data,
@@ -144,7 +220,8 @@ class DetectedObject(db.Base):
         self, session: orm.Session
     ) -> Sequence["DetectedObject"]:
         stmt = sa.select(DetectedObject).where(
-            DetectedObject.image_id == self.source_image_previous_frame
+            (DetectedObject.image_id == self.source_image_previous_frame)
+            & DetectedObject.canonical.is_(True)
         )
         return session.execute(stmt).unique().scalars().all()
 
@@ -152,32 +229,34 @@ class DetectedObject(db.Base):
         """
         Return the start time, end time duration in minutes, and number of frames for a track
         """
+        num_frames = None
         if self.sequence_id:
-            stmt = sa.select(
-                sa.func.max(DetectedObject.sequence_frame).label("last_frame_num"),
-            ).where((DetectedObject.sequence_id == self.sequence_id))
-            row = session.execute(stmt).one()
-            return row.last_frame_num + 1
-        else:
-            return 1
+            stmt = sa.select(Track.num_frames).where(
+                Track.sequence_id == self.sequence_id
+            )
+            num_frames = session.execute(stmt).scalar()
+        return num_frames or 1
 
     def track_info(self, session: orm.Session) -> dict[str, Any]:
         """
         Return the start time, end time duration in minutes, and number of frames for a track
         """
 
+        track = None
         if self.sequence_id:
-            stmt = sa.select(
-                sa.func.min(DetectedObject.timestamp).label("start"),
-                sa.func.max(DetectedObject.timestamp).label("end"),
-                sa.func.max(DetectedObject.sequence_frame).label("last_frame_num"),
-            ).where((DetectedObject.sequence_id == self.sequence_id))
-            start_time, end_time, last_frame_num = session.execute(stmt).one()
-            num_frames = last_frame_num + 1
+            stmt = sa.select(Track).where(Track.sequence_id == self.sequence_id)
+            track = session.execute(stmt).scalar()
+        if track:
+            return self._track_info(track.start_time, track.end_time, track.num_frames)
         else:
-            start_time, end_time = self.timestamp, self.timestamp
-            num_frames = 1
+            return self._track_info(self.timestamp, self.timestamp, 1)
 
+    def _track_info(
+        self,
+        start_time: datetime.datetime,
+        end_time: datetime.datetime,
+        num_frames: int,
+    ) -> dict[str, Any]:
         def get_minutes(timedelta):
             return int(round(timedelta.seconds / 60, 0))
 
@@ -209,12 +288,8 @@ class DetectedObject(db.Base):
         """
         stmt = (
             sa.select(DetectedObject)
-            .where(
-                (DetectedObject.sequence_id == self.sequence_id)
-                & DetectedObject.sequence_id.isnot(None)
-                & DetectedObject.specific_label_score.isnot(None)
-            )
-            .order_by(DetectedObject.specific_label_score.desc())
+            .join(Track, Track.best_detection_id == DetectedObject.id)
+            .where(Track.sequence_id == self.sequence_id)
         )
         best_sibling = session.execute(stmt).unique().scalars().first()
         if best_sibling:
@@ -239,34 +314,133 @@ class DetectedObject(db.Base):
             session.commit()
 
     def report_data(self) -> dict[str, Any]:
-        if self.specific_label:
-            label = self.specific_label
-            score = self.specific_label_score
-        else:
-            label = self.binary_label
-            score = self.binary_label_score
-
-        return {
-            "trap": pathlib.Path(self.monitoring_session.base_directory).name,
-            "event": self.monitoring_session.day.isoformat(),
-            "sequence": self.sequence_id,
-            "sequence_frame": self.sequence_frame,
-            "sequence_cost": self.sequence_previous_cost,
-            "source_image": self.image.absolute_path,
-            "cropped_image": self.path,
-            "timestamp": self.image.timestamp.isoformat(),
-            "bbox": self.bbox,
-            "bbox_center": bbox_center(self.bbox) if self.bbox else None,
-            "area_pixels": self.area_pixels,
-            "model_name": self.model_name,
-            "category_label": label,
-            "category_score": score,
+        # The columns of the report are read from this object and its relations
+        related = {
+            DetectedObject: self,
+            models.MonitoringSession: self.monitoring_session,
+            models.TrapImage: self.image,
         }
+        return detection_report(
+            {
+                name: getattr(related[column.class_], column.key)
+                for name, column in report_columns().items()
+            }
+        )
 
     def to_json(self):
         return self.report_data()
 
 
+def report_columns() -> dict[str, orm.InstrumentedAttribute]:
+    """
+    Return the columns read for the report of a detection, keyed by the names
+    passed to `detection_report`.
+    """
+    image = models.TrapImage
+    event = models.MonitoringSession
+    return {
+        "id": DetectedObject.id,
+        "base_directory": event.base_directory,
+        "day": event.day,
+        "sequence_id": DetectedObject.sequence_id,
+        "sequence_frame": DetectedObject.sequence_frame,
+        "sequence_previous_cost": DetectedObject.sequence_previous_cost,
+        "image_base_path": image.base_path,
+        "image_path": image.path,
+        "path": DetectedObject.path,
+        "image_timestamp": image.timestamp,
+        "bbox": DetectedObject.bbox,
+        "area_pixels": DetectedObject.area_pixels,
+        "model_name": DetectedObject.model_name,
+        "specific_label": DetectedObject.specific_label,
+        "specific_label_score": DetectedObject.specific_label_score,
+        "binary_label": DetectedObject.binary_label,
+        "binary_label_score": DetectedObject.binary_label_score,
+    }
+
+
+def detection_report(values: Mapping[str, Any]) -> dict[str, Any]:
+    """
+    Return the report data of a detection from the values of `report_columns`.
+    """
+    if values["specific_label"]:
+        label, score = values["specific_label"], values["specific_label_score"]
+    else:
+        label, score = values["binary_label"], values["binary_label_score"]
+    timestamp = values["image_timestamp"]
+    bbox = values["bbox"]
+    return {
+        "id": values["id"],
+        "trap": pathlib.Path(values["base_directory"]).name,
+        "event": values["day"].isoformat(),
+        "sequence": values["sequence_id"],
+        "sequence_frame": values["sequence_frame"],
+        "sequence_cost": values["sequence_previous_cost"],
+        "source_image": absolute_path(values["image_path"], values["image_base_path"]),
+        "cropped_image": values["path"],
+        "timestamp": timestamp.isoformat() if timestamp else None,
+        "bbox": bbox,
+        "bbox_center": bbox_center(bbox) if bbox else None,
+        "area_pixels": values["area_pixels"],
+        "model_name": values["model_name"],
+        "category_label": label,
+        "category_score": score,
+    }
+
+
+def detection_values(
+    images: Sequence[models.TrapImage],
+    detected_objects_data,
+    previous_frames: Mapping[int, Optional[int]],
+    timestamp: datetime.datetime,
+    user_data_path=None,
+) -> list[dict[str, Any]]:
+    """
+    Return the values of the new detections of each image, and save their crops.
+    The saved crops are added to the `crop_cache` if it is enabled.
+    """
+    detections = []
+    for image, detected_objects in zip(images, detected_objects_data):
+        if not detected_objects:
+            continue
+        # Decoded once for all the crops of the image
+        frame = open_frame(image.absolute_path)
+        exif_data = crop_exif(image, frame)
+        for object_data in detected_objects:
+            values = {
+                "image_id": image.id,
+                "monitoring_session_id": image.monitoring_session_id,
+                "timestamp": image.timestamp,
+                "source_image_previous_frame": previous_frames[image.id],
+                "source_image_width": image.width,
+                "source_image_height": image.height,
+                "last_detected": timestamp,
+                "updated_at": timestamp,
+                "in_queue": True,
+                **object_data,
+            }
+            if "bbox" in object_data:
+                values["area_pixels"] = bbox_area(object_data["bbox"])
+            values["canonical"] = values.get("bbox") is not None
+
+            # The crop is written from an unsaved instance to get its path
+            detection = DetectedObject(**values)
+            detection.save_cropped_image_data(
+                source_image=image,
+                base_path=user_data_path,
+                frame=frame,
+                exif_data=exif_data,
+            )
+            values["path"] = detection.path
+            if crop_cache.max_bytes:
+                # Kept in memory for the classifiers as they would read it from
+                # the file, after the JPEG compression
+                crop_cache.put(detection.path, load_image(detection.path))
+            detections.append(values)
+    return detections
+
+
+@retry_if_locked
 def save_detected_objects(
     db_path,
     image_ids,
@@ -274,98 +448,159 @@ def save_detected_objects(
     user_data_path=None,
     delete_existing=True,
 ):
-    orm_objects = []
-    with db.get_session(db_path) as sesh:
-        images = (
-            sesh.query(models.TrapImage)
-            .filter(models.TrapImage.id.in_(image_ids))
-            .all()
-        )
+    """
+    Save the objects detected in a batch of images in a single transaction.
+    Their crops are saved before the transaction.
+
+    `detected_objects_data` has a list of detected objects for each image ID.
+    The existing detections of the images are deleted, or if `delete_existing`
+    is False, kept but not canonical if the same bounding box was detected again.
+    """
+    from trapdata.db.models.queue import stages_of
+    from trapdata.db.models.events import update_all_aggregates
 
     timestamp = datetime.datetime.now()
 
-    with db.get_session(db_path) as sesh:
-        for image, detected_objects in zip(images, detected_objects_data):
-            existing_objects = image.detected_objects
-            if delete_existing and len(existing_objects):
-                logger.info(
-                    f"Deleting {len(existing_objects)} existing objects for image {image.id}"
-                )
-                for existing_obj in existing_objects:
-                    sesh.delete(existing_obj)
+    changed_records = {
+        models.TrapImage: models.TrapImage.id.in_(image_ids),
+        DetectedObject: DetectedObject.image_id.in_(image_ids),
+    }
 
-            image.last_processed = timestamp
+    with db.get_session(db_path) as sesh:
+        images = {
+            image.id: image
+            for image in sesh.execute(
+                sa.select(models.TrapImage)
+                .where(models.TrapImage.id.in_(image_ids))
+                .options(orm.noload(models.TrapImage.detected_objects))
+            )
+            .unique()
+            .scalars()
+        }
+        previous_frames = previous_image_ids(sesh, image_ids)
+
+    # The crops are made before the write transaction, so the database is not
+    # locked while the images are decoded and encoded
+    detections = detection_values(
+        [images[image_id] for image_id in image_ids],
+        detected_objects_data,
+        previous_frames,
+        timestamp,
+        user_data_path,
+    )
 
-            # sesh.add(image)
-            orm_objects.append(image)
+    with db.get_session(db_path) as sesh:
+        counts_before = count_stages(sesh, changed_records)
 
-            for object_data in detected_objects:
-                detection = DetectedObject(
-                    last_detected=timestamp,
-                    in_queue=True,
+        sequence_ids = []
+        if delete_existing:
+            sequence_ids = sequences_of_objects(
+                sesh, DetectedObject.image_id.in_(image_ids)
+            )
+            # The claims on the deleted objects would never be completed
+            deleted_ids = sa.select(DetectedObject.id).where(
+                DetectedObject.image_id.in_(image_ids)
+            )
+            for stage in stages_of(DetectedObject):
+                delete_jobs(sesh, stage, deleted_ids)
+            num_deleted = sesh.execute(
+                sa.delete(DetectedObject).where(DetectedObject.image_id.in_(image_ids))
+            ).rowcount
+            if num_deleted:
+                logger.info(f"Deleted {num_deleted} existing objects for images")
+        else:
+            # Only the new detection of a bounding box stays canonical
+            new_bboxes = {
+                (image_id, str(obj.get("bbox")))
+                for image_id, detected_objects in zip(image_ids, detected_objects_data)
+                for obj in detected_objects
+            }
+            existing_objects = sesh.execute(
+                sa.select(
+                    DetectedObject.id, DetectedObject.image_id, DetectedObject.bbox
+                ).where(
+                    DetectedObject.image_id.in_(image_ids)
+                    & DetectedObject.canonical.is_(True)
                 )
-
-                if "bbox" in object_data:
-                    area_pixels = bbox_area(object_data["bbox"])
-                    object_data["area_pixels"] = area_pixels
-
-                for k, v in object_data.items():
-                    logger.debug(f"Adding {k} to detected object {detection.id}")
-                    setattr(detection, k, v)
-
-                detection.monitoring_session_id = image.monitoring_session_id
-                detection.image_id = image.id
-
-                detection.save_cropped_image_data(
-                    source_image=image,
-                    base_path=user_data_path,
+            ).all()
+            replaced_ids = [
+                obj_id
+                for obj_id, image_id, bbox in existing_objects
+                if (image_id, str(bbox)) in new_bboxes
+            ]
+            if replaced_ids:
+                sesh.execute(
+                    sa.update(DetectedObject)
+                    .where(DetectedObject.id.in_(replaced_ids))
+                    .values({"canonical": False})
                 )
 
-                detection.timestamp = image.timestamp
+        sesh.execute(
+            sa.update(models.TrapImage)
+            .where(models.TrapImage.id.in_(image_ids))
+            .values({"last_processed": timestamp, "in_queue": False})
+        )
 
-                previous_image = image.previous_image(sesh)
-                detection.source_image_previous_frame = (
-                    previous_image.id if previous_image else None
-                )
-                detection.source_image_width = image.width
-                detection.source_image_height = image.height
-                logger.debug(
-                    f"Previous image: {detection.source_image_previous_frame}, current image: {image.id}"
-                )
+        logger.info(f"Inserting {len(detections)} detected objects")
+        if detections:
+            # Include the NULL values so all rows are sent in one statement
+            sesh.execute(
+                sa.insert(DetectedObject).execution_options(render_nulls=True),
+                detections,
+            )
 
-                logger.debug(f"Creating detected object {detection} for image {image}")
+        # The tracks of the deleted detections are left with their other detections
+        update_tracks(sesh, sequence_ids=sequence_ids)
+        apply_count_changes(sesh, counts_before, count_stages(sesh, changed_records))
+        # The number of detections of the events
+        update_all_aggregates(
+            sesh,
+            models.MonitoringSession.id.in_(
+                {image.monitoring_session_id for image in images.values()}
+            ),
+        )
+        sesh.commit()
 
-                orm_objects.append(detection)
 
-            # @TODO this could be faster! Especially for sqlite
-            logger.info(f"Bulk saving {len(orm_objects)} objects")
-            sesh.bulk_save_objects(orm_objects)
-            sesh.commit()
+def crop_exif(source_image: models.TrapImage, frame: PIL.Image.Image) -> PIL.Image.Exif:
+    """
+    Return the EXIF data for the crops of a source image, from its decoded frame.
+    """
+    # Loaded from the raw data rather than `frame.getexif()`, which is modified in
+    # place and the frame may be shared with other threads by the frame cache
+    exif_data = PIL.Image.Exif()
+    if "exif" in frame.info:
+        exif_data.load(frame.info["exif"])
+    return construct_exif(
+        description=f"Source image: {source_image.path}",
+        timestamp=source_image.timestamp,  # type: ignore
+        existing_exif=exif_data,
+    )
 
 
+@retry_if_locked
 def save_classified_objects(db_path, object_ids, classified_objects_data):
+    """
+    Save the data of each classified object to the object with the ID in the same
+    position. Only the fields in the data are updated, with one executemany UPDATE.
+    """
     logger.debug(f"Saving data to classified objects: {object_ids}")
 
-    orm_objects = []
-    timestamp = datetime.datetime.now()
-    with db.get_session(db_path) as sesh:
-        objects = (
-            sesh.query(DetectedObject).filter(DetectedObject.id.in_(object_ids)).all()
-        )
-
-    for obj, object_data in zip(objects, classified_objects_data):
-        obj.last_processed = timestamp
-
-        logger.debug(f"Updating classified object {obj}")
-        for k, v in object_data.items():
-            logger.debug(f"Adding {k} to detected object {obj.id}")
-            setattr(obj, k, v)
-
-        orm_objects.append(obj)
+    values = [
+        {"id": object_id, **object_data}
+        for object_id, object_data in zip(object_ids, classified_objects_data)
+    ]
 
     with db.get_session(db_path) as sesh:
-        logger.info(f"Bulk saving {len(orm_objects)} objects")
-        sesh.bulk_save_objects(orm_objects)
+        logger.info(f"Bulk updating {len(values)} objects")
+        # The sequences before & after the update, since it may clear them
+        sequence_ids = sequences_of_objects(sesh, DetectedObject.id.in_(object_ids))
+        with track_stage_counters(
+            sesh, {DetectedObject: DetectedObject.id.in_(object_ids)}
+        ):
+            sesh.execute(sa.update(DetectedObject), values)
+        sequence_ids += sequences_of_objects(sesh, DetectedObject.id.in_(object_ids))
+        update_tracks(sesh, sequence_ids=sequence_ids)
         sesh.commit()
 
 
@@ -391,6 +626,96 @@ def get_detected_objects(
         ).all()
 
 
+def iter_detection_reports(
+    db_path,
+    image_base_path: FilePath,
+    limit: Optional[int] = None,
+    offset: int = 0,
+    after_id: Optional[int] = None,
+    batch_size: int = 1000,
+) -> Iterator[dict[str, Any]]:
+    """
+    Yield the report data of the detections in a deployment in order of ID.
+
+    The rows are read one page at a time by keyset pagination, in a new session
+    for each page, so exporting millions of detections uses constant memory.
+    Pass the ID of the last detection exported as `after_id` to resume an export.
+    """
+    image = models.TrapImage
+    event = models.MonitoringSession
+    stmt = (
+        sa.select(*[column.label(name) for name, column in report_columns().items()])
+        .join(event, event.id == DetectedObject.monitoring_session_id)
+        .join(image, image.id == DetectedObject.image_id)
+        .where(event.base_directory == str(image_base_path))
+        .order_by(DetectedObject.id)
+    )
+
+    remaining = limit
+    while remaining is None or remaining > 0:
+        page = stmt.limit(
+            batch_size if remaining is None else min(batch_size, remaining)
+        )
+        if after_id is not None:
+            page = page.where(DetectedObject.id > after_id)
+        elif offset:
+            page = page.offset(offset)
+        with db.get_session(db_path) as sesh:
+            rows = sesh.execute(page).all()
+        if not rows:
+            break
+        for row in rows:
+            yield detection_report(row._mapping)
+        after_id = rows[-1].id
+        if remaining is not None:
+            remaining -= len(rows)
+
+
+def get_best_siblings(
+    session: orm.Session, objects: Sequence[DetectedObject]
+) -> dict[int, DetectedObject]:
+    """
+    Return the result of `DetectedObject.best_sibling` for many objects at once,
+    keyed by object ID. Uses one query for all of their tracks.
+    """
+    sequence_ids = {obj.sequence_id for obj in objects if obj.sequence_id}
+    best = {
+        sequence_id: obj
+        for sequence_id, obj in session.execute(
+            sa.select(Track.sequence_id, DetectedObject)
+            .join(DetectedObject, DetectedObject.id == Track.best_detection_id)
+            .where(Track.sequence_id.in_(sequence_ids))
+        ).unique()
+    }
+    return {obj.id: best.get(obj.sequence_id, obj) for obj in objects}
+
+
+def get_track_info(
+    session: orm.Session, objects: Sequence[DetectedObject]
+) -> dict[int, dict[str, Any]]:
+    """
+    Return the result of `DetectedObject.track_info` for many objects at once,
+    keyed by object ID. Uses one query for all of their tracks.
+    """
+    sequence_ids = {obj.sequence_id for obj in objects if obj.sequence_id}
+    tracks = {
+        track.sequence_id: track
+        for track in session.execute(
+            sa.select(Track).where(Track.sequence_id.in_(sequence_ids))
+        ).scalars()
+    }
+    info = {}
+    for obj in objects:
+        track = tracks.get(obj.sequence_id)
+        if track:
+            info[obj.id] = obj._track_info(
+                track.start_time, track.end_time, track.num_frames
+            )
+        else:
+            info[obj.id] = obj._track_info(obj.timestamp, obj.timestamp, 1)
+    return info
+
+
 def get_objects_for_image(db_path, image_id):
     with db.get_session(db_path) as sesh:
         return sesh.query(DetectedObject.binary_label).filter_by(image_id=image_id)
@@ -400,11 +725,12 @@ def get_unique_objects_for_image(db_path, image_id) -> Sequence[DetectedObject]:
     with db.get_session(db_path) as sesh:
         objects = (
             sesh.execute(
-                sa.select(DetectedObject)
-                .where(DetectedObject.image_id == image_id)
-                .order_by(DetectedObject.last_detected.desc())
+                sa.select(DetectedObject).where(
+                    (DetectedObject.image_id == image_id)
+                    & DetectedObject.canonical.is_(True)
+                )
             )
-            .unique(lambda d: str(d.bbox))
+            .unique()
             .scalars()
             .all()
         )
@@ -412,8 +738,23 @@ def get_unique_objects_for_image(db_path, image_id) -> Sequence[DetectedObject]:
 
 
 def delete_objects_for_image(db_path, image_id):
+    from trapdata.db.models.events import update_all_aggregates
+
     with db.get_session(db_path) as sesh:
-        sesh.query(DetectedObject).filter_by(image_id=image_id).delete()
+        sequence_ids = sequences_of_objects(sesh, DetectedObject.image_id == image_id)
+        with track_stage_counters(
+            sesh, {DetectedObject: DetectedObject.image_id == image_id}
+        ):
+            sesh.query(DetectedObject).filter_by(image_id=image_id).delete()
+        update_tracks(sesh, sequence_ids=sequence_ids)
+        update_all_aggregates(
+            sesh,
+            models.MonitoringSession.id.in_(
+                sa.select(models.TrapImage.monitoring_session_id).where(
+                    models.TrapImage.id == image_id
+                )
+            ),
+        )
         sesh.commit()
 
 
@@ -489,52 +830,60 @@ def get_unique_species_by_track(
     Session = db.get_session_class(db_path)
     session = Session()
 
-    # Select all sequences where at least one example is above the score threshold
+    # Select all tracks where at least one example is above the score threshold
     sequences = session.execute(
         sa.select(
-            DetectedObject.sequence_id,
-            sa.func.count(DetectedObject.id).label(
-                "sequence_frame_count"
-            ),  # frames in track
-            sa.func.max(DetectedObject.specific_label_score).label(
-                "sequence_best_score"
-            ),
-            sa.func.min(DetectedObject.timestamp).label("sequence_start_time"),
-            sa.func.max(DetectedObject.timestamp).label("sequence_end_time"),
+            Track.sequence_id,
+            Track.num_detections.label("sequence_frame_count"),  # frames in track
+            Track.best_score.label("sequence_best_score"),
+            Track.start_time.label("sequence_start_time"),
+            Track.end_time.label("sequence_end_time"),
         )
-        .group_by("sequence_id")
-        .where((DetectedObject.monitoring_session_id == monitoring_session.id))
-        .having(
-            sa.func.max(DetectedObject.specific_label_score)
-            >= classification_threshold,
+        .where(
+            (Track.monitoring_session_id == monitoring_session.id)
+            & (Track.best_score >= classification_threshold)
         )
-        .order_by(DetectedObject.specific_label)
+        .order_by(Track.best_label)
     ).all()
 
+    # The best examples of every track, in one query
+    ranked = (
+        sa.select(
+            DetectedObject.image_id.label("source_image_id"),
+            DetectedObject.specific_label.label("label"),
+            DetectedObject.specific_label_score.label("score"),
+            DetectedObject.path.label("cropped_image_path"),
+            DetectedObject.sequence_id,
+            DetectedObject.timestamp,
+            sa.func.row_number()
+            .over(
+                partition_by=DetectedObject.sequence_id,
+                order_by=DetectedObject.specific_label_score.desc(),
+            )
+            .label("rank"),
+        )
+        .where(
+            (DetectedObject.monitoring_session_id == monitoring_session.id)
+            & DetectedObject.sequence_id.in_([seq.sequence_id for seq in sequences])
+        )
+        .subquery()
+    )
+    examples = collections.defaultdict(list)
+    for example in session.execute(
+        sa.select(*[c for c in ranked.c if c.name != "rank"])
+        .where(ranked.c.rank <= num_examples)
+        .order_by(ranked.c.sequence_id, ranked.c.rank)
+    ):
+        examples[example.sequence_id].append(example._mapping)
+
     rows = []
     for sequence in sequences:
-        frames = session.execute(
-            sa.select(
-                DetectedObject.image_id.label("source_image_id"),
-                DetectedObject.specific_label.label("label"),
-                DetectedObject.specific_label_score.label("score"),
-                DetectedObject.path.label("cropped_image_path"),
-                DetectedObject.sequence_id,
-                DetectedObject.timestamp,
-            )
-            .where(
-                (DetectedObject.monitoring_session_id == monitoring_session.id)
-                & (DetectedObject.sequence_id == sequence.sequence_id)
-            )
-            # .order_by(sa.func.random())
-            .order_by(sa.desc("score"))
-            .limit(num_examples)
-        ).all()
+        frames = examples[sequence.sequence_id]
         row = dict(sequence._mapping)
         if frames:
             best_example = frames[0]
-            row["label"] = best_example.label
-            row["examples"] = [example._mapping for example in frames[:num_examples]]
+            row["label"] = best_example["label"]
+            row["examples"] = frames
             row["sequence_duration"] = (
                 sequence.sequence_end_time - sequence.sequence_start_time
             )
@@ -553,31 +902,74 @@ def get_objects_for_species(db_path, species_label, monitoring_session=None):
         return sesh.execute(query).unique().all()
 
 
-def get_object_counts_for_image(db_path, image_id):
-    # @TODO this could all be one query. It runs on every frame of the playback.
-
-    # Every object detected
-    num_objects = get_objects_for_image(db_path, image_id).count()
-
-    # Every object that is a moth
-    num_detections = get_detections_for_image(db_path, image_id).count()
-
-    # Every object that has been classified to taxa level
-    num_classifications = get_classifications_for_image(db_path, image_id).count()
-
-    # Unique taxa names
-    num_species = get_species_for_image(db_path, image_id).count()
-
-    # Has every object detected in this image been fully processed?
-    is_completely_classified = completely_classified(db_path, image_id)
+def get_object_counts_for_images(
+    db_path, image_ids: Sequence[int]
+) -> dict[int, dict[str, Any]]:
+    """
+    Count the objects, detections, classifications & species in each image
+    with a single aggregate query, e.g. for the frames shown during playback.
+    """
+    image = models.TrapImage
+    is_detection = DetectedObject.binary_label == constants.POSITIVE_BINARY_LABEL
+    stmt = (
+        sa.select(
+            image.id,
+            image.last_processed,
+            image.in_queue,
+            # Every object detected
+            sa.func.count(DetectedObject.id).label("num_objects"),
+            # Every object that is a moth
+            sa.func.count(sa.case((is_detection, DetectedObject.id))).label(
+                "num_detections"
+            ),
+            # Every object that has been classified to taxa level
+            sa.func.count(
+                sa.case(
+                    (
+                        is_detection & DetectedObject.specific_label.is_not(None),
+                        DetectedObject.id,
+                    )
+                )
+            ).label("num_classifications"),
+            # Unique taxa names
+            sa.func.count(DetectedObject.specific_label.distinct()).label(
+                "num_species"
+            ),
+        )
+        .outerjoin(DetectedObject, DetectedObject.image_id == image.id)
+        .where(image.id.in_(image_ids))
+        .group_by(image.id)
+    )
 
-    return {
-        "num_objects": num_objects,
-        "num_detections": num_detections,
-        "num_species": num_species,
-        "num_classifications": num_classifications,
-        "completely_classified": is_completely_classified,
+    counts = {
+        image_id: {
+            "num_objects": 0,
+            "num_detections": 0,
+            "num_species": 0,
+            "num_classifications": 0,
+            "completely_classified": False,
+        }
+        for image_id in image_ids
     }
+    with db.get_session(db_path) as sesh:
+        for row in sesh.execute(stmt):
+            counts[row.id] = {
+                "num_objects": row.num_objects,
+                "num_detections": row.num_detections,
+                "num_species": row.num_species,
+                "num_classifications": row.num_classifications,
+                # Has every object detected in this image been fully processed?
+                "completely_classified": bool(
+                    row.last_processed
+                    and not row.in_queue
+                    and row.num_classifications == row.num_detections
+                ),
+            }
+    return counts
+
+
+def get_object_counts_for_image(db_path, image_id) -> dict[str, Any]:
+    return get_object_counts_for_images(db_path, [image_id])[image_id]
 
 
 def export_detected_objects(
@@ -1,15 +1,18 @@
 import pathlib
 import datetime
-from typing import Optional, Union, Iterable, Any
+from typing import Optional, Union, Iterable, Sequence, Any
 
 import sqlalchemy as sa
 from sqlalchemy import orm
 from sqlalchemy_utils import aggregated, observes
 
 from trapdata.db import Base, get_session
+from trapdata.db.base import retry_if_locked
 from trapdata.common.logs import logger
 from trapdata.common.utils import export_report
 from trapdata.db import models
+from trapdata.db.models.counters import track_stage_counters
+from trapdata.db.models.manifest import ManifestDelta, update_manifest, manifest_images
 from trapdata.common.filemanagement import find_images, group_images_by_day
 
 
@@ -26,6 +29,10 @@ class MonitoringSession(Base):
     # num_species = sa.Column(sa.Integer)
     notes = sa.Column(sa.JSON)
 
+    __table_args__ = (
+        sa.Index("ix_monitoring_sessions_base_directory_day", base_directory, day),
+    )
+
     @aggregated("images", sa.Column(sa.Integer))
     def num_images(self):
         return sa.func.count("1")
@@ -71,26 +78,8 @@ class MonitoringSession(Base):
     def update_aggregates(self, session: orm.Session):
         # Requires and active session
         logger.info(f"Updating cached values for event {self.day}")
-        self.num_images = session.execute(
-            sa.select(sa.func.count(1)).where(
-                models.TrapImage.monitoring_session_id == self.id
-            )
-        ).scalar_one()
-        self.num_detected_objects = session.execute(
-            sa.select(sa.func.count(1)).where(
-                models.DetectedObject.monitoring_session_id == self.id
-            )
-        ).scalar_one()
-        self.start_time: datetime.datetime = session.execute(
-            sa.select(sa.func.min(models.TrapImage.timestamp)).where(
-                models.TrapImage.monitoring_session_id == self.id
-            )
-        ).scalar_one()
-        self.end_time: datetime.datetime = session.execute(
-            sa.select(sa.func.max(models.TrapImage.timestamp)).where(
-                models.TrapImage.monitoring_session_id == self.id
-            )
-        ).scalar_one()
+        update_all_aggregates(session, MonitoringSession.id == self.id)
+        session.refresh(self, AGGREGATE_FIELDS)
 
     def duration(self) -> Optional[datetime.timedelta]:
         if self.start_time and self.end_time:
@@ -124,7 +113,73 @@ class MonitoringSession(Base):
         }
 
 
-def save_monitoring_session(db_path, base_directory, session):
+AGGREGATE_FIELDS = ["num_images", "num_detected_objects", "start_time", "end_time"]
+
+
+def update_all_aggregates(
+    session: orm.Session, where: Optional[sa.ColumnElement] = None
+) -> int:
+    """
+    Update the cached counts & times of all monitoring sessions matching the filter
+    (or every one) with a single grouped query, written back with one bulk UPDATE.
+    The caller commits the changes.
+
+    Returns the number of monitoring sessions updated.
+    """
+    if where is None:
+        where = sa.true()
+    session_ids = sa.select(MonitoringSession.id).where(where)
+    images = (
+        sa.select(
+            models.TrapImage.monitoring_session_id,
+            sa.func.count(models.TrapImage.id).label("num_images"),
+            sa.func.min(models.TrapImage.timestamp).label("start_time"),
+            sa.func.max(models.TrapImage.timestamp).label("end_time"),
+        )
+        .where(models.TrapImage.monitoring_session_id.in_(session_ids))
+        .group_by(models.TrapImage.monitoring_session_id)
+        .subquery()
+    )
+    detections = (
+        sa.select(
+            models.DetectedObject.monitoring_session_id,
+            sa.func.count(models.DetectedObject.id).label("num_detected_objects"),
+        )
+        .where(models.DetectedObject.monitoring_session_id.in_(session_ids))
+        .group_by(models.DetectedObject.monitoring_session_id)
+        .subquery()
+    )
+    stmt = (
+        sa.select(
+            MonitoringSession.id,
+            sa.func.coalesce(images.c.num_images, 0).label("num_images"),
+            sa.func.coalesce(detections.c.num_detected_objects, 0).label(
+                "num_detected_objects"
+            ),
+            images.c.start_time,
+            images.c.end_time,
+        )
+        .outerjoin(images, images.c.monitoring_session_id == MonitoringSession.id)
+        .outerjoin(
+            detections, detections.c.monitoring_session_id == MonitoringSession.id
+        )
+        .where(where)
+    )
+    values = [dict(row._mapping) for row in session.execute(stmt)]
+    if values:
+        session.execute(sa.update(MonitoringSession), values)
+    return len(values)
+
+
+def save_monitoring_session(db_path, base_directory, session, check_filesize=False):
+    """
+    Save a monitoring session found in the filesystem and add its new images.
+
+    The paths of the images already saved are loaded once and only the missing
+    images are inserted, in bulk. With `check_filesize`, the saved images with a
+    different filesize are updated and will be processed again.
+    This does not delete missing images.
+    """
     # @TODO find & save all images to the DB first, then
     # group by timestamp and construct monitoring sessions. window function?
     with get_session(db_path) as sesh:
@@ -142,39 +197,61 @@ def save_monitoring_session(db_path, base_directory, session):
         num_existing_images = (
             sesh.query(models.TrapImage).filter_by(monitoring_session_id=ms.id).count()
         )
-        if session["num_images"] > num_existing_images:
+        # Compare the number of images known in this session
+        # Only scan & add images if there is a difference.
+        if check_filesize or session["num_images"] > num_existing_images:
             logger.info(
                 f"session images: {session['num_images']}, saved count: {num_existing_images}"
             )
-            # Compare the number of images known in this session
-            # Only scan & add images if there is a difference.
-            # This does not delete missing images.
-            ms_images = []
+            existing_images = {
+                path: (image_id, filesize)
+                for image_id, path, filesize in sesh.execute(
+                    sa.select(
+                        models.TrapImage.id,
+                        models.TrapImage.path,
+                        models.TrapImage.filesize,
+                    ).where(models.TrapImage.monitoring_session_id == ms.id)
+                )
+            }
+            new_images = []
+            changed_images = []
             for image in session["images"]:
-                path = pathlib.Path(image["path"]).relative_to(ms.base_directory)
-                # absolute_path = pathlib.Path(ms.base_directory) / path
+                path = str(pathlib.Path(image["path"]).relative_to(ms.base_directory))
                 img_kwargs = {
-                    "monitoring_session_id": ms.id,
-                    "base_path": ms.base_directory,
-                    "path": str(path),
                     "timestamp": image["timestamp"],
                     "filesize": image["filesize"],
                     "width": image["shape"][0],
                     "height": image["shape"][1],
                     # file hash?
                 }
-                db_img = (
-                    sesh.query(models.TrapImage).filter_by(**img_kwargs).one_or_none()
-                )
-                if db_img:
-                    # logger.debug(f"Found existing Image in db: {img}")
-                    pass
-                else:
-                    db_img = models.TrapImage(**img_kwargs)
-                    logger.debug(f"Adding new Image to db: {db_img}")
-                ms_images.append(db_img)
-            logger.info(f"Bulk saving {len(ms_images)} objects")
-            sesh.bulk_save_objects(ms_images)
+                existing = existing_images.get(path)
+                if not existing:
+                    new_images.append(
+                        {
+                            "monitoring_session_id": ms.id,
+                            "base_path": ms.base_directory,
+                            "path": path,
+                            **img_kwargs,
+                        }
+                    )
+                elif check_filesize and existing[1] != image["filesize"]:
+                    logger.debug(f"Image has changed since it was saved: {path}")
+                    changed_images.append(
+                        {"id": existing[0], "last_processed": None, **img_kwargs}
+                    )
+
+            logger.info(
+                f"Adding {len(new_images)} new images, "
+                f"updating {len(changed_images)} changed images"
+            )
+            with track_stage_counters(
+                sesh,
+                {models.TrapImage: models.TrapImage.monitoring_session_id == ms.id},
+            ):
+                if new_images:
+                    sesh.execute(sa.insert(models.TrapImage), new_images)
+                if changed_images:
+                    sesh.execute(sa.update(models.TrapImage), changed_images)
 
             # Manually update aggregate & cached values after bulk update
             ms.update_aggregates(sesh)
@@ -184,17 +261,120 @@ def save_monitoring_session(db_path, base_directory, session):
         logger.debug("Done committing")
 
 
-def save_monitoring_sessions(db_path, base_directory, sessions):
+def find_monitoring_session(
+    session: orm.Session,
+    base_directory: Union[pathlib.Path, str],
+    timestamp: datetime.datetime,
+    maximum_gap_minutes: int = 6 * 60,
+) -> MonitoringSession:
+    """
+    Return the monitoring session an image taken at `timestamp` belongs to, the
+    same way `group_images_by_day` groups images. A new one is added if the image
+    is more than `maximum_gap_minutes` away from the images of every session.
+    """
+    gap = datetime.timedelta(minutes=maximum_gap_minutes)
+    ms = session.execute(
+        sa.select(MonitoringSession)
+        .where(
+            (MonitoringSession.base_directory == str(base_directory))
+            & (MonitoringSession.end_time > timestamp - gap)
+            & (MonitoringSession.start_time < timestamp + gap)
+        )
+        .order_by(MonitoringSession.end_time.desc())
+        .limit(1)
+    ).scalar()
+    if not ms:
+        ms_kwargs = {"base_directory": str(base_directory), "day": timestamp.date()}
+        ms = session.query(MonitoringSession).filter_by(**ms_kwargs).one_or_none()
+    if not ms:
+        ms = MonitoringSession(**ms_kwargs)
+        logger.debug(f"Adding new Monitoring Session to db: {ms}")
+        session.add(ms)
+        session.flush()
+    return ms
+
+
+@retry_if_locked
+def save_new_images(
+    db_path,
+    base_directory,
+    images: Sequence[dict[str, Any]],
+    queue: bool = False,
+) -> list[int]:
+    """
+    Add images found after their directory was scanned to their monitoring
+    sessions, e.g. while watching the directory. The images are in the format
+    of `find_images` and the ones that are already saved are skipped.
+
+    With `queue`, the new images are also added to the processing queue.
+    Returns the IDs of the new images.
+    """
+    image_ids = []
+    with get_session(db_path) as sesh:
+        for image in sorted(images, key=lambda image: image["timestamp"]):
+            path = str(pathlib.Path(image["path"]).relative_to(base_directory))
+            ms = find_monitoring_session(sesh, base_directory, image["timestamp"])
+            existing = sesh.execute(
+                sa.select(models.TrapImage.id).where(
+                    (models.TrapImage.monitoring_session_id == ms.id)
+                    & (models.TrapImage.path == path)
+                )
+            ).first()
+            if existing:
+                logger.debug(f"Image is already saved: {path}")
+                continue
+            db_img = models.TrapImage(
+                monitoring_session_id=ms.id,
+                base_path=ms.base_directory,
+                path=path,
+                timestamp=image["timestamp"],
+                filesize=image["filesize"],
+                width=image["shape"][0],
+                height=image["shape"][1],
+                in_queue=queue,
+            )
+            new_image = (models.TrapImage.monitoring_session_id == ms.id) & (
+                models.TrapImage.path == path
+            )
+            with track_stage_counters(sesh, {models.TrapImage: new_image}):
+                sesh.add(db_img)
+                sesh.flush()
+            # The times of the session decide where the next images go
+            update_all_aggregates(sesh, MonitoringSession.id == ms.id)
+            logger.info(f"Added image {path} to event {ms.day}")
+            image_ids.append(db_img.id)
+        sesh.commit()
+    return image_ids
+
+
+def save_monitoring_sessions(db_path, base_directory, sessions, check_filesize=False):
     for session in sessions:
-        save_monitoring_session(db_path, base_directory, session)
+        save_monitoring_session(
+            db_path, base_directory, session, check_filesize=check_filesize
+        )
 
     return get_monitoring_sessions_from_db(db_path, base_directory)
 
 
-def get_monitoring_sessions_from_filesystem(base_directory):
+def get_monitoring_sessions_from_filesystem(base_directory, db_path=None):
+    """
+    Find the images in a directory and group them into monitoring sessions.
+
+    With a `db_path`, the images are read from the manifest of the directory
+    in the database, after reading only the files that changed since the last scan.
+    """
     # @TODO can we use the sqlalchemy classes for sessions & images before
     # they are saved to the DB?
-    images = find_images(base_directory)
+    if db_path:
+        update_manifest(db_path, base_directory)
+        images = manifest_images(db_path, base_directory)
+    else:
+        # The images are sorted by their timestamps when they are grouped
+        images = find_images(base_directory, ordered=False)
+    return group_monitoring_sessions(base_directory, images)
+
+
+def group_monitoring_sessions(base_directory, images):
     sessions = []
     groups = group_images_by_day(images)
     for day, images in groups.items():
@@ -215,25 +395,25 @@ def get_monitoring_sessions_from_filesystem(base_directory):
 def get_monitoring_sessions_from_db(
     db_path: str,
     base_directory: Union[pathlib.Path, str, None] = None,
-    update_aggregates: bool = True,
+    update_aggregates: bool = False,
 ):
-    query_kwargs = {}
+    """
+    Return the monitoring sessions of a deployment (or all of them) with their
+    cached counts & times, which are kept up to date by the functions that save
+    images & detections. With `update_aggregates`, they are refreshed first.
+    """
+    where = sa.true()
 
     logger.info("Querying existing sessions in DB")
 
     if base_directory:
-        query_kwargs["base_directory"] = str(base_directory)
+        where = MonitoringSession.base_directory == str(base_directory)
 
     with get_session(db_path) as sesh:
-        items = (
-            sesh.query(MonitoringSession)
-            .filter_by(
-                **query_kwargs,
-            )
-            .all()
-        )
         if update_aggregates:
-            [item.update_aggregates(sesh) for item in items]
+            update_all_aggregates(sesh, where)
+            sesh.commit()
+        items = sesh.query(MonitoringSession).where(where).all()
         return items
 
 
@@ -241,22 +421,18 @@ def get_monitoring_session_by_date(
     db_path: str,
     event_dates: list[datetime.date],
     base_directory: Union[pathlib.Path, str, None] = None,
+    update_aggregates: bool = False,
 ):
-    query_kwargs = {}
+    where = MonitoringSession.day.in_(event_dates)
 
     if base_directory:
-        query_kwargs["base_directory"] = str(base_directory)
+        where = where & (MonitoringSession.base_directory == str(base_directory))
 
     with get_session(db_path) as sesh:
-        items = (
-            sesh.query(MonitoringSession)
-            .where(MonitoringSession.day.in_(event_dates))
-            .filter_by(
-                **query_kwargs,
-            )
-            .all()
-        )
-        [item.update_aggregates(sesh) for item in items]
+        if update_aggregates:
+            update_all_aggregates(sesh, where)
+            sesh.commit()
+        items = sesh.query(MonitoringSession).where(where).all()
         return items
 
 
@@ -269,11 +445,34 @@ def monitoring_sessions_exist(db_path, base_directory):
         )
 
 
-def get_or_create_monitoring_sessions(db_path, base_directory):
+def rescan_monitoring_sessions(db_path, base_directory) -> ManifestDelta:
+    """
+    Add the images that are new or modified since the last scan of a directory
+    to their monitoring sessions. Only those images are read.
+
+    Returns the images that were added, modified or removed. Removed images
+    are not deleted from their monitoring sessions.
+    """
+    delta = update_manifest(db_path, base_directory)
+    if delta.new or delta.modified:
+        sessions = group_monitoring_sessions(
+            base_directory, manifest_images(db_path, base_directory)
+        )
+        save_monitoring_sessions(
+            db_path, base_directory, sessions, check_filesize=bool(delta.modified)
+        )
+    return delta
+
+
+def get_or_create_monitoring_sessions(db_path, base_directory, rescan=False):
     # @TODO Check if there are unprocessed images in monitoring session?
     if not monitoring_sessions_exist(db_path, base_directory):
-        sessions = get_monitoring_sessions_from_filesystem(base_directory)
+        sessions = get_monitoring_sessions_from_filesystem(
+            base_directory, db_path=db_path
+        )
         save_monitoring_sessions(db_path, base_directory, sessions)
+    elif rescan:
+        rescan_monitoring_sessions(db_path, base_directory)
     return get_monitoring_sessions_from_db(db_path, base_directory)
 
 
@@ -1,6 +1,6 @@
 import pathlib
 import datetime
-from typing import Optional
+from typing import Optional, Sequence
 
 import sqlalchemy as sa
 from sqlalchemy import orm
@@ -35,6 +35,28 @@ class TrapImage(Base):
     # centroid
     # cnn features
 
+    __table_args__ = (
+        sa.Index(
+            "ix_images_monitoring_session_id_timestamp",
+            monitoring_session_id,
+            timestamp,
+        ),
+        sa.Index("ix_images_timestamp", timestamp),
+        # Partial indexes must use the exact expressions of the queue queries
+        sa.Index(
+            "ix_images_queued",
+            monitoring_session_id,
+            sqlite_where=in_queue.is_(True),
+            postgresql_where=in_queue.is_(True),
+        ),
+        sa.Index(
+            "ix_images_unprocessed",
+            monitoring_session_id,
+            sqlite_where=last_processed.is_(None),
+            postgresql_where=last_processed.is_(None),
+        ),
+    )
+
     @property
     def absolute_path(self, directory: Optional[str] = None) -> pathlib.Path:
         # @TODO this directory argument can be removed once the image has the base
@@ -103,6 +125,28 @@ class TrapImage(Base):
         )
 
 
+def previous_image_ids(
+    session: orm.Session, image_ids: Sequence[int]
+) -> dict[int, Optional[int]]:
+    """
+    Return the ID of the image captured before each of the images, in one query.
+    See `TrapImage.previous_image`.
+    """
+    previous = orm.aliased(TrapImage)
+    previous_id = (
+        sa.select(previous.id)
+        .where(previous.timestamp < TrapImage.timestamp)
+        .order_by(previous.timestamp.desc())
+        .limit(1)
+        .correlate(TrapImage)
+        .scalar_subquery()
+    )
+    rows = session.execute(
+        sa.select(TrapImage.id, previous_id).where(TrapImage.id.in_(image_ids))
+    ).all()
+    return {image_id: previous_image_id for image_id, previous_image_id in rows}
+
+
 def get_image_with_objects(db_path, image_id):
     with get_session(db_path) as sesh:
         image_kwargs = {
@@ -0,0 +1,247 @@
+import os
+import enum
+import socket
+import datetime
+from typing import Iterable, Sequence, Optional, Union
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+from sqlalchemy.dialects import sqlite, postgresql
+
+from trapdata.db import Base
+from trapdata.common.logs import logger
+
+
+class JobStatus(str, enum.Enum):
+    claimed = "claimed"  # A worker is processing the item until its lease expires
+    released = "released"  # The lease expired before the item was completed
+    failed = "failed"  # The item was claimed too many times without being completed
+
+
+class Job(Base):
+    """
+    A claim on one item of a processing stage.
+
+    Items are only waiting in a queue while they have no claimed or failed job.
+    The job is deleted once the result of the stage has been saved. If a worker
+    crashes its claims expire and are released to the next worker.
+    """
+
+    __tablename__ = "jobs"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    stage = sa.Column(sa.String(255), nullable=False)
+    item_id = sa.Column(sa.Integer, nullable=False)
+    status = sa.Column(sa.String(255), nullable=False, default=JobStatus.claimed.value)
+    worker_id = sa.Column(sa.String(255))
+    claimed_at = sa.Column(sa.DateTime)
+    lease_expires_at = sa.Column(sa.DateTime)
+    attempts = sa.Column(sa.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        sa.UniqueConstraint(stage, item_id, name="uq_jobs_stage_item_id"),
+        sa.Index(
+            "ix_jobs_stage_status_lease_expires_at", stage, status, lease_expires_at
+        ),
+    )
+
+    def __repr__(self):
+        return (
+            f"Job(stage={self.stage!r}, item_id={self.item_id!r}, "
+            f"status={self.status!r}, worker_id={self.worker_id!r}, "
+            f"lease_expires_at={self.lease_expires_at!r}, attempts={self.attempts!r})"
+        )
+
+
+def get_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def active_job_exists(stage: str, item_id: sa.ColumnElement) -> sa.Exists:
+    """
+    Filter for items of a stage that are claimed by a worker or have failed.
+    """
+    return sa.exists().where(
+        (Job.stage == stage)
+        & (Job.item_id == item_id)
+        & Job.status.in_([JobStatus.claimed.value, JobStatus.failed.value])
+    )
+
+
+def reap_jobs(session: orm.Session, stage: str, max_attempts: int) -> int:
+    """
+    Release the expired claims of a stage so their items can be claimed again,
+    or mark them as failed if they have been attempted too many times.
+    """
+    now = datetime.datetime.now()
+    expired = (
+        (Job.stage == stage)
+        & (Job.status == JobStatus.claimed.value)
+        & (Job.lease_expires_at < now)
+    )
+    failed = session.execute(
+        sa.update(Job)
+        .where(expired & (Job.attempts >= max_attempts))
+        .values({"status": JobStatus.failed.value, "worker_id": None})
+    ).rowcount
+    released = session.execute(
+        sa.update(Job)
+        .where(expired)
+        .values({"status": JobStatus.released.value, "worker_id": None})
+    ).rowcount
+    if failed or released:
+        logger.warn(
+            f"Found {failed + released} expired claims in stage '{stage}', "
+            f"{released} released and {failed} failed after {max_attempts} attempts"
+        )
+    return failed + released
+
+
+def claim_jobs(
+    session: orm.Session,
+    stage: str,
+    candidates: sa.Select,
+    lease_duration: datetime.timedelta,
+    max_attempts: int,
+    worker_id: Optional[str] = None,
+) -> list[int]:
+    """
+    Claim the items returned by the `candidates` query for the current worker.
+
+    The query must select item IDs, excluding items with an active job
+    (see `active_job_exists`) and limited to the size of the batch.
+    Returns the IDs of the items that were claimed, the caller commits.
+
+    Expired claims are reaped first. In SQLite that first write also takes the
+    database write lock for the rest of the transaction, so concurrent workers
+    never read the same candidates. In PostgreSQL the candidate rows are locked
+    with FOR UPDATE SKIP LOCKED, so concurrent workers claim different items
+    without waiting for each other. In other databases a candidate claimed by
+    another worker in the meantime is skipped by the unique constraint.
+    """
+    worker_id = worker_id or get_worker_id()
+    dialect = session.get_bind().dialect.name
+    now = datetime.datetime.now()
+    claim = {
+        "status": JobStatus.claimed.value,
+        "worker_id": worker_id,
+        "claimed_at": now,
+        "lease_expires_at": now + lease_duration,
+    }
+
+    reap_jobs(session, stage, max_attempts)
+
+    if dialect == "postgresql":
+        candidates = candidates.with_for_update(skip_locked=True)
+    item_ids = session.execute(candidates).scalars().all()
+    if not item_ids:
+        return []
+
+    reclaimed = (
+        session.execute(
+            sa.update(Job)
+            .where(
+                (Job.stage == stage)
+                & Job.item_id.in_(item_ids)
+                & (Job.status == JobStatus.released.value)
+            )
+            .values({**claim, "attempts": Job.attempts + 1})
+            .returning(Job.item_id)
+        )
+        .scalars()
+        .all()
+    )
+    existing = session.execute(
+        sa.select(Job.item_id).where((Job.stage == stage) & Job.item_id.in_(item_ids))
+    ).scalars()
+    new_ids = set(item_ids) - set(existing)
+
+    inserted = []
+    if new_ids:
+        if dialect == "sqlite":
+            insert_stmt = sqlite.insert(Job).on_conflict_do_nothing()
+        elif dialect == "postgresql":
+            insert_stmt = postgresql.insert(Job).on_conflict_do_nothing()
+        else:
+            insert_stmt = sa.insert(Job)
+        inserted = (
+            session.execute(
+                insert_stmt.returning(Job.item_id),
+                [
+                    {"stage": stage, "item_id": item_id, "attempts": 1, **claim}
+                    for item_id in sorted(new_ids)
+                ],
+            )
+            .scalars()
+            .all()
+        )
+
+    return sorted([*reclaimed, *inserted])
+
+
+def renew_jobs(
+    session: orm.Session,
+    stage: str,
+    item_ids: Iterable[int],
+    lease_duration: datetime.timedelta,
+) -> int:
+    """
+    Extend the lease of claimed items that are still being processed.
+    """
+    return session.execute(
+        sa.update(Job)
+        .where(
+            (Job.stage == stage)
+            & Job.item_id.in_(list(item_ids))
+            & (Job.status == JobStatus.claimed.value)
+        )
+        .values({"lease_expires_at": datetime.datetime.now() + lease_duration})
+    ).rowcount
+
+
+def release_jobs(
+    session: orm.Session,
+    stage: str,
+    item_ids: Iterable[int],
+    max_attempts: int,
+) -> int:
+    """
+    Release the claims on items that could not be processed, so they can be
+    claimed again without waiting for their lease to expire. Items that have been
+    attempted too many times are marked as failed instead, like in `reap_jobs`.
+    """
+    claimed = (
+        (Job.stage == stage)
+        & Job.item_id.in_(list(item_ids))
+        & (Job.status == JobStatus.claimed.value)
+    )
+    failed = session.execute(
+        sa.update(Job)
+        .where(claimed & (Job.attempts >= max_attempts))
+        .values({"status": JobStatus.failed.value, "worker_id": None})
+    ).rowcount
+    released = session.execute(
+        sa.update(Job)
+        .where(claimed)
+        .values({"status": JobStatus.released.value, "worker_id": None})
+    ).rowcount
+    return failed + released
+
+
+def delete_jobs(
+    session: orm.Session,
+    stage: str,
+    item_ids: Union[Iterable[int], sa.Select],
+    statuses: Optional[Sequence[JobStatus]] = None,
+) -> int:
+    """
+    Remove the jobs of completed or cleared items.
+    """
+    if not isinstance(item_ids, sa.Select):
+        item_ids = list(item_ids)
+    stmt = sa.delete(Job).where((Job.stage == stage) & Job.item_id.in_(item_ids))
+    if statuses:
+        stmt = stmt.where(Job.status.in_([status.value for status in statuses]))
+    return session.execute(
+        stmt, execution_options={"synchronize_session": False}
+    ).rowcount
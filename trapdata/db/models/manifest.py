@@ -0,0 +1,235 @@
+import os
+import pathlib
+import datetime
+import collections
+from dataclasses import dataclass, field
+from typing import Any, Iterator, Optional, Union
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from trapdata.db import Base, get_session
+from trapdata.common.logs import logger
+from trapdata.common.utils import threaded_imap
+from trapdata.common.filemanagement import walk_images, read_image_metadata
+
+
+class ManifestFile(Base):
+    """
+    The metadata of each image file found in a deployment, as of the last scan.
+
+    Rescans only read the images that are new or have a different size or
+    modification time than in the manifest.
+    """
+
+    __tablename__ = "manifest_files"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    base_directory = sa.Column(sa.String(255), nullable=False)
+    # Relative to the base directory
+    path = sa.Column(sa.String(255), nullable=False)
+    filesize = sa.Column(sa.Integer)
+    mtime_ns = sa.Column(sa.BigInteger)
+    # In ISO format with the timezone offset from the EXIF data, which the DateTime
+    # columns drop in SQLite. Empty if the image has no EXIF date.
+    timestamp = sa.Column(sa.String(32))
+    width = sa.Column(sa.Integer)
+    height = sa.Column(sa.Integer)
+
+    __table_args__ = (
+        sa.Index(
+            "ix_manifest_files_base_directory_path",
+            base_directory,
+            path,
+            unique=True,
+        ),
+    )
+
+    def __repr__(self):
+        return (
+            f"ManifestFile(base_directory={self.base_directory!r}, "
+            f"path={self.path!r}, timestamp={self.timestamp!r})"
+        )
+
+
+@dataclass
+class ManifestDelta:
+    """
+    The image files that changed since the previous scan of a deployment,
+    with their paths relative to the base directory.
+    """
+
+    new: list[str] = field(default_factory=list)
+    modified: list[str] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+    num_unchanged: int = 0
+
+    def __bool__(self):
+        return bool(self.new or self.modified or self.removed)
+
+
+def stat_file(filepath: pathlib.Path) -> tuple[pathlib.Path, os.stat_result]:
+    return filepath, filepath.stat()
+
+
+def manifest_values(
+    base_directory: pathlib.Path,
+    filepath: pathlib.Path,
+    stat: os.stat_result,
+    image: dict[str, Any],
+) -> dict[str, Any]:
+    """
+    The row of the manifest for an image read by `read_image_metadata`.
+    """
+    return {
+        "base_directory": str(base_directory),
+        "path": str(filepath.relative_to(base_directory)),
+        "filesize": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "timestamp": image["timestamp"].isoformat() if image["timestamp"] else None,
+        "width": image["shape"][0],
+        "height": image["shape"][1],
+    }
+
+
+def save_manifest_files(session: orm.Session, files: list[dict[str, Any]]):
+    """
+    Add the files to the manifest, or replace them if they are already in it.
+    The caller commits the changes.
+    """
+    paths = collections.defaultdict(list)
+    for values in files:
+        paths[values["base_directory"]].append(values["path"])
+    for base_directory, base_paths in paths.items():
+        session.execute(
+            sa.delete(ManifestFile).where(
+                (ManifestFile.base_directory == base_directory)
+                & ManifestFile.path.in_(base_paths)
+            )
+        )
+    if files:
+        session.execute(sa.insert(ManifestFile), files)
+
+
+def update_manifest(
+    db_path: str,
+    base_directory: Union[pathlib.Path, str],
+    num_workers: int = 8,
+    batch_size: int = 1000,
+) -> ManifestDelta:
+    """
+    Update the manifest of a deployment with the image files currently in its
+    directory and return what changed.
+
+    Every file is checked with `stat`, but only the new & modified images are
+    read. Both are done by a pool of `num_workers` threads.
+    """
+    base_directory = pathlib.Path(base_directory)
+    logger.info(f"Updating the manifest of the images in '{base_directory}'")
+    with get_session(db_path) as sesh:
+        existing = {
+            path: (file_id, filesize, mtime_ns)
+            for file_id, path, filesize, mtime_ns in sesh.execute(
+                sa.select(
+                    ManifestFile.id,
+                    ManifestFile.path,
+                    ManifestFile.filesize,
+                    ManifestFile.mtime_ns,
+                ).where(ManifestFile.base_directory == str(base_directory))
+            )
+        }
+
+    delta = ManifestDelta()
+    changed = []
+    seen = set()
+    for filepath, stat in threaded_imap(
+        stat_file, walk_images(base_directory), num_workers, ordered=False
+    ):
+        path = str(filepath.relative_to(base_directory))
+        seen.add(path)
+        previous = existing.get(path)
+        if not previous:
+            delta.new.append(path)
+        elif previous[1:] != (stat.st_size, stat.st_mtime_ns):
+            delta.modified.append(path)
+        else:
+            delta.num_unchanged += 1
+            continue
+        changed.append((filepath, stat))
+    delta.removed = [path for path in existing if path not in seen]
+
+    def read_file(file: tuple[pathlib.Path, os.stat_result]) -> Optional[dict]:
+        filepath, stat = file
+        # Images without an EXIF date are kept in the manifest so they are not
+        # read again, but left out of `manifest_images`
+        try:
+            image = read_image_metadata(filepath, filepath, skip_bad_exif=False)
+        except OSError as e:
+            # e.g. removed since it was found, it is checked again in the next scan
+            logger.warning(f"Could not read image {filepath}: {e}")
+            return None
+        values = manifest_values(base_directory, filepath, stat, image)
+        path = values["path"]
+        if path in existing:
+            values["id"] = existing[path][0]
+        return values
+
+    files = [
+        values
+        for values in threaded_imap(read_file, changed, num_workers, ordered=False)
+        if values
+    ]
+    new_files = [values for values in files if "id" not in values]
+    modified_files = [values for values in files if "id" in values]
+    removed_ids = [existing[path][0] for path in delta.removed]
+
+    with get_session(db_path) as sesh:
+        if new_files:
+            sesh.execute(sa.insert(ManifestFile), new_files)
+        if modified_files:
+            sesh.execute(sa.update(ManifestFile), modified_files)
+        for i in range(0, len(removed_ids), batch_size):
+            sesh.execute(
+                sa.delete(ManifestFile).where(
+                    ManifestFile.id.in_(removed_ids[i : i + batch_size])
+                )
+            )
+        sesh.commit()
+
+    logger.info(
+        f"Found {len(delta.new)} new, {len(delta.modified)} modified and "
+        f"{len(delta.removed)} removed images, {delta.num_unchanged} unchanged"
+    )
+    return delta
+
+
+def manifest_images(
+    db_path: str, base_directory: Union[pathlib.Path, str]
+) -> Iterator[dict[str, Any]]:
+    """
+    The images in the manifest of a deployment, in the format of `find_images`.
+    Images without an EXIF date are skipped.
+    """
+    base_directory = pathlib.Path(base_directory)
+    with get_session(db_path) as sesh:
+        rows = sesh.execute(
+            sa.select(
+                ManifestFile.path,
+                ManifestFile.filesize,
+                ManifestFile.timestamp,
+                ManifestFile.width,
+                ManifestFile.height,
+            )
+            .where(
+                (ManifestFile.base_directory == str(base_directory))
+                & ManifestFile.timestamp.is_not(None)
+            )
+            .order_by(ManifestFile.path)
+        ).all()
+    for path, filesize, timestamp, width, height in rows:
+        yield {
+            "path": base_directory / path,
+            "timestamp": datetime.datetime.fromisoformat(timestamp),
+            "shape": (width, height),
+            "filesize": filesize,
+        }
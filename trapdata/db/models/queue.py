@@ -1,29 +1,110 @@
+import datetime
 from typing import Sequence, Union, Optional
 
 import sqlalchemy as sa
 
 from trapdata.db import get_session
+from trapdata.db.base import retry_if_locked
 from trapdata import logger
 from trapdata import constants
 from trapdata.common.types import FilePath
 from trapdata.db.models.images import TrapImage
 from trapdata.db.models.detections import DetectedObject
 from trapdata.db.models.events import MonitoringSession
+from trapdata.db.models.counters import COUNTER_KEYS, track_stage_counters
+from trapdata.db.models.jobs import (
+    JobStatus,
+    active_job_exists,
+    claim_jobs,
+    renew_jobs,
+    release_jobs,
+    delete_jobs,
+)
 
 
 class QueueManager:
+    """
+    Items are added to a queue by setting their `in_queue` flag. Workers claim
+    a batch of items with `pull_n_from_queue`, which records a job with a
+    lease for each item, and call `complete` once the results are saved.
+    Items claimed by a worker that crashed are released when the lease expires.
+    """
+
     name = "Unnamed Queue"
+    stage = "unknown"
+    model: Union[type[TrapImage], type[DetectedObject]]
     base_directory: FilePath
+    lease_duration = datetime.timedelta(minutes=10)
+    max_attempts = 3
 
     def __init__(self, db_path: str, base_directory: FilePath):
         self.db_path = db_path
         self.base_directory = base_directory
 
-    def ids(self) -> sa.ScalarSelect:
+    def monitoring_session_ids(self) -> sa.ScalarSelect:
+        """
+        Return subquery of the IDs of all Monitoring Sessions in this deployment.
+        """
+        return (
+            sa.select(MonitoringSession.id)
+            .where(MonitoringSession.base_directory == str(self.base_directory))
+            .scalar_subquery()
+        )
+
+    def deployment(self) -> sa.ColumnElement:
+        """
+        Return filter for all records in the Monitoring Sessions of this deployment.
+        """
+        return self.model.monitoring_session_id.in_(self.monitoring_session_ids())
+
+    def subset(self) -> sa.ColumnElement:
+        """
+        Return filter for the records of a deployment that this queue manages.
+        """
+        return sa.true()
+
+    def scope(self) -> sa.ColumnElement:
+        """
+        Return filter for all records managed by the scope of this queue.
+        """
+        return self.deployment() & self.subset()
+
+    def pending(self) -> sa.ColumnElement:
+        """
+        Return filter for the records that have not been processed by this stage yet.
+        """
+        return sa.false()
+
+    def waiting(self) -> sa.ColumnElement:
+        """
+        Return filter for the records that were added to the queue and still
+        need to be processed.
+        """
+        return self.model.in_queue.is_(True) & self.pending()
+
+    def queued(self) -> sa.ColumnElement:
+        """
+        Return filter for the records in the scope that are waiting to be processed.
+        """
+        return self.scope() & self.waiting()
+
+    def status_columns(self) -> list[sa.Label]:
         """
-        Return subquery of all IDs managed by the scope of this queue.
+        Return the counts of `queue_status` for this queue as conditional sums,
+        to be selected from the records of the deployment.
         """
-        return sa.select().scalar_subquery()
+        # Keys match `COUNTER_KEYS`
+        columns = {
+            "unprocessed": self.subset() & self.pending(),
+            "queued": self.subset() & self.waiting(),
+            "done": self.subset() & sa.not_(self.pending()),
+        }
+        return [
+            sa.func.coalesce(sa.func.sum(sa.case((condition, 1), else_=0)), 0).label(
+                f"{self.stage}_{key}"
+            )
+            for key, condition in columns.items()
+        ]
 
     def queue_count(self) -> int:
         return 0
@@ -43,9 +124,93 @@ class QueueManager:
     def status(self):
         return NotImplementedError
 
-    def pull_n_from_queue(self, n: int):
+    def pull_n_from_queue(self, n: int, where: Optional[sa.ColumnElement] = None):
         return NotImplementedError
 
+    def of_images(self, image_ids: Sequence[int]) -> sa.ColumnElement:
+        """
+        Return filter for the records of the given images.
+        """
+        return self.model.image_id.in_(image_ids)
+
+    def queued_image_ids(self) -> sa.Select:
+        """
+        Return query of the IDs of the images that have items in this queue.
+        """
+        return sa.select(self.model.image_id).where(self.queued())
+
+    def item_order(self) -> list[sa.ColumnElement]:
+        """
+        Return the order the items are pulled from the queue in. The items of the
+        same image are kept together, so a batch shares the decoded source images.
+        """
+        return [self.model.image_id, self.model.id]
+
+    @retry_if_locked
+    def claim(self, n: int, where: Optional[sa.ColumnElement] = None) -> list[int]:
+        """
+        Claim up to `n` queued items for the current worker and return their IDs.
+        Only the items that match `where` are claimed, if it is given.
+        """
+        candidates = (
+            sa.select(self.model.id)
+            .where(self.queued() & ~active_job_exists(self.stage, self.model.id))
+            .order_by(*self.item_order())
+            .limit(n)
+        )
+        if where is not None:
+            candidates = candidates.where(where)
+        with get_session(self.db_path) as sesh:
+            item_ids = claim_jobs(
+                sesh,
+                stage=self.stage,
+                candidates=candidates,
+                lease_duration=self.lease_duration,
+                max_attempts=self.max_attempts,
+            )
+            sesh.commit()
+        return item_ids
+
+    @retry_if_locked
+    def renew(self, item_ids: Sequence[int]) -> None:
+        """
+        Extend the lease on claimed items that are still being processed.
+        """
+        with get_session(self.db_path) as sesh:
+            renew_jobs(sesh, self.stage, item_ids, self.lease_duration)
+            sesh.commit()
+
+    @retry_if_locked
+    def complete(self, item_ids: Sequence[int]) -> None:
+        """
+        Remove the claims on items after their results have been saved.
+        """
+        with get_session(self.db_path) as sesh:
+            delete_jobs(sesh, self.stage, item_ids)
+            sesh.commit()
+
+    @retry_if_locked
+    def release(self, item_ids: Sequence[int]) -> None:
+        """
+        Release the claims on items that could not be processed.
+        """
+        with get_session(self.db_path) as sesh:
+            release_jobs(sesh, self.stage, item_ids, self.max_attempts)
+            sesh.commit()
+
+    def track_counters(self, sesh):
+        """
+        Update the stage counters with the changes made to the records in the scope.
+        """
+        return track_stage_counters(sesh, {self.model: self.scope()})
+
+    def clear_jobs(self, sesh, statuses: Optional[Sequence[JobStatus]] = None):
+        """
+        Remove the jobs of all items in the scope of this queue, the caller commits.
+        """
+        in_scope = sa.select(self.model.id).where(self.scope())
+        delete_jobs(sesh, self.stage, in_scope, statuses=statuses)
+
     def process_queue(self, model):
         logger.info(f"Processing {self.name} queue")
         model.run()
@@ -55,33 +220,35 @@ class QueueManager:
 class ImageQueue(QueueManager):
     name = "Unprocessed images"
     description = "Raw images from camera needing object detection"
+    stage = "localization"
+    model = TrapImage
 
-    def ids(self) -> sa.ScalarSelect:
-        """
-        Return subquery of all IDs managed by the scope of this queue.
-        """
-        return (
-            sa.select(TrapImage.id)
-            .where(MonitoringSession.base_directory == str(self.base_directory))
-            .join(
-                MonitoringSession,
-                TrapImage.monitoring_session_id == MonitoringSession.id,
-            )
-            .scalar_subquery()
-        )
+    def pending(self) -> sa.ColumnElement:
+        return TrapImage.last_processed.is_(None)
+
+    def waiting(self) -> sa.ColumnElement:
+        # Images that were already processed can be added to the queue again
+        return TrapImage.in_queue.is_(True)
+
+    def item_order(self) -> list[sa.ColumnElement]:
+        return [TrapImage.id]
+
+    def of_images(self, image_ids: Sequence[int]) -> sa.ColumnElement:
+        return TrapImage.id.in_(image_ids)
+
+    def queued_image_ids(self) -> sa.Select:
+        return sa.select(TrapImage.id).where(self.queued())
 
     def queue_count(self) -> int:
         with get_session(self.db_path) as sesh:
-            stmt = sa.select(sa.func.count(TrapImage.id)).where(
-                (TrapImage.id.in_(self.ids()) & (TrapImage.in_queue.is_(True)))
-            )
+            stmt = sa.select(sa.func.count(TrapImage.id)).where(self.queued())
             count = sesh.execute(stmt).scalar()
             return count or 0
 
     def unprocessed_count(self) -> int:
         with get_session(self.db_path) as sesh:
             stmt = sa.select(sa.func.count(TrapImage.id)).where(
-                (TrapImage.id.in_(self.ids()) & (TrapImage.last_processed.is_(None)))
+                (self.scope() & (TrapImage.last_processed.is_(None)))
             )
             count = sesh.execute(stmt).scalar()
             return count or 0
@@ -89,53 +256,61 @@ class ImageQueue(QueueManager):
     def done_count(self) -> int:
         with get_session(self.db_path) as sesh:
             stmt = sa.select(sa.func.count(TrapImage.id)).where(
-                (TrapImage.id.in_(self.ids()) & (TrapImage.last_processed.is_not(None)))
+                (self.scope() & (TrapImage.last_processed.is_not(None)))
             )
             count = sesh.execute(stmt).scalar()
             return count or 0
 
-    def add_unprocessed(self, *_) -> None:
+    @retry_if_locked
+    def add_unprocessed(self, *_, where: Optional[sa.ColumnElement] = None) -> None:
+        """
+        Add the unprocessed images of the deployment to the queue, only the ones
+        that match `where` if it is given.
+        """
         logger.info("Adding all unprocessed deployment images to queue")
         with get_session(self.db_path) as sesh:
             stmt = (
                 sa.update(TrapImage)
-                .where(
-                    TrapImage.id.in_(self.ids()) & TrapImage.last_processed.is_(None)
-                )
+                .where(self.scope() & TrapImage.last_processed.is_(None))
                 .values({"in_queue": True})
             )
-            sesh.execute(stmt)
+            if where is not None:
+                stmt = stmt.where(where)
+            with self.track_counters(sesh):
+                sesh.execute(stmt)
+            self.clear_jobs(sesh, statuses=[JobStatus.failed])
             sesh.commit()
 
+    @retry_if_locked
     def clear_queue(self, *_) -> None:
         logger.info("Clearing all deployment images in queue")
         with get_session(self.db_path) as sesh:
             stmt = (
                 sa.update(TrapImage)
-                .where(TrapImage.id.in_(self.ids()) & TrapImage.in_queue.is_(True))
+                .where(self.scope() & TrapImage.in_queue.is_(True))
                 .values({"in_queue": False})
             )
-            sesh.execute(stmt)
+            with self.track_counters(sesh):
+                sesh.execute(stmt)
+            self.clear_jobs(sesh)
             sesh.commit()
 
-    def pull_n_from_queue(self, n: int) -> Sequence[TrapImage]:
+    def pull_n_from_queue(
+        self, n: int, where: Optional[sa.ColumnElement] = None
+    ) -> Sequence[TrapImage]:
         logger.debug(f"Attempting to pull {n} images from queue")
-        select_stmt = (
-            sa.select(TrapImage.id)
-            .where(TrapImage.id.in_(self.ids()) & (TrapImage.in_queue.is_(True)))
-            .limit(n)
-            .with_for_update()
-        )
-        update_stmt = (
-            sa.update(TrapImage)
-            .where(TrapImage.id.in_(select_stmt.scalar_subquery()))
-            # .where(TrapImage.status == Status.waiting)
-            .values({"in_queue": False})
-            .returning(TrapImage)
-        )
+        image_ids = self.claim(n, where)
         with get_session(self.db_path) as sesh:
-            images = sesh.execute(update_stmt).unique().scalars().all()
-            sesh.commit()
+            images = (
+                sesh.execute(
+                    sa.select(TrapImage)
+                    .where(TrapImage.id.in_(image_ids))
+                    .order_by(TrapImage.id)
+                )
+                .unique()
+                .scalars()
+                .all()
+            )
             logger.info(f"Pulled {len(images)} images from queue")
             return images
 
@@ -143,44 +318,28 @@ class ImageQueue(QueueManager):
 class DetectedObjectQueue(QueueManager):
     name = "Detected objects"
     description = "Objects that were detected in an image but have not been classified"
+    stage = "binary_classification"
+    model = DetectedObject
 
-    def ids(self) -> sa.ScalarSelect:
+    def subset(self) -> sa.ColumnElement:
         """
-        Return subquery of all IDs managed by the scope of this queue.
+        Only the latest detection of each bounding box is processed.
         """
-        return (
-            sa.select(sa.func.max(DetectedObject.id))
-            .where(
-                (MonitoringSession.base_directory == str(self.base_directory))
-                & DetectedObject.bbox.is_not(None)
-            )
-            .join(
-                MonitoringSession,
-                DetectedObject.monitoring_session_id == MonitoringSession.id,
-            )
-            .group_by(DetectedObject.bbox)
-            .scalar_subquery()
-        )
+        return DetectedObject.canonical.is_(True)
+
+    def pending(self) -> sa.ColumnElement:
+        return DetectedObject.binary_label.is_(None)
 
     def queue_count(self):
         with get_session(self.db_path) as sesh:
-            stmt = sa.select(sa.func.count(DetectedObject.id)).where(
-                (
-                    (DetectedObject.id.in_(self.ids()))
-                    & DetectedObject.in_queue.is_(True)
-                    & (DetectedObject.binary_label.is_(None))
-                )
-            )
+            stmt = sa.select(sa.func.count(DetectedObject.id)).where(self.queued())
             count = sesh.execute(stmt).scalar()
             return count
 
     def unprocessed_count(self):
         with get_session(self.db_path) as sesh:
             stmt = sa.select(sa.func.count(DetectedObject.id)).where(
-                (
-                    (DetectedObject.id.in_(self.ids()))
-                    & (DetectedObject.binary_label.is_(None))
-                )
+                (self.scope() & (DetectedObject.binary_label.is_(None)))
             )
             count = sesh.execute(stmt).scalar()
             return count
@@ -188,68 +347,54 @@ class DetectedObjectQueue(QueueManager):
     def done_count(self):
         with get_session(self.db_path) as sesh:
             stmt = sa.select(sa.func.count(DetectedObject.id)).where(
-                (
-                    (DetectedObject.id.in_(self.ids()))
-                    & (DetectedObject.binary_label.is_not(None))
-                )
+                (self.scope() & (DetectedObject.binary_label.is_not(None)))
             )
             count = sesh.execute(stmt).scalar()
             return count
 
+    @retry_if_locked
     def add_unprocessed(self, *_) -> None:
         logger.info(f"Adding detected objects in deployment to queue")
         with get_session(self.db_path) as sesh:
             stmt = (
                 sa.update(DetectedObject)
                 .where(
-                    (DetectedObject.id.in_(self.ids()))
+                    self.scope()
                     & (DetectedObject.in_queue.is_(False))
                     & (DetectedObject.binary_label.is_(None))
                 )
                 .values({"in_queue": True})
             )
-            sesh.execute(stmt)
+            with self.track_counters(sesh):
+                sesh.execute(stmt)
+            self.clear_jobs(sesh, statuses=[JobStatus.failed])
             sesh.commit()
 
+    @retry_if_locked
     def clear_queue(self, *_) -> None:
         logger.info("Removing detected objects in deployment from queue")
         with get_session(self.db_path) as sesh:
             stmt = (
                 sa.update(DetectedObject)
-                .where(
-                    (DetectedObject.id.in_(self.ids()))
-                    & (DetectedObject.in_queue.is_(True))
-                    & (DetectedObject.binary_label.is_(None))
-                )
+                .where(self.queued())
                 .values({"in_queue": False})
             )
-            sesh.execute(stmt)
+            with self.track_counters(sesh):
+                sesh.execute(stmt)
+            self.clear_jobs(sesh)
             sesh.commit()
 
-    def pull_n_from_queue(self, n: int) -> Sequence[DetectedObject]:
+    def pull_n_from_queue(
+        self, n: int, where: Optional[sa.ColumnElement] = None
+    ) -> Sequence[DetectedObject]:
         logger.debug(f"Attempting to pull {n} detected objects from queue")
-        select_stmt = (
-            sa.select(DetectedObject.id)
-            .where(
-                (DetectedObject.id.in_(self.ids()))
-                & (DetectedObject.in_queue.is_(True))
-                & (DetectedObject.binary_label.is_(None))
-            )
-            .limit(n)
-            .with_for_update()
-        )
-        update_stmt = (
-            sa.update(DetectedObject)
-            .where(DetectedObject.id.in_(select_stmt.scalar_subquery()))
-            .values({"in_queue": False})
-            .returning(DetectedObject.id)
-        )
+        record_ids = self.claim(n, where)
         with get_session(self.db_path) as sesh:
-            record_ids = sesh.execute(update_stmt).unique().scalars().all()
-            sesh.commit()
             objs = (
                 sesh.execute(
-                    sa.select(DetectedObject).where(DetectedObject.id.in_(record_ids))
+                    sa.select(DetectedObject)
+                    .where(DetectedObject.id.in_(record_ids))
+                    .order_by(*self.item_order())
                 )
                 .unique()
                 .scalars()
@@ -265,44 +410,30 @@ class UnclassifiedObjectQueue(QueueManager):
     Objects that have been identified as something of interest (e.g. a moth)
     but have not yet been classified to the species level.
     """
+    stage = "species_classification"
+    model = DetectedObject
 
-    def ids(self) -> sa.ScalarSelect:
+    def subset(self) -> sa.ColumnElement:
         """
-        Return subquery of all IDs managed by the scope of this queue.
+        Only the latest detection of each bounding box is processed.
         """
-        return (
-            sa.select(sa.func.max(DetectedObject.id))
-            .where(
-                (MonitoringSession.base_directory == str(self.base_directory))
-                & (DetectedObject.binary_label == constants.POSITIVE_BINARY_LABEL)
-            )
-            .join(
-                MonitoringSession,
-                DetectedObject.monitoring_session_id == MonitoringSession.id,
-            )
-            .group_by(DetectedObject.bbox)
-            .scalar_subquery()
+        return DetectedObject.canonical.is_(True) & (
+            DetectedObject.binary_label == constants.POSITIVE_BINARY_LABEL
         )
 
+    def pending(self) -> sa.ColumnElement:
+        return DetectedObject.specific_label.is_(None)
+
     def queue_count(self) -> Union[int, None]:
         with get_session(self.db_path) as sesh:
-            stmt = sa.select(sa.func.count(DetectedObject.id)).where(
-                (
-                    (DetectedObject.id.in_(self.ids()))
-                    & DetectedObject.in_queue.is_(True)
-                    & DetectedObject.specific_label.is_(None)
-                )
-            )
+            stmt = sa.select(sa.func.count(DetectedObject.id)).where(self.queued())
             count = sesh.execute(stmt).scalar()
             return count
 
     def unprocessed_count(self) -> Union[int, None]:
         with get_session(self.db_path) as sesh:
             stmt = sa.select(sa.func.count(DetectedObject.id)).where(
-                (
-                    (DetectedObject.id.in_(self.ids()))
-                    & DetectedObject.specific_label.is_(None)
-                )
+                (self.scope() & DetectedObject.specific_label.is_(None))
             )
             count = sesh.execute(stmt).scalar()
             return count
@@ -310,69 +441,54 @@ class UnclassifiedObjectQueue(QueueManager):
     def done_count(self) -> Union[int, None]:
         with get_session(self.db_path) as sesh:
             stmt = sa.select(sa.func.count(DetectedObject.id)).where(
-                (
-                    (DetectedObject.id.in_(self.ids()))
-                    & DetectedObject.specific_label.is_not(None)
-                )
+                (self.scope() & DetectedObject.specific_label.is_not(None))
             )
             count = sesh.execute(stmt).scalar()
             return count
 
+    @retry_if_locked
     def add_unprocessed(self, *_) -> None:
         logger.info("Adding unclassified objects in deployment to queue")
         with get_session(self.db_path) as sesh:
             stmt = (
                 sa.update(DetectedObject)
                 .where(
-                    (DetectedObject.id.in_(self.ids()))
+                    self.scope()
                     & (DetectedObject.in_queue.is_(False))
                     & (DetectedObject.specific_label.is_(None))
                 )
                 .values({"in_queue": True})
             )
-            sesh.execute(stmt)
+            with self.track_counters(sesh):
+                sesh.execute(stmt)
+            self.clear_jobs(sesh, statuses=[JobStatus.failed])
             sesh.commit()
 
+    @retry_if_locked
     def clear_queue(self, *_) -> None:
         logger.info("Removing unclassified objects in deployment from queue")
         with get_session(self.db_path) as sesh:
             stmt = (
                 sa.update(DetectedObject)
-                .where(
-                    (DetectedObject.id.in_(self.ids()))
-                    & (DetectedObject.in_queue.is_(True))
-                    & (DetectedObject.specific_label.is_(None))
-                )
+                .where(self.queued())
                 .values({"in_queue": False})
             )
-            sesh.execute(stmt)
+            with self.track_counters(sesh):
+                sesh.execute(stmt)
+            self.clear_jobs(sesh)
             sesh.commit()
 
-    def pull_n_from_queue(self, n: int) -> Sequence[DetectedObject]:
+    def pull_n_from_queue(
+        self, n: int, where: Optional[sa.ColumnElement] = None
+    ) -> Sequence[DetectedObject]:
         logger.debug(f"Attempting to pull {n} objects of interest from queue")
-        select_stmt = (
-            sa.select(DetectedObject.id)
-            .where(
-                (DetectedObject.id.in_(self.ids()))
-                & (DetectedObject.in_queue.is_(True))
-                & (DetectedObject.specific_label.is_(None))
-                & (DetectedObject.bbox.is_not(None))
-            )
-            .limit(n)
-            .with_for_update()
-        )
-        update_stmt = (
-            sa.update(DetectedObject)
-            .where(DetectedObject.id.in_(select_stmt.scalar_subquery()))
-            .values({"in_queue": False})
-            .returning(DetectedObject.id)
-        )
+        record_ids = self.claim(n, where)
         with get_session(self.db_path) as sesh:
-            record_ids = sesh.execute(update_stmt).scalars().all()
-            sesh.commit()
             objs = (
                 sesh.execute(
-                    sa.select(DetectedObject).where(DetectedObject.id.in_(record_ids))
+                    sa.select(DetectedObject)
+                    .where(DetectedObject.id.in_(record_ids))
+                    .order_by(*self.item_order())
                 )
                 .unique()
                 .scalars()
@@ -386,46 +502,32 @@ class ObjectsWithoutFeaturesQueue(QueueManager):
     name = "Detections without features"
     description = """
     Objects that have been identified as something of interest (e.g. a moth)
-    and need CNN features stored for using to generate tracks & similarity later. 
+    and need CNN features stored for using to generate tracks & similarity later.
     """
+    stage = "feature_extraction"
+    model = DetectedObject
 
-    def ids(self) -> sa.ScalarSelect:
+    def subset(self) -> sa.ColumnElement:
         """
-        Return subquery of all IDs managed by the scope of this queue.
+        Only the latest detection of each bounding box is processed.
         """
-        return (
-            sa.select(sa.func.max(DetectedObject.id))
-            .where(
-                (MonitoringSession.base_directory == str(self.base_directory))
-                & (DetectedObject.binary_label == constants.POSITIVE_BINARY_LABEL)
-            )
-            .join(
-                MonitoringSession,
-                DetectedObject.monitoring_session_id == MonitoringSession.id,
-            )
-            .group_by(DetectedObject.bbox)
-            .scalar_subquery()
+        return DetectedObject.canonical.is_(True) & (
+            DetectedObject.binary_label == constants.POSITIVE_BINARY_LABEL
         )
 
+    def pending(self) -> sa.ColumnElement:
+        return DetectedObject.cnn_features.is_(None)
+
     def queue_count(self) -> int:
         with get_session(self.db_path) as sesh:
-            stmt = sa.select(sa.func.count(DetectedObject.id)).where(
-                (
-                    (DetectedObject.id.in_(self.ids()))
-                    & DetectedObject.in_queue.is_(True)
-                    & DetectedObject.cnn_features.is_(None)
-                )
-            )
+            stmt = sa.select(sa.func.count(DetectedObject.id)).where(self.queued())
             count = sesh.execute(stmt).scalar()
             return count or 0
 
     def unprocessed_count(self) -> int:
         with get_session(self.db_path) as sesh:
             stmt = sa.select(sa.func.count(DetectedObject.id)).where(
-                (
-                    (DetectedObject.id.in_(self.ids()))
-                    & DetectedObject.cnn_features.is_(None)
-                )
+                (self.scope() & DetectedObject.cnn_features.is_(None))
             )
             count = sesh.execute(stmt).scalar()
             return count or 0
@@ -433,68 +535,54 @@ class ObjectsWithoutFeaturesQueue(QueueManager):
     def done_count(self) -> int:
         with get_session(self.db_path) as sesh:
             stmt = sa.select(sa.func.count(DetectedObject.id)).where(
-                (
-                    (DetectedObject.id.in_(self.ids()))
-                    & DetectedObject.cnn_features.is_not(None)
-                )
+                (self.scope() & DetectedObject.cnn_features.is_not(None))
             )
             count = sesh.execute(stmt).scalar()
             return count or 0
 
+    @retry_if_locked
     def add_unprocessed(self, *_) -> None:
         logger.info("Adding objects without feature in deployment to queue")
         with get_session(self.db_path) as sesh:
             stmt = (
                 sa.update(DetectedObject)
                 .where(
-                    (DetectedObject.id.in_(self.ids()))
+                    self.scope()
                     & (DetectedObject.in_queue.is_(False))
                     & (DetectedObject.cnn_features.is_(None))
                 )
                 .values({"in_queue": True})
             )
-            sesh.execute(stmt)
+            with self.track_counters(sesh):
+                sesh.execute(stmt)
+            self.clear_jobs(sesh, statuses=[JobStatus.failed])
             sesh.commit()
 
+    @retry_if_locked
     def clear_queue(self, *_) -> None:
         logger.info("Removing objects without features in deployment from queue")
         with get_session(self.db_path) as sesh:
             stmt = (
                 sa.update(DetectedObject)
-                .where(
-                    (DetectedObject.id.in_(self.ids()))
-                    & (DetectedObject.in_queue.is_(True))
-                    & (DetectedObject.cnn_features.is_(None))
-                )
+                .where(self.queued())
                 .values({"in_queue": False})
             )
-            sesh.execute(stmt)
+            with self.track_counters(sesh):
+                sesh.execute(stmt)
+            self.clear_jobs(sesh)
             sesh.commit()
 
-    def pull_n_from_queue(self, n: int) -> Sequence[DetectedObject]:
+    def pull_n_from_queue(
+        self, n: int, where: Optional[sa.ColumnElement] = None
+    ) -> Sequence[DetectedObject]:
         logger.debug(f"Attempting to pull {n} objects without features from queue")
-        select_stmt = (
-            sa.select(DetectedObject.id)
-            .where(
-                (DetectedObject.id.in_(self.ids()))
-                & (DetectedObject.in_queue.is_(True))
-                & (DetectedObject.cnn_features.is_(None))
-            )
-            .limit(n)
-            .with_for_update()
-        )
-        update_stmt = (
-            sa.update(DetectedObject)
-            .where(DetectedObject.id.in_(select_stmt.scalar_subquery()))
-            .values({"in_queue": False})
-            .returning(DetectedObject.id)
-        )
+        record_ids = self.claim(n, where)
         with get_session(self.db_path) as sesh:
-            record_ids = sesh.execute(update_stmt).scalars().all()
-            sesh.commit()
             objs = (
                 sesh.execute(
-                    sa.select(DetectedObject).where(DetectedObject.id.in_(record_ids))
+                    sa.select(DetectedObject)
+                    .where(DetectedObject.id.in_(record_ids))
+                    .order_by(*self.item_order())
                 )
                 .unique()
                 .scalars()
@@ -510,45 +598,32 @@ class UntrackedObjectsQueue(QueueManager):
     Objects that have been identified as something of interest (e.g. a moth)
     but have not yet been "tracked" e.g. grouped into multiple frames of the same organism.
     """
+    stage = "tracking"
+    model = DetectedObject
 
-    def ids(self) -> sa.ScalarSelect:
+    def subset(self) -> sa.ColumnElement:
         """
-        Return subquery of all IDs managed by the scope of this queue.
+        Only the latest detection of each bounding box is processed.
         """
         return (
-            sa.select(sa.func.max(DetectedObject.id))
-            .where(
-                (MonitoringSession.base_directory == str(self.base_directory))
-                & (DetectedObject.binary_label == constants.POSITIVE_BINARY_LABEL)
-                & (DetectedObject.cnn_features.is_not(None))
-            )
-            .join(
-                MonitoringSession,
-                DetectedObject.monitoring_session_id == MonitoringSession.id,
-            )
-            .group_by(DetectedObject.bbox)
-            .scalar_subquery()
+            DetectedObject.canonical.is_(True)
+            & (DetectedObject.binary_label == constants.POSITIVE_BINARY_LABEL)
+            & (DetectedObject.cnn_features.is_not(None))
         )
 
+    def pending(self) -> sa.ColumnElement:
+        return DetectedObject.sequence_id.is_(None)
+
     def queue_count(self) -> int:
         with get_session(self.db_path) as sesh:
-            stmt = sa.select(sa.func.count(DetectedObject.id)).where(
-                (
-                    (DetectedObject.id.in_(self.ids()))
-                    & DetectedObject.in_queue.is_(True)
-                    & DetectedObject.sequence_id.is_(None)
-                )
-            )
+            stmt = sa.select(sa.func.count(DetectedObject.id)).where(self.queued())
             count = sesh.execute(stmt).scalar()
             return count or 0
 
     def unprocessed_count(self) -> int:
         with get_session(self.db_path) as sesh:
             stmt = sa.select(sa.func.count(DetectedObject.id)).where(
-                (
-                    (DetectedObject.id.in_(self.ids()))
-                    & DetectedObject.sequence_id.is_(None)
-                )
+                (self.scope() & DetectedObject.sequence_id.is_(None))
             )
             count = sesh.execute(stmt).scalar()
             return count or 0
@@ -556,46 +631,45 @@ class UntrackedObjectsQueue(QueueManager):
     def done_count(self) -> int:
         with get_session(self.db_path) as sesh:
             stmt = sa.select(sa.func.count(DetectedObject.id)).where(
-                (
-                    (DetectedObject.id.in_(self.ids()))
-                    & DetectedObject.sequence_id.is_not(None)
-                )
+                (self.scope() & DetectedObject.sequence_id.is_not(None))
             )
             count = sesh.execute(stmt).scalar()
             return count or 0
 
+    @retry_if_locked
     def add_unprocessed(self, *_) -> None:
         logger.info("Adding objects without tracks in deployment to queue")
         with get_session(self.db_path) as sesh:
             stmt = (
                 sa.update(DetectedObject)
                 .where(
-                    (DetectedObject.id.in_(self.ids()))
+                    self.scope()
                     & (DetectedObject.in_queue.is_(False))
                     & (DetectedObject.sequence_id.is_(None))
                 )
                 .values({"in_queue": True})
             )
-            sesh.execute(stmt)
+            with self.track_counters(sesh):
+                sesh.execute(stmt)
+            self.clear_jobs(sesh, statuses=[JobStatus.failed])
             sesh.commit()
 
+    @retry_if_locked
     def clear_queue(self, *_) -> None:
         logger.info("Removing untracked objects in deployment from queue")
         with get_session(self.db_path) as sesh:
             stmt = (
                 sa.update(DetectedObject)
-                .where(
-                    (DetectedObject.id.in_(self.ids()))
-                    & (DetectedObject.in_queue.is_(True))
-                    & (DetectedObject.sequence_id.is_(None))
-                )
+                .where(self.queued())
                 .values({"in_queue": False})
             )
-            sesh.execute(stmt)
+            with self.track_counters(sesh):
+                sesh.execute(stmt)
+            self.clear_jobs(sesh)
             sesh.commit()
 
     def pull_n_from_queue(
-        self, n: int
+        self, n: int, where: Optional[sa.ColumnElement] = None
     ) -> Sequence[tuple[DetectedObject, Sequence[DetectedObject]]]:
         """
         Fetch detected objects that need to be assigned to a sequence / track and
@@ -606,28 +680,13 @@ class UntrackedObjectsQueue(QueueManager):
         This could also happen on a MonitoringSession scope
         """
         logger.debug(f"Attempting to pull {n} objects without tracks from queue")
-        select_stmt = (
-            sa.select(DetectedObject.id)
-            .where(
-                (DetectedObject.id.in_(self.ids()))
-                & (DetectedObject.in_queue.is_(True))
-                & (DetectedObject.sequence_id.is_(None))
-            )
-            .limit(n)
-            .with_for_update()
-        )
-        update_stmt = (
-            sa.update(DetectedObject)
-            .where(DetectedObject.id.in_(select_stmt.scalar_subquery()))
-            .values({"in_queue": False})
-            .returning(DetectedObject.id)
-        )
+        record_ids = self.claim(n, where)
         with get_session(self.db_path) as sesh:
-            record_ids = sesh.execute(update_stmt).scalars().all()
-            sesh.commit()
             objs = (
                 sesh.execute(
-                    sa.select(DetectedObject).where(DetectedObject.id.in_(record_ids))
+                    sa.select(DetectedObject)
+                    .where(DetectedObject.id.in_(record_ids))
+                    .order_by(*self.item_order())
                 )
                 .unique()
                 .scalars()
@@ -653,37 +712,102 @@ def all_queues(db_path, base_directory):
     }
 
 
+def stage_status_columns(model: Union[type[TrapImage], type[DetectedObject]]):
+    """
+    Return the status columns of every queue that processes records of `model`.
+    """
+    return [
+        column
+        for queue in all_queues(db_path=None, base_directory=None).values()
+        if queue.model is model
+        for column in queue.status_columns()
+    ]
+
+
+def stages_of(model: Union[type[TrapImage], type[DetectedObject]]) -> list[str]:
+    """
+    Return the stage of every queue that processes records of `model`.
+    """
+    return [
+        queue.stage
+        for queue in all_queues(db_path=None, base_directory=None).values()
+        if queue.model is model
+    ]
+
+
+def queue_status(db_path: str, base_directory: FilePath) -> dict[str, dict[str, int]]:
+    """
+    Return the number of unprocessed, queued & done records of every queue
+    in the deployment, keyed by queue name.
+
+    All of the counts are computed in a single query with one aggregate pass
+    over each table, rather than three count queries per queue.
+    """
+    queues = list(all_queues(db_path, base_directory).values())
+    subqueries = []
+    for model in (TrapImage, DetectedObject):
+        columns = stage_status_columns(model)
+        first_queue = next(queue for queue in queues if queue.model is model)
+        subqueries.append(
+            sa.select(*columns).where(first_queue.deployment()).subquery()
+        )
+
+    stmt = sa.select(*subqueries).select_from(subqueries[0])
+    for subquery in subqueries[1:]:
+        stmt = stmt.join(subquery, sa.true())
+
+    with get_session(db_path) as sesh:
+        counts = sesh.execute(stmt).one()._mapping
+
+    return {
+        queue.name: {key: counts[f"{queue.stage}_{key}"] for key in COUNTER_KEYS}
+        for queue in queues
+    }
+
+
+@retry_if_locked
 def add_image_to_queue(db_path, image_id):
     with get_session(db_path) as sesh:
         logger.info(f"Adding image id {image_id} to queue")
         stmt = sa.update(TrapImage).filter_by(id=image_id).values({"in_queue": True})
-        sesh.execute(stmt)
+        with track_stage_counters(sesh, {TrapImage: TrapImage.id == image_id}):
+            sesh.execute(stmt)
         sesh.commit()
 
 
+@retry_if_locked
 def add_sample_to_queue(db_path, sample_size=10):
     with get_session(db_path) as sesh:
-        num_in_queue = sesh.query(TrapImage).filter_by(in_queue=True).count()
+        num_in_queue = (
+            sesh.query(TrapImage).filter(TrapImage.in_queue.is_(True)).count()
+        )
+        images = []
         if num_in_queue < sample_size:
-            images = []
-            for image in (
-                sesh.query(TrapImage)
-                .filter_by(
-                    in_queue=False,
+            image_ids = (
+                sesh.execute(
+                    sa.select(TrapImage.id)
+                    .filter_by(
+                        in_queue=False,
+                    )
+                    .order_by(sa.func.random())
+                    .limit(sample_size - num_in_queue)
                 )
-                .order_by(sa.func.random())
-                .limit(sample_size - num_in_queue)
+                .scalars()
                 .all()
-            ):
-                image.in_queue = True
-                images.append(image)
-            logger.info(f"Adding {len(images)} images to queue")
-            sesh.bulk_save_objects(images)
+            )
+            logger.info(f"Adding {len(image_ids)} images to queue")
+            sample = TrapImage.id.in_(image_ids)
+            with track_stage_counters(sesh, {TrapImage: sample}):
+                sesh.execute(
+                    sa.update(TrapImage).where(sample).values({"in_queue": True})
+                )
             sesh.commit()
+            images = sesh.execute(sa.select(TrapImage).where(sample)).scalars().all()
 
     return images
 
 
+@retry_if_locked
 def add_monitoring_session_to_queue(db_path, monitoring_session):
     """
     Add images captured during a give Monitoring Session to the
@@ -706,31 +830,38 @@ def add_monitoring_session_to_queue(db_path, monitoring_session):
             )
             .values({"in_queue": True})
         )
-        sesh.execute(stmt)
+        with track_stage_counters(
+            sesh, {TrapImage: TrapImage.monitoring_session_id == ms.id}
+        ):
+            sesh.execute(stmt)
         sesh.commit()
 
 
 def images_in_queue(db_path):
     with get_session(db_path) as sesh:
-        return sesh.query(TrapImage).filter_by(in_queue=True).count()
+        return sesh.query(TrapImage).filter(TrapImage.in_queue.is_(True)).count()
 
 
 def queue_counts(db_path):
     counts = {}
     with get_session(db_path) as sesh:
-        counts["images"] = sesh.query(TrapImage).filter_by(in_queue=True).count()
+        # Compare with IS rather than = so the partial indexes on queued rows apply
+        counts["images"] = (
+            sesh.query(TrapImage).filter(TrapImage.in_queue.is_(True)).count()
+        )
         counts["unclassified_objects"] = (
             sesh.query(DetectedObject)
-            .filter_by(in_queue=True, binary_label=None)
+            .filter_by(binary_label=None)
+            .filter(DetectedObject.in_queue.is_(True))
             .count()
         )
         counts["unclassified_species"] = (
             sesh.query(DetectedObject)
             .filter_by(
-                in_queue=True,
                 specific_label=None,
             )
             .filter(
+                DetectedObject.in_queue.is_(True),
                 DetectedObject.binary_label.is_not(None),
             )
             .count()
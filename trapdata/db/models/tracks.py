@@ -0,0 +1,133 @@
+from typing import Iterable, Optional
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from trapdata.db import Base
+from trapdata.db import models
+
+
+class Track(Base):
+    """
+    The aggregates of each track (the detections with the same sequence ID).
+
+    The writers of the detections keep the tracks up to date with `update_tracks`,
+    so the track of a detection can be read with one indexed lookup instead of
+    aggregating its detections every time.
+    """
+
+    __tablename__ = "tracks"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    sequence_id = sa.Column(sa.String(255), nullable=False)
+    monitoring_session_id = sa.Column(sa.ForeignKey("monitoring_sessions.id"))
+    start_time = sa.Column(sa.DateTime(timezone=True))
+    end_time = sa.Column(sa.DateTime(timezone=True))
+    num_frames = sa.Column(sa.Integer)
+    num_detections = sa.Column(sa.Integer)
+    # The detection with the highest species classification score
+    best_detection_id = sa.Column(sa.ForeignKey("detections.id", ondelete="SET NULL"))
+    best_label = sa.Column(sa.String(255))
+    best_score = sa.Column(sa.Numeric(asdecimal=False))
+
+    __table_args__ = (
+        sa.Index("ix_tracks_sequence_id", sequence_id, unique=True),
+        sa.Index("ix_tracks_monitoring_session_id", monitoring_session_id),
+    )
+
+    def __repr__(self):
+        return (
+            f"Track(sequence_id={self.sequence_id!r}, "
+            f"num_frames={self.num_frames!r}, best_label={self.best_label!r})"
+        )
+
+
+def track_aggregates(where: sa.ColumnElement) -> sa.Select:
+    """
+    Aggregate the tracks of the detections matching the filter into the columns
+    of the tracks table.
+    """
+    DetectedObject = models.DetectedObject
+    where = where & DetectedObject.sequence_id.is_not(None)
+    ranked = (
+        sa.select(
+            DetectedObject.id,
+            DetectedObject.sequence_id,
+            DetectedObject.specific_label,
+            DetectedObject.specific_label_score,
+            sa.func.row_number()
+            .over(
+                partition_by=DetectedObject.sequence_id,
+                order_by=DetectedObject.specific_label_score.desc(),
+            )
+            .label("rank"),
+        )
+        .where(where & DetectedObject.specific_label_score.is_not(None))
+        .subquery()
+    )
+    best = sa.select(ranked).where(ranked.c.rank == 1).subquery()
+    tracks = (
+        sa.select(
+            DetectedObject.sequence_id,
+            sa.func.min(DetectedObject.monitoring_session_id).label(
+                "monitoring_session_id"
+            ),
+            sa.func.min(DetectedObject.timestamp).label("start_time"),
+            sa.func.max(DetectedObject.timestamp).label("end_time"),
+            (sa.func.max(DetectedObject.sequence_frame) + 1).label("num_frames"),
+            sa.func.count(DetectedObject.id).label("num_detections"),
+        )
+        .where(where)
+        .group_by(DetectedObject.sequence_id)
+        .subquery()
+    )
+    return sa.select(
+        tracks,
+        best.c.id.label("best_detection_id"),
+        best.c.specific_label.label("best_label"),
+        best.c.specific_label_score.label("best_score"),
+    ).outerjoin(best, best.c.sequence_id == tracks.c.sequence_id)
+
+
+def update_tracks(
+    session: orm.Session,
+    sequence_ids: Optional[Iterable[str]] = None,
+    monitoring_session_id: Optional[int] = None,
+):
+    """
+    Rebuild the tracks with the given sequence IDs, or all of the tracks in a
+    monitoring session, from their detections. The caller commits the changes.
+    """
+    DetectedObject = models.DetectedObject
+    if monitoring_session_id is not None:
+        tracks = Track.monitoring_session_id == monitoring_session_id
+        detections = DetectedObject.monitoring_session_id == monitoring_session_id
+    elif sequence_ids is not None:
+        sequence_ids = set(sequence_ids)
+        if not sequence_ids:
+            return
+        tracks = Track.sequence_id.in_(sequence_ids)
+        detections = DetectedObject.sequence_id.in_(sequence_ids)
+    else:
+        tracks = detections = sa.true()
+
+    session.execute(sa.delete(Track).where(tracks))
+    aggregates = track_aggregates(detections)
+    columns = [column.name for column in aggregates.selected_columns]
+    session.execute(sa.insert(Track).from_select(columns, aggregates))
+
+
+def sequences_of_objects(session: orm.Session, where: sa.ColumnElement) -> list[str]:
+    """
+    The sequence IDs of the detections matching the filter.
+    """
+    DetectedObject = models.DetectedObject
+    return (
+        session.execute(
+            sa.select(DetectedObject.sequence_id)
+            .where(where & DetectedObject.sequence_id.is_not(None))
+            .distinct()
+        )
+        .scalars()
+        .all()
+    )
@@ -6,6 +6,7 @@ import sqlalchemy as sa
 from .base import get_session
 from trapdata import constants
 from trapdata.db import models
+from trapdata.db.models import events
 
 
 def count_species(db_path, monitoring_session=None):
@@ -169,11 +170,13 @@ def count_species_with_images(db_session=None, monitoring_session=None):
         return query
 
 
-def update_all_aggregates(directory):
-    # Call the update_aggregates method of every model
-    raise NotImplementedError
+def update_all_aggregates(db_path, base_directory=None):
+    # Update the cached counts & times of every monitoring session
+    where = None
+    if base_directory:
+        where = models.MonitoringSession.base_directory == str(base_directory)
 
-    with get_session(directory) as sesh:
-        for ms in sesh.query(None).all():
-            ms.update_aggregates(sesh)
+    with get_session(db_path) as sesh:
+        num_updated = events.update_all_aggregates(sesh, where)
         sesh.commit()
+    return num_updated
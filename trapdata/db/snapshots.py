@@ -0,0 +1,249 @@
+"""
+Columnar snapshots of the database for analysis.
+
+Each table is written to a directory of Parquet files, e.g. `<directory>/detections/`,
+that pandas, pyarrow or DuckDB can read (and memory-map) as a single dataset without
+opening the database. Incremental snapshots append a new part file with the rows
+added or changed since the previous snapshot, so a row can appear in more than one
+part. The part with the highest number has the latest version of the row.
+
+Requires the `parquet` extra: `pip install trapdata[parquet]`
+"""
+
+import json
+import pathlib
+import datetime
+from typing import Any, Callable, Optional
+
+import sqlalchemy as sa
+
+from trapdata.db import get_session
+from trapdata.db.types import FeatureVector
+from trapdata.db.models.events import MonitoringSession
+from trapdata.db.models.images import TrapImage
+from trapdata.db.models.detections import DetectedObject
+from trapdata.db.models.tracks import Track
+from trapdata.common.logs import logger
+from trapdata.common.types import FilePath
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+STATE_FILENAME = "snapshot.json"
+
+# Incremental snapshots are only appended to parts written with the same schema
+SCHEMA_VERSION = 2
+
+# Tables that incremental snapshots append to, with the columns that find
+# the rows added or changed since the previous snapshot
+INCREMENTAL_TABLES = {
+    "images": (TrapImage, ("id", "last_processed")),
+    "detections": (DetectedObject, ("id", "updated_at")),
+}
+
+# Small or derived tables that every snapshot rewrites
+FULL_TABLES = {"events": MonitoringSession, "tracks": Track}
+
+
+def arrow_type(column: sa.Column) -> "pa.DataType":
+    """
+    Return the Arrow type of a column, which only depends on the column so that
+    every part of a table has the same schema.
+    """
+    if isinstance(column.type, FeatureVector):
+        # The size of the vectors depends on the feature extractor
+        return pa.list_(pa.from_numpy_dtype(column.type.dtype))
+    elif column.name == "bbox":
+        return pa.list_(pa.int64(), 4)
+    elif isinstance(column.type, sa.Boolean):
+        return pa.bool_()
+    elif isinstance(column.type, sa.Integer):
+        return pa.int64()
+    elif isinstance(column.type, sa.Numeric):
+        return pa.float64()
+    elif isinstance(column.type, sa.DateTime):
+        return pa.timestamp("us")
+    elif isinstance(column.type, sa.Date):
+        return pa.date32()
+    else:
+        # Strings and other JSON values
+        return pa.string()
+
+
+def arrow_value(column: sa.Column, arrow_type: "pa.DataType") -> Callable[[Any], Any]:
+    if isinstance(column.type, sa.JSON) and pa.types.is_string(arrow_type):
+        return lambda value: None if value is None else json.dumps(value)
+    else:
+        return lambda value: value
+
+
+def cursor_value(column: sa.Column, value: Any) -> Any:
+    """
+    Read a cursor value saved in the JSON state of a snapshot.
+    """
+    if value is not None and isinstance(column.type, sa.DateTime):
+        return datetime.datetime.fromisoformat(value)
+    return value
+
+
+def write_parquet(
+    db_path: str,
+    stmt: sa.Select,
+    key: sa.ColumnElement,
+    schema: "pa.Schema",
+    converters: list[Callable[[Any], Any]],
+    filepath: pathlib.Path,
+    batch_size: int,
+) -> int:
+    """
+    Write the rows of a query to a Parquet file one page (and row group) at a time,
+    using keyset pagination on `key`. The file only appears once it is complete.
+    """
+    # Files starting with a dot are ignored by readers of the dataset
+    tmp_filepath = filepath.with_name(f".{filepath.name}.tmp")
+    count = 0
+    last_key = None
+    with pq.ParquetWriter(tmp_filepath, schema) as writer:
+        while True:
+            page = stmt.order_by(key).limit(batch_size)
+            if last_key is not None:
+                page = page.where(key > last_key)
+            with get_session(db_path) as sesh:
+                rows = sesh.execute(page).all()
+            if not rows:
+                break
+            columns = zip(*rows)
+            batch = pa.RecordBatch.from_arrays(
+                [
+                    pa.array([convert(v) for v in values], type=field.type)
+                    for values, convert, field in zip(columns, converters, schema)
+                ],
+                schema=schema,
+            )
+            writer.write_batch(batch)
+            count += len(rows)
+            last_key = getattr(rows[-1], key.name)
+    tmp_filepath.rename(filepath)
+    return count
+
+
+def read_state(directory: pathlib.Path) -> Optional[dict[str, Any]]:
+    filepath = directory / STATE_FILENAME
+    if filepath.exists():
+        return json.loads(filepath.read_text())
+    return None
+
+
+def clear_parts(table_directory: pathlib.Path):
+    for filepath in table_directory.glob("part-*.parquet"):
+        filepath.unlink()
+
+
+def write_snapshot(
+    db_path: str,
+    directory: FilePath,
+    incremental: bool = False,
+    batch_size: int = 10000,
+) -> dict[str, int]:
+    """
+    Write the images, detections, events & tracks to Parquet files in a directory.
+
+    With `incremental`, only the images and detections added (by ID) or changed
+    (by `last_processed` and `updated_at`) since the previous snapshot in the
+    directory are appended. Deleted rows are only removed by a full snapshot.
+
+    Returns the number of rows written for each table.
+    """
+    if pa is None:
+        raise ImportError(
+            "Parquet snapshots require pyarrow, install with `pip install trapdata[parquet]`"
+        )
+
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    state = read_state(directory) if incremental else None
+    if incremental and not state:
+        logger.info(f"No previous snapshot in {directory}, writing a full snapshot")
+    elif state and state.get("schema_version") != SCHEMA_VERSION:
+        logger.info(
+            f"Snapshot in {directory} has an old schema, writing a full snapshot"
+        )
+        state = None
+
+    with get_session(db_path) as sesh:
+        # The end of this snapshot is the start of the next incremental one,
+        # rows added while it is being written are left for the next one.
+        cursors = {
+            name: {
+                column: sesh.execute(
+                    sa.select(sa.func.max(model.__table__.c[column]))
+                ).scalar()
+                for column in columns
+            }
+            for name, (model, columns) in INCREMENTAL_TABLES.items()
+        }
+
+    number = state["snapshot"] + 1 if state else 0
+    part_name = f"part-{number:05d}.parquet"
+    counts = {}
+
+    tables = [
+        (name, model, columns) for name, (model, columns) in INCREMENTAL_TABLES.items()
+    ] + [(name, model, ()) for name, model in FULL_TABLES.items()]
+    for name, model, cursor_columns in tables:
+        table = model.__table__
+        table_directory = directory / name
+        table_directory.mkdir(exist_ok=True)
+        if not state or not cursor_columns:
+            clear_parts(table_directory)
+
+        stmt = sa.select(*table.columns)
+        if cursor_columns:
+            stmt = stmt.where(table.c.id <= cursors[name]["id"])
+            previous = state["cursors"][name] if state else None
+            if previous:
+                changed = [
+                    table.c[column] > cursor_value(table.c[column], value)
+                    for column, value in previous.items()
+                    if value is not None
+                ]
+                stmt = stmt.where(sa.or_(*changed) if changed else sa.true())
+
+        types = [arrow_type(column) for column in table.columns]
+        schema = pa.schema(
+            [(column.name, type) for column, type in zip(table.columns, types)]
+        )
+        converters = [
+            arrow_value(column, type) for column, type in zip(table.columns, types)
+        ]
+        counts[name] = write_parquet(
+            db_path,
+            stmt,
+            table.c.id,
+            schema,
+            converters,
+            table_directory / part_name,
+            batch_size,
+        )
+
+    state = {
+        "snapshot": number,
+        "created": datetime.datetime.now().isoformat(),
+        "schema_version": SCHEMA_VERSION,
+        "cursors": {
+            name: {
+                column: (
+                    value.isoformat() if isinstance(value, datetime.datetime) else value
+                )
+                for column, value in cursor.items()
+            }
+            for name, cursor in cursors.items()
+        },
+    }
+    (directory / STATE_FILENAME).write_text(json.dumps(state, indent=2))
+    logger.info(f"Saved snapshot {number} to {directory}: {counts}")
+    return counts
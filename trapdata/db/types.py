@@ -0,0 +1,33 @@
+from typing import Optional, Union, Sequence
+
+import numpy as np
+import sqlalchemy as sa
+
+
+class FeatureVector(sa.types.TypeDecorator):
+    """
+    A vector of floats stored as raw bytes, rather than a JSON list.
+
+    Values can be saved from any sequence of numbers and are loaded as read-only
+    NumPy arrays that share the memory of the row data (see `np.frombuffer`).
+    Use `dtype=np.float16` to halve the size again at the cost of precision.
+    """
+
+    impl = sa.LargeBinary
+    cache_ok = True
+
+    def __init__(self, dtype: Union[type, str] = np.float32, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dtype = np.dtype(dtype)
+
+    def process_bind_param(
+        self, value: Optional[Union[np.ndarray, Sequence[float]]], dialect
+    ) -> Optional[bytes]:
+        if value is None:
+            return None
+        return np.asarray(value, dtype=self.dtype).tobytes()
+
+    def process_result_value(self, value: Optional[bytes], dialect):
+        if value is None:
+            return None
+        return np.frombuffer(value, dtype=self.dtype)
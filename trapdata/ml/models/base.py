@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Optional, Sequence
 import json
 
 import torch
@@ -230,11 +230,23 @@ class InferenceBaseClass:
                 continue
 
             item_ids, batch_input = batch
+            item_ids = item_ids.tolist()
 
             logger.info(
                 f"Processing batch {i+1}, about {len(self.dataloader)} remaining"
             )
+            # The batch may have waited in the dataloader since it was claimed
+            self.queue.renew(item_ids)
+            self.process_batch(item_ids, batch_input)
+            logger.info(f"{self.name} Batch -- Done")
+
+        logger.info(f"{self.name} -- Done")
 
+    def process_batch(self, item_ids: list[int], batch_input):
+        """
+        Predict, post-process & save the results of a batch of claimed items.
+        """
+        try:
             # @TODO the StopWatch doesn't seem to work when there are multiple workers,
             # it always returns 0 seconds.
             with StopWatch() as batch_time:
@@ -248,9 +260,38 @@ class InferenceBaseClass:
             )
 
             batch_output = list(self.post_process_batch(batch_output))
-            item_ids = item_ids.tolist()
             logger.info(f"Saving {len(item_ids)} results")
             self.save_results(item_ids, batch_output)
-            logger.info(f"{self.name} Batch -- Done")
+        except Exception:
+            # The items can be tried again right away, by another worker or run
+            self.queue.release(item_ids)
+            raise
+        self.queue.complete(item_ids)
 
-        logger.info(f"{self.name} -- Done")
+    @torch.no_grad()
+    def run_images(self, image_ids: Sequence[int]) -> int:
+        """
+        Process the queued items of the given images right away, in the current
+        thread instead of the dataloader. Returns the number of items processed.
+        """
+        where = self.queue.of_images(image_ids)
+        processed_ids = []
+        while True:
+            records = self.queue.pull_n_from_queue(
+                self.batch_size,
+                where & self.queue.model.id.not_in(processed_ids),
+            )
+            if not records:
+                break
+            item_ids = [record.id for record in records]
+            try:
+                batch_input = torch.utils.data.default_collate(
+                    [self.dataset.transform_record(record) for record in records]
+                )
+            except Exception:
+                # e.g. an image that can't be read, like in `process_batch`
+                self.queue.release(item_ids)
+                raise
+            self.process_batch(item_ids, batch_input)
+            processed_ids += item_ids
+        return len(processed_ids)
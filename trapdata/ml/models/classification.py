@@ -36,13 +36,19 @@ class ClassificationIterableDatabaseDataset(torch.utils.data.IterableDataset):
                     [record.id for record in records]
                 )
                 batch_data = torch.utils.data.default_collate(
-                    [self.transform(record.cropped_image_data()) for record in records]
+                    [self.transform_record(record) for record in records]
                 )
                 yield (item_ids, batch_data)
+            else:
+                # The remaining items are claimed by other workers
+                break
 
     def transform(self, cropped_image):
         return self.image_transforms(cropped_image)
 
+    def transform_record(self, record):
+        return self.transform(record.cropped_image_data())
+
 
 class EfficientNetClassifier(InferenceBaseClass):
     input_size = 300
@@ -10,6 +10,7 @@ from trapdata import db
 from trapdata.db.models.queue import ImageQueue
 from trapdata import TrapImage
 from trapdata import logger
+from trapdata.common.cache import open_frame
 
 from trapdata.db.models.detections import save_detected_objects
 from trapdata.ml.models.base import InferenceBaseClass
@@ -36,14 +37,23 @@ class LocalizationIterableDatabaseDataset(torch.utils.data.IterableDataset):
                     [record.id for record in records]
                 )
                 batch_data = torch.utils.data.default_collate(
-                    [self.transform(record.absolute_path) for record in records]
+                    [self.transform_record(record) for record in records]
                 )
 
                 yield (item_ids, batch_data)
+            else:
+                # The remaining items are claimed by other workers
+                break
 
     def transform(self, img_path):
+        if torch.utils.data.get_worker_info() is None:
+            # In the main process, the decoded image is kept for saving the crops
+            return self.image_transforms(open_frame(img_path))
         return self.image_transforms(PIL.Image.open(img_path))
 
+    def transform_record(self, record):
+        return self.transform(record.absolute_path)
+
 
 class LocalizationDatabaseDataset(torch.utils.data.Dataset):
     def __init__(self, db_path, image_transforms):
@@ -10,7 +10,7 @@ import math
 import PIL.Image
 from torchvision import transforms
 import torch.utils.data
-from sqlalchemy import orm, select, update, func
+from sqlalchemy import orm, select, update, delete, func
 from rich.progress import track
 
 from trapdata import logger
@@ -26,6 +26,8 @@ from trapdata.db.models.queue import UntrackedObjectsQueue, ObjectsWithoutFeatur
 from trapdata.db.models.events import MonitoringSession
 from trapdata.db.models.images import TrapImage
 from trapdata.db.models.detections import DetectedObject, save_classified_objects
+from trapdata.db.models.counters import count_stages, apply_count_changes
+from trapdata.db.models.tracks import Track, update_tracks, sequences_of_objects
 
 # from trapdata.db.models.detections import save_untracked_detection
 from .base import InferenceBaseClass
@@ -60,6 +62,9 @@ def cosine_similarity(img1_ftrs: torch.Tensor, img2_ftrs: torch.Tensor) -> float
     Uses the feature embeddings array computed from a CNN model.
     """
 
+    # Features are stored as float32, compare them with full precision
+    img1_ftrs = np.asarray(img1_ftrs, dtype=np.float64)
+    img2_ftrs = np.asarray(img2_ftrs, dtype=np.float64)
     cosine_sim = np.dot(img1_ftrs, img2_ftrs) / (
         np.linalg.norm(img1_ftrs) * np.linalg.norm(img2_ftrs)
     )
@@ -412,6 +417,9 @@ class UntrackedObjectsIterableDatabaseDataset(torch.utils.data.IterableDataset):
                     # batch_metadata,
                     # batch_comparison_metadata,
                 )
+            else:
+                # The remaining items are claimed by other workers
+                break
 
     def transform(self, cropped_image) -> torch.Tensor:
         return self.image_transforms(cropped_image)
@@ -457,7 +465,7 @@ class FeatureExtractor(InferenceBaseClass):
         # output = output.view(-1, output.size(0)).cpu()
         # output = output.reshape((output.shape[0],))
         batch_size = output.shape[0]
-        num_features = np.product(output.shape[1:])
+        num_features = np.prod(output.shape[1:])
 
         output = output.reshape(batch_size, num_features)
         output = output.cpu().numpy()
@@ -469,7 +477,7 @@ class FeatureExtractor(InferenceBaseClass):
         # Here we are saving the moth/non-moth labels
         data = [
             {
-                "cnn_features": features.tolist(),
+                "cnn_features": features,
                 # Clear any existing sequence assignment:
                 "sequence_id": None,
                 "sequence_frame": None,
@@ -491,7 +499,9 @@ class MothNonMothFeatureExtractor(FeatureExtractor, MothNonMothClassifier):
     name = "Features from general Moth/Non-Moth model"
 
 
-def clear_sequences(monitoring_session: MonitoringSession, session: orm.Session):
+def clear_sequences(
+    monitoring_session: MonitoringSession, session: orm.Session, commit: bool = True
+):
     logger.info(f"Clearing existing sequences for {monitoring_session.day}")
     stmt = (
         update(DetectedObject)
@@ -506,8 +516,12 @@ def clear_sequences(monitoring_session: MonitoringSession, session: orm.Session)
         )
     )
     session.execute(stmt)
-    session.flush()
-    session.commit()
+    session.execute(
+        delete(Track).where(Track.monitoring_session_id == monitoring_session.id)
+    )
+    if commit:
+        session.flush()
+        session.commit()
 
 
 def make_sequence_id(date: datetime.date, obj_id: int):
@@ -638,7 +652,7 @@ def compare_objects(
     img_shape = PIL.Image.open(image_current.absolute_path).size
 
     for obj_current in objects_current:
-        if not obj_current.cnn_features:
+        if obj_current.cnn_features is None:
             logger.warn(
                 f"Object is missing CNN features, can't determine track for object {obj_current.id}"
             )
@@ -653,7 +667,7 @@ def compare_objects(
         logger.debug(f"Comparing obj {obj_current.id} to all objects in previous frame")
         costs = []
         for obj_previous in objects_previous:
-            if not obj_previous.cnn_features:
+            if obj_previous.cnn_features is None:
                 logger.warn(
                     f"An object in the previous frame is missing features, can't determine track for object {obj_current.id}"
                 )
@@ -700,7 +714,7 @@ def compare_objects(
     # Check all objects
     # If current object was not assigned to a sequence, create one for it by itself
     for obj_current in objects_current:
-        if obj_current.cnn_features and not obj_current.sequence_id:
+        if obj_current.cnn_features is not None and not obj_current.sequence_id:
             sequence_id = assign_solo_sequence(obj_current, session=session)
 
     if commit:
@@ -730,7 +744,13 @@ def find_all_tracks(
     """
     Retrieve all images for an Event / Monitoring Session and find all sequential objects.
     """
-    clear_sequences(monitoring_session, session)
+    changed_records = {
+        DetectedObject: DetectedObject.monitoring_session_id == monitoring_session.id
+    }
+    counts_before = count_stages(session, changed_records)
+
+    # Sequences are cleared & saved in one transaction with the stage counters
+    clear_sequences(monitoring_session, session, commit=False)
 
     logger.info(f"Calculating tracks for {monitoring_session.day}")
 
@@ -745,7 +765,6 @@ def find_all_tracks(
         )
         .values({"in_queue": False})
     )
-    session.commit()
 
     images = (
         session.execute(
@@ -771,9 +790,81 @@ def find_all_tracks(
             )
     logger.info("Saving tracks to database")
     session.flush()
+    update_tracks(session, monitoring_session_id=monitoring_session.id)
+    apply_count_changes(session, counts_before, count_stages(session, changed_records))
     session.commit()
 
 
+def track_new_image(image: TrapImage, session: orm.Session):
+    """
+    Assign the objects in a newly processed image to the tracks of the image before
+    it in the same Monitoring Session, without recalculating the whole session.
+
+    Used when images are processed as they arrive, see `find_all_tracks` to
+    recalculate all tracks of a session. The caller commits.
+    """
+    image_previous = session.execute(
+        select(TrapImage)
+        .where(
+            (TrapImage.monitoring_session_id == image.monitoring_session_id)
+            & (TrapImage.timestamp < image.timestamp)
+        )
+        .order_by(TrapImage.timestamp.desc())
+        .limit(1)
+    ).scalar()
+    image_ids = [image.id] + ([image_previous.id] if image_previous else [])
+    changed_records = {DetectedObject: DetectedObject.image_id.in_(image_ids)}
+    counts_before = count_stages(session, changed_records)
+
+    session.execute(
+        update(DetectedObject)
+        .where(
+            (DetectedObject.image_id == image.id)
+            & (DetectedObject.in_queue == True)
+            & (DetectedObject.cnn_features.is_not(None))
+        )
+        .values({"in_queue": False})
+        # The objects of the image are loaded already, with features that can't
+        # be compared in Python
+        .execution_options(synchronize_session="fetch")
+    )
+
+    if image_previous:
+        compare_objects(
+            image_current=image,
+            image_previous=image_previous,
+            session=session,
+            skip_existing=True,
+            commit=False,
+        )
+    else:
+        # The first image of the session starts a track for each object
+        objects = (
+            session.execute(
+                select(DetectedObject).where(
+                    (DetectedObject.image_id == image.id)
+                    & (DetectedObject.binary_label == constants.POSITIVE_BINARY_LABEL)
+                    & DetectedObject.cnn_features.is_not(None)
+                    & DetectedObject.sequence_id.is_(None)
+                )
+            )
+            .unique()
+            .scalars()
+            .all()
+        )
+        for obj in objects:
+            assign_solo_sequence(obj, session=session)
+
+    session.flush()
+    update_tracks(
+        session,
+        sequence_ids=sequences_of_objects(
+            session, DetectedObject.image_id.in_(image_ids)
+        ),
+    )
+    apply_count_changes(session, counts_before, count_stages(session, changed_records))
+
+
 def summarize_tracks(session: orm.Session, event: Optional[MonitoringSession] = None):
     query_args = {}
     if event:
@@ -1,76 +1,105 @@
+import time
+import queue
 import pathlib
+import threading
+from typing import Optional, Sequence
+
+import sqlalchemy as sa
 
 from trapdata import logger
 from trapdata import ml
-from trapdata.db.base import get_session_class
+from trapdata.db.base import get_session, get_session_class
+from trapdata.db.models.images import TrapImage
+from trapdata.db.models.events import MonitoringSession, update_all_aggregates
+from trapdata.db.models.queue import queue_status
 from trapdata.common.types import FilePath
+from trapdata.ml.models.base import InferenceBaseClass
+from trapdata.ml.utils import StopWatch
 
 
-def start_pipeline(
+def load_models(
     db_path: str,
     image_base_path: FilePath,
     config: dict,
     single: bool = False,
-):
+) -> list[InferenceBaseClass]:
+    """
+    Load the models of each stage selected in the config, in the order they run.
+    """
     user_data_path = pathlib.Path(config.get("paths", "user_data_path"))
     logger.info(f"Local user data path: {user_data_path}")
     num_workers = int(config.get("performance", "num_workers"))
-
-    object_detector_name = config.get("models", "localization_model")
-    ObjectDetector = ml.models.object_detectors[object_detector_name]
-    object_detector = ObjectDetector(
-        db_path=db_path,
-        image_base_path=image_base_path,
-        user_data_path=user_data_path,
-        batch_size=int(config.get("performance", "localization_batch_size")),
-        num_workers=num_workers,
-        single=single,
-    )
-    if object_detector.queue.queue_count() > 0:
-        object_detector.run()
-        logger.info("Localization complete")
-
-    binary_classifier_name = config.get("models", "binary_classification_model")
-    BinaryClassifier = ml.models.binary_classifiers[binary_classifier_name]
-    binary_classifier = BinaryClassifier(
-        db_path=db_path,
-        image_base_path=image_base_path,
-        user_data_path=user_data_path,
-        batch_size=int(config.get("performance", "classification_batch_size")),
-        num_workers=num_workers,
-        single=single,
-    )
-    if binary_classifier.queue.queue_count() > 0:
-        binary_classifier.run()
-        logger.info("Binary classification complete")
-
-    species_classifier_name = config.get("models", "species_classification_model")
-    SpeciesClassifier = ml.models.species_classifiers[species_classifier_name]
-    species_classifier = SpeciesClassifier(
-        db_path=db_path,
-        image_base_path=image_base_path,
-        user_data_path=user_data_path,
-        batch_size=int(config.get("performance", "classification_batch_size")),
-        num_workers=num_workers,
-        single=single,
+    localization_batch_size = int(config.get("performance", "localization_batch_size"))
+    classification_batch_size = int(
+        config.get("performance", "classification_batch_size")
     )
-    if species_classifier.queue.queue_count() > 0:
-        species_classifier.run()
-        logger.info("Species classification complete")
-
-    feature_extractor_name = config.get("models", "feature_extractor")
-    FeatureExtractor = ml.models.feature_extractors[feature_extractor_name]
-    feature_extractor = FeatureExtractor(
-        db_path=db_path,
-        image_base_path=image_base_path,
-        user_data_path=user_data_path,
-        batch_size=int(config.get("performance", "classification_batch_size")),
-        num_workers=num_workers,
-        single=single,
-    )
-    if feature_extractor.queue.queue_count() > 0:
-        feature_extractor.run()
-        logger.info("Feature extraction complete")
+
+    stages = [
+        (
+            ml.models.object_detectors,
+            "localization_model",
+            localization_batch_size,
+        ),
+        (
+            ml.models.binary_classifiers,
+            "binary_classification_model",
+            classification_batch_size,
+        ),
+        (
+            ml.models.species_classifiers,
+            "species_classification_model",
+            classification_batch_size,
+        ),
+        (
+            ml.models.feature_extractors,
+            "feature_extractor",
+            classification_batch_size,
+        ),
+    ]
+    models = []
+    for choices, setting, batch_size in stages:
+        Model = choices[config.get("models", setting)]
+        models.append(
+            Model(
+                db_path=db_path,
+                image_base_path=image_base_path,
+                user_data_path=user_data_path,
+                batch_size=batch_size,
+                num_workers=num_workers,
+                single=single,
+            )
+        )
+    return models
+
+
+def start_pipeline(
+    db_path: str,
+    image_base_path: FilePath,
+    config: dict,
+    single: bool = False,
+    staged: bool = False,
+    stage_workers: Optional[dict[str, int]] = None,
+):
+    """
+    Process all queued items, one stage after the other. With `staged`, the
+    stages run concurrently first, see `StagedPipeline`.
+    """
+    status = queue_status(db_path, image_base_path)
+    for name, counts in status.items():
+        logger.info(f"{name}: {counts['queued']} queued of {counts['unprocessed']}")
+
+    models = load_models(db_path, image_base_path, config, single=single)
+    if staged:
+        StagedPipeline(db_path, image_base_path, models, workers=stage_workers).run()
+        # Only the items added to the queues while the stages ran are left
+        status = queue_status(db_path, image_base_path)
+
+    for model in models:
+        if status[model.queue.name]["queued"] > 0:
+            model.run()
+            logger.info(f"{model.name} complete")
+            # Each stage adds items to the queues of the stages after it
+            status = queue_status(db_path, image_base_path)
 
     # @TODO this should only generate tracks with cnn_features for all detections
     # in a monitoring session. Consider creating or updating a QueueManager
@@ -86,9 +115,275 @@ def start_pipeline(
                 monitoring_session=event, session=session
             )
 
+        # The events are read with their cached counts & times
+        update_all_aggregates(
+            session, MonitoringSession.base_directory == str(image_base_path)
+        )
+        session.commit()
+
         # Debug extra unprocessed objects:
         # from trapdata.ml.models.tracking import UntrackedObjectsQueue
         # queue = UntrackedObjectsQueue(db_path=db_path, base_directory=image_base_path)
         # queue.add_unprocessed()
         # for obj, previous_objects in queue.pull_n_from_queue(100):
         #     print(len(previous_objects), obj)
+
+
+class LivePipeline:
+    """
+    Process new images through every stage as soon as they arrive, instead of
+    running each stage over the whole queue in turn like `start_pipeline`.
+
+    The models stay loaded between images. Each image is detected, classified,
+    has its features extracted and is tracked against the image before it,
+    so its results can be shown within seconds of the capture.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        image_base_path: FilePath,
+        models: Sequence[InferenceBaseClass],
+    ):
+        self.db_path = db_path
+        self.image_base_path = image_base_path
+        self.models = models
+
+    @classmethod
+    def from_config(cls, db_path: str, image_base_path: FilePath, config: dict):
+        # The images are processed in the current thread, without dataloader workers
+        models = load_models(db_path, image_base_path, config, single=True)
+        return cls(db_path, image_base_path, models)
+
+    def process_images(self, image_ids: Sequence[int]) -> dict[str, float]:
+        """
+        Run the queued images through all stages and return the seconds spent on
+        each stage. The images must be in the queue, e.g. saved by the `ImageWatcher`
+        with `queue=True`.
+        """
+        timings = {}
+        with StopWatch() as total_time:
+            for model in self.models:
+                with StopWatch() as t:
+                    num_items = model.run_images(image_ids)
+                timings[model.queue.stage] = t.duration
+                logger.debug(
+                    f"{model.name}: {num_items} items in {round(t.duration, 2)}s"
+                )
+
+            with StopWatch() as t:
+                with get_session(self.db_path) as sesh:
+                    images = (
+                        sesh.execute(
+                            sa.select(TrapImage)
+                            .where(TrapImage.id.in_(image_ids))
+                            .order_by(TrapImage.timestamp)
+                        )
+                        .unique()
+                        .scalars()
+                        .all()
+                    )
+                    for image in images:
+                        ml.models.tracking.track_new_image(image, sesh)
+                    sesh.commit()
+            timings["tracking"] = t.duration
+        timings["total"] = total_time.duration
+
+        # Delay between the image being written and its results being saved
+        latencies = [
+            time.time() - image.absolute_path.stat().st_mtime
+            for image in images
+            if image.absolute_path.exists()
+        ]
+        stage_times = ", ".join(
+            f"{stage}: {round(seconds, 2)}s"
+            for stage, seconds in timings.items()
+            if stage != "total"
+        )
+        logger.info(
+            f"Processed {len(images)} images in {round(total_time.duration, 2)}s "
+            f"({stage_times}), "
+            f"latency since written: {round(max(latencies, default=0), 2)}s"
+        )
+        return timings
+
+
+class StagedPipeline:
+    """
+    Run the stages concurrently, each with its own number of worker threads,
+    connected by bounded queues of batches of image IDs.
+
+    While one batch of images is being classified, the next one is already being
+    detected. A stage that falls behind fills its queue and blocks the stages
+    before it. Each stage claims the items of its batches in the database like
+    `InferenceBaseClass.run`, so the database stays the record of what is done
+    and an interrupted run continues from the queues in the database.
+    """
+
+    # Put in the queue of a stage once for each of its workers after the last batch
+    done = None
+
+    def __init__(
+        self,
+        db_path: str,
+        image_base_path: FilePath,
+        models: Sequence[InferenceBaseClass],
+        workers: Optional[dict[str, int]] = None,
+        queue_size: int = 4,
+        timeout_seconds: float = 0.5,
+    ):
+        self.db_path = db_path
+        self.image_base_path = image_base_path
+        self.models = models
+        # Keyed by the stage of the queue of each model, 1 worker by default
+        self.workers = workers or {}
+        self.queue_size = queue_size
+        self.timeout_seconds = timeout_seconds
+        self.stop_event = threading.Event()
+        self.errors: list[Exception] = []
+        self.lock = threading.Lock()
+
+    def stop(self):
+        """
+        Stop all stages once their current batch is saved.
+        """
+        self.stop_event.set()
+
+    def num_workers(self, model: InferenceBaseClass) -> int:
+        return max(1, self.workers.get(model.queue.stage, 1))
+
+    def get(self, source: queue.Queue) -> Optional[list[int]]:
+        while not self.stop_event.is_set():
+            try:
+                return source.get(timeout=self.timeout_seconds)
+            except queue.Empty:
+                continue
+        return self.done
+
+    def put(self, target: queue.Queue, image_ids: Optional[list[int]]):
+        while not self.stop_event.is_set():
+            try:
+                target.put(image_ids, timeout=self.timeout_seconds)
+                return
+            except queue.Full:
+                continue
+
+    def feed(self, target: queue.Queue):
+        """
+        Pass the IDs of the images with items in the queue of any stage to the
+        first stage in batches. Each stage skips the images it has nothing to do for.
+        """
+        with_queued_items = sa.union(
+            *[model.queue.queued_image_ids() for model in self.models]
+        )
+        batch_size = self.models[0].batch_size
+        last_id = 0
+        try:
+            while not self.stop_event.is_set():
+                with get_session(self.db_path) as sesh:
+                    image_ids = (
+                        sesh.execute(
+                            sa.select(TrapImage.id)
+                            .where(
+                                TrapImage.id.in_(with_queued_items)
+                                & (TrapImage.id > last_id)
+                            )
+                            .order_by(TrapImage.id)
+                            .limit(batch_size)
+                        )
+                        .scalars()
+                        .all()
+                    )
+                if not image_ids:
+                    break
+                self.put(target, image_ids)
+                last_id = image_ids[-1]
+        except Exception as e:
+            self.fail(e)
+        finally:
+            for _ in range(self.num_workers(self.models[0])):
+                self.put(target, self.done)
+
+    def work(
+        self,
+        model: InferenceBaseClass,
+        source: queue.Queue,
+        target: Optional[queue.Queue],
+        remaining: list[int],
+        num_next_workers: int,
+    ):
+        """
+        Process the batches of one stage and pass them on to the next stage.
+        """
+        try:
+            while True:
+                image_ids = self.get(source)
+                if image_ids is self.done:
+                    break
+                model.run_images(image_ids)
+                if target:
+                    self.put(target, image_ids)
+        except Exception as e:
+            self.fail(e)
+        finally:
+            with self.lock:
+                remaining[0] -= 1
+                last_worker = remaining[0] == 0
+            # The next stage is done once every worker of this stage is
+            if last_worker and target:
+                for _ in range(num_next_workers):
+                    self.put(target, self.done)
+
+    def fail(self, error: Exception):
+        logger.exception(f"Stopping the pipeline: {error}")
+        self.errors.append(error)
+        self.stop()
+
+    def run(self):
+        """
+        Process all queued images and wait until every stage is done.
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.models]
+        threads = [
+            threading.Thread(
+                target=self.feed, args=(queues[0],), name="Pipeline feeder"
+            )
+        ]
+        for i, model in enumerate(self.models):
+            is_last = i + 1 == len(self.models)
+            num_workers = self.num_workers(model)
+            num_next_workers = 0 if is_last else self.num_workers(self.models[i + 1])
+            remaining = [num_workers]
+            logger.info(f"Starting {num_workers} workers for {model.name}")
+            for j in range(num_workers):
+                threads.append(
+                    threading.Thread(
+                        target=self.work,
+                        args=(
+                            model,
+                            queues[i],
+                            None if is_last else queues[i + 1],
+                            remaining,
+                            num_next_workers,
+                        ),
+                        name=f"{model.queue.stage} worker {j + 1}",
+                    )
+                )
+
+        with StopWatch() as t:
+            for thread in threads:
+                thread.start()
+            try:
+                for thread in threads:
+                    # With a timeout, so the main thread can be interrupted
+                    while thread.is_alive():
+                        thread.join(self.timeout_seconds)
+            except KeyboardInterrupt:
+                logger.info("Stopping the pipeline after the current batches")
+                self.stop()
+                for thread in threads:
+                    thread.join()
+                raise
+        if self.errors:
+            raise self.errors[0]
+        logger.info(f"Pipeline done in {round(t.duration, 2)}s")
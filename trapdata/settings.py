@@ -1,4 +1,5 @@
 import sys
+import enum
 from functools import lru_cache
 from typing import Union, Optional
 import configparser
@@ -30,6 +31,18 @@ class Settings(BaseSettings):
     localization_batch_size: int = 2
     classification_batch_size: int = 20
     num_workers: int = 1
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+    database_pool_pre_ping: bool = True
+    database_lock_retries: int = 5
+    database_lock_retry_delay: float = 0.1
+    sqlite_journal_mode: str = "wal"
+    sqlite_synchronous: str = "normal"
+    sqlite_mmap_size: int = 256 * 1024 * 1024
+    sqlite_cache_size: int = -64 * 1024
+    sqlite_temp_store: str = "memory"
+    sqlite_busy_timeout: float = 10
+    crop_cache_size: int = 0
 
     @validator("image_base_path", "user_data_path")
     def validate_path(cls, v):
@@ -48,6 +61,34 @@ class Settings(BaseSettings):
     def validate_database_dsn(cls, v):
         return sqlalchemy.engine.url.make_url(v)
 
+    def get(self, section: str, key: str):
+        """
+        Read a setting the same way as the config of the Kivy app, so the settings
+        can be passed to the pipeline as its config.
+        """
+        value = getattr(self, key)
+        if isinstance(value, enum.Enum):
+            return value.value
+        return value
+
+    def database_options(self) -> dict:
+        """
+        Options for `trapdata.db.configure_engines`
+        """
+        return {
+            "pool_size": self.database_pool_size,
+            "max_overflow": self.database_max_overflow,
+            "pool_pre_ping": self.database_pool_pre_ping,
+            "lock_retries": self.database_lock_retries,
+            "lock_retry_delay": self.database_lock_retry_delay,
+            "sqlite_journal_mode": self.sqlite_journal_mode,
+            "sqlite_synchronous": self.sqlite_synchronous,
+            "sqlite_mmap_size": self.sqlite_mmap_size,
+            "sqlite_cache_size": self.sqlite_cache_size,
+            "sqlite_temp_store": self.sqlite_temp_store,
+            "sqlite_busy_timeout": self.sqlite_busy_timeout,
+        }
+
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
@@ -135,6 +176,78 @@ class Settings(BaseSettings):
                 "kivy_type": "numeric",
                 "kivy_section": "performance",
             },
+            "database_pool_size": {
+                "title": "Database connection pool size",
+                "description": "Number of connections kept open to a PostgreSQL server. Not used for SQLite.",
+                "kivy_type": "numeric",
+                "kivy_section": "performance",
+            },
+            "database_max_overflow": {
+                "title": "Database connection pool overflow",
+                "description": "Number of extra connections that may be opened to a PostgreSQL server when the pool is busy. Not used for SQLite.",
+                "kivy_type": "numeric",
+                "kivy_section": "performance",
+            },
+            "database_pool_pre_ping": {
+                "title": "Test database connections before use",
+                "description": "Detect connections to a PostgreSQL server that were dropped while idle. Not used for SQLite.",
+                "kivy_type": "bool",
+                "kivy_section": "performance",
+            },
+            "database_lock_retries": {
+                "title": "Database lock retries",
+                "description": "Number of times to retry saving results when the database is locked by another process.",
+                "kivy_type": "numeric",
+                "kivy_section": "performance",
+            },
+            "database_lock_retry_delay": {
+                "title": "Database lock retry delay",
+                "description": "Number of seconds to wait before the first retry when the database is locked. The delay doubles after each retry.",
+                "kivy_type": "numeric",
+                "kivy_section": "performance",
+            },
+            "sqlite_journal_mode": {
+                "title": "SQLite journal mode",
+                "description": "WAL lets the interface read results while the models are saving new ones. One of: delete, truncate, persist, memory, wal, off.",
+                "kivy_type": "string",
+                "kivy_section": "performance",
+            },
+            "sqlite_synchronous": {
+                "title": "SQLite synchronous mode",
+                "description": "How often SQLite waits for data to be written to disk. NORMAL is safe in WAL mode. One of: off, normal, full, extra.",
+                "kivy_type": "string",
+                "kivy_section": "performance",
+            },
+            "sqlite_mmap_size": {
+                "title": "SQLite memory-mapped I/O size",
+                "description": "Maximum number of bytes of the database file to memory-map. Use 0 to disable.",
+                "kivy_type": "numeric",
+                "kivy_section": "performance",
+            },
+            "sqlite_cache_size": {
+                "title": "SQLite page cache size",
+                "description": "Positive values are a number of pages, negative values are a size in KiB (e.g. -65536 for 64MB).",
+                "kivy_type": "numeric",
+                "kivy_section": "performance",
+            },
+            "sqlite_temp_store": {
+                "title": "SQLite temporary storage",
+                "description": "Where SQLite keeps temporary tables and indices used for sorting. One of: default, file, memory.",
+                "kivy_type": "string",
+                "kivy_section": "performance",
+            },
+            "sqlite_busy_timeout": {
+                "title": "SQLite busy timeout",
+                "description": "Number of seconds to wait for another process to finish writing before giving up.",
+                "kivy_type": "numeric",
+                "kivy_section": "performance",
+            },
+            "crop_cache_size": {
+                "title": "Crop cache size",
+                "description": "Number of bytes of decoded crops kept in memory after detection, so the classifiers don't read them from disk again. Only used when the stages run in the same process. Use 0 to disable.",
+                "kivy_type": "numeric",
+                "kivy_section": "performance",
+            },
         }
 
         @classmethod
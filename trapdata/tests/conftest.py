@@ -0,0 +1,179 @@
+"""
+Fixtures shared by the tests. The databases, images and crops they create are
+in the temporary directory of each test, which pytest cleans up.
+"""
+
+import pathlib
+import datetime
+
+import pytest
+import PIL.Image
+import torch
+import torchvision
+
+from trapdata.db import Base
+from trapdata.db.base import get_engine, dispose_engines
+from trapdata.db.models.events import get_or_create_monitoring_sessions
+from trapdata.db.models.queue import ImageQueue
+from trapdata.common.filemanagement import construct_exif
+from trapdata.ml.models.localization import ObjectDetector
+from trapdata.ml.models.classification import (
+    BinaryClassifier,
+    SpeciesClassifier,
+    EfficientNetClassifier,
+)
+from trapdata.ml.models.tracking import FeatureExtractor
+
+# Models with fixed outputs, so no weights are downloaded
+
+
+class FixedObjectDetector(ObjectDetector):
+    name = "Fixed object detector"
+
+    def get_model(self):
+        return lambda batch: [[[5, 5, 25, 20]] for _ in batch]
+
+
+class FixedBinaryClassifier(BinaryClassifier):
+    name = "Fixed binary classifier"
+    input_size = 8
+
+    def get_labels(self, labels_path):
+        return {0: "nonmoth", 1: "moth"}
+
+    def get_model(self):
+        return lambda batch: torch.tensor([[0.0, 1.0]] * len(batch))
+
+
+class FixedSpeciesClassifier(SpeciesClassifier, EfficientNetClassifier):
+    name = "Fixed species classifier"
+    input_size = 8
+
+    def get_labels(self, labels_path):
+        return {0: "Actias luna", 1: "Other"}
+
+    def get_model(self):
+        return lambda batch: torch.tensor([[1.0, 0.0]] * len(batch))
+
+
+class FixedFeatureExtractor(FeatureExtractor):
+    name = "Fixed feature extractor"
+    input_size = 8
+
+    def get_transforms(self):
+        return torchvision.transforms.Compose(
+            [
+                torchvision.transforms.Resize((self.input_size, self.input_size)),
+                torchvision.transforms.ToTensor(),
+            ]
+        )
+
+    def get_model(self):
+        return lambda batch: torch.ones(len(batch), 4)
+
+
+def _save_test_image(
+    directory,
+    name,
+    offset=None,
+    exif=True,
+    timestamp=datetime.datetime(2022, 6, 22, 20, 4, 0),
+    **kwargs,
+) -> pathlib.Path:
+    img = PIL.Image.new("RGB", (40, 30))
+    path = pathlib.Path(directory) / name
+    if exif:
+        other_tags = {"TimeZoneOffset": offset} if offset is not None else None
+        exif_data = construct_exif(
+            timestamp=timestamp,
+            other_tags=other_tags,
+        )
+        img.save(path, exif=exif_data, **kwargs)
+    else:
+        img.save(path, **kwargs)
+    return path
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """
+    The URL of a new SQLite database with all of the tables.
+    """
+    url = f"sqlite+pysqlite:///{tmp_path / 'trapdata.db'}"
+    Base.metadata.create_all(get_engine(url))
+    yield url
+    # Close the connections before the file is removed
+    dispose_engines()
+
+
+@pytest.fixture
+def image_directory(tmp_path) -> pathlib.Path:
+    directory = tmp_path / "images"
+    directory.mkdir()
+    return directory
+
+
+@pytest.fixture
+def user_data_path(tmp_path) -> pathlib.Path:
+    directory = tmp_path / "user_data"
+    directory.mkdir()
+    return directory
+
+
+@pytest.fixture
+def save_test_image():
+    """
+    Return a function that saves a small JPEG with the EXIF tags of a trap camera,
+    e.g. `save_test_image(directory, "0.jpg", timestamp=...)`.
+    """
+    return _save_test_image
+
+
+@pytest.fixture
+def queue_images(db_path, image_directory):
+    """
+    Return a function that saves a number of images a minute apart to the image
+    directory, adds them to a monitoring session and queues them.
+    """
+
+    def queue(num_images: int):
+        night = datetime.datetime(2022, 6, 22, 21, 0)
+        for i in range(num_images):
+            _save_test_image(
+                image_directory,
+                f"{i}.jpg",
+                timestamp=night + datetime.timedelta(minutes=i),
+            )
+        get_or_create_monitoring_sessions(db_path, image_directory)
+        ImageQueue(db_path, image_directory).add_unprocessed()
+
+    return queue
+
+
+@pytest.fixture
+def fixed_models(db_path, image_directory, user_data_path):
+    """
+    Return a function that loads the models with fixed outputs for the test
+    database and image directory, in the order of the pipeline. Its arguments
+    are passed to each model, e.g. `fixed_models(batch_size=2)`.
+    """
+
+    def load(**kwargs):
+        kwargs = dict(
+            db_path=db_path,
+            image_base_path=image_directory,
+            user_data_path=user_data_path,
+            single=True,
+            **kwargs,
+        )
+        return [
+            Model(**kwargs)
+            for Model in (
+                FixedObjectDetector,
+                FixedBinaryClassifier,
+                FixedSpeciesClassifier,
+                FixedFeatureExtractor,
+            )
+        ]
+
+    return load
@@ -0,0 +1,81 @@
+"""
+Check the query plans of the statements executed against a SQLite test database.
+"""
+
+import contextlib
+
+import sqlalchemy as sa
+
+from trapdata import logger
+from trapdata.db.base import get_engine
+
+# The indexes of each table that the application queries rely on
+INDEXES = {
+    "monitoring_sessions": {"ix_monitoring_sessions_base_directory_day"},
+    "images": {
+        "ix_images_monitoring_session_id_timestamp",
+        "ix_images_timestamp",
+        "ix_images_queued",
+        "ix_images_unprocessed",
+    },
+    "detections": {
+        "ix_detections_image_id",
+        "ix_detections_monitoring_session_id_binary_label",
+        "ix_detections_sequence_id_sequence_frame",
+        "ix_detections_queued",
+        "ix_detections_without_features",
+        "ix_detections_canonical",
+        "ix_detections_updated_at",
+    },
+    "jobs": {"ix_jobs_stage_status_lease_expires_at"},
+    "tracks": {"ix_tracks_sequence_id", "ix_tracks_monitoring_session_id"},
+    "manifest_files": {"ix_manifest_files_base_directory_path"},
+}
+
+
+@contextlib.contextmanager
+def capture_queries(db_path):
+    """
+    Collect every SELECT & UPDATE statement (with its parameters) executed
+    by the engine, so the query plans of the real application queries can be checked.
+    """
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "UPDATE")):
+            statements.append((statement, parameters))
+
+    engine = get_engine(db_path)
+    sa.event.listen(engine, "before_cursor_execute", capture)
+    try:
+        yield statements
+    finally:
+        sa.event.remove(engine, "before_cursor_execute", capture)
+
+
+def query_plan(db_path, statement, parameters) -> list[str]:
+    with get_engine(db_path).connect() as conn:
+        cursor = conn.connection.cursor()
+        rows = cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        return [row[-1] for row in rows.fetchall()]
+
+
+def assert_no_table_scans(db_path, statements):
+    for statement, parameters in statements:
+        plan = query_plan(db_path, statement, parameters)
+        logger.debug("\n".join([statement, *plan]))
+        for step in plan:
+            for table in INDEXES:
+                assert not step.startswith(f"SCAN {table}"), (
+                    f"Full table scan of '{table}' in query:\n{statement}\n"
+                    + "\n".join(plan)
+                )
+
+
+def indexes_used(db_path, statements) -> set[str]:
+    used = set()
+    all_indexes = set.union(*INDEXES.values())
+    for statement, parameters in statements:
+        for step in query_plan(db_path, statement, parameters):
+            used |= {name for name in all_indexes if f"INDEX {name} " in f"{step} "}
+    return used
@@ -0,0 +1,120 @@
+import os
+import sqlite3
+import datetime
+from unittest import mock
+
+import pytest
+import PIL.Image
+
+from trapdata.db.base import get_session
+from trapdata.db.models.detections import DetectedObject, save_detected_objects
+from trapdata.db.models.events import get_or_create_monitoring_sessions
+from trapdata.db.models.images import TrapImage
+from trapdata.common.cache import ImageCache, crop_cache, frame_cache, load_image
+
+
+def test_image_cache():
+    image = PIL.Image.new("RGB", (10, 10))  # 300 bytes
+    cache = ImageCache(max_bytes=700)
+    for key in "abc":
+        cache.put(key, image)
+    assert list(cache.images) == ["b", "c"]
+    assert cache.num_bytes == 600
+
+    assert cache.get("b") is image
+    cache.put("d", image)
+    assert list(cache.images) == ["b", "d"]
+    assert cache.get("c") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Larger than the whole cache
+    cache.put("e", PIL.Image.new("RGB", (20, 20)))
+    assert "e" not in cache
+
+    cache.resize(300)
+    assert list(cache.images) == ["d"]
+    cache.resize(0)
+    assert len(cache) == 0
+    assert cache.get("d") is None
+
+
+def test_crops_are_cached(db_path, image_directory, user_data_path, save_test_image):
+    save_test_image(image_directory, "0.jpg", timestamp=datetime.datetime(2022, 6, 22))
+    get_or_create_monitoring_sessions(db_path, image_directory)
+    with get_session(db_path) as sesh:
+        image_id = sesh.query(TrapImage.id).scalar()
+
+    def load_crop(path):
+        # The crops are decoded again before the database is locked
+        conn = sqlite3.connect(db_path.split("///", 1)[1], timeout=0)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.rollback()
+        finally:
+            conn.close()
+        return load_image(path)
+
+    crop_cache.resize(10 * 1024 * 1024)
+    try:
+        with mock.patch("trapdata.db.models.detections.load_image", load_crop):
+            save_detected_objects(
+                db_path,
+                [image_id],
+                [[{"bbox": [0, 0, 10, 10]}, {"bbox": [5, 5, 25, 20]}]],
+                user_data_path=user_data_path,
+            )
+        with get_session(db_path) as sesh:
+            objs = sesh.query(DetectedObject).order_by(DetectedObject.id).all()
+        assert len(crop_cache) == 2
+
+        # The cached crops are the same as the ones read from their files
+        for obj in objs:
+            cached = obj.cropped_image_data()
+            crop_cache.pop(obj.path)
+            assert cached.tobytes() == obj.cropped_image_data().tobytes()
+            crop_cache.put(obj.path, cached)
+
+        # The crops are read from memory, not from their files
+        for obj in objs:
+            os.unlink(obj.path)
+        assert [obj.cropped_image_data().size for obj in objs] == [(10, 10), (20, 15)]
+    finally:
+        crop_cache.resize(0)
+
+
+def test_source_image_decoded_once(
+    db_path, image_directory, user_data_path, save_test_image
+):
+    source_path = save_test_image(
+        image_directory, "0.jpg", timestamp=datetime.datetime(2022, 6, 22)
+    )
+    get_or_create_monitoring_sessions(db_path, image_directory)
+    with get_session(db_path) as sesh:
+        image_id = sesh.query(TrapImage.id).scalar()
+
+    frame_cache.clear()
+    bboxes = [[0, 0, 10, 10], [5, 5, 25, 20], [10, 10, 30, 30]]
+    with mock.patch("PIL.Image.open", wraps=PIL.Image.open) as open_image:
+        save_detected_objects(
+            db_path,
+            [image_id],
+            [[{"bbox": bbox} for bbox in bboxes]],
+            user_data_path=user_data_path,
+        )
+    opened = [str(call.args[0]) for call in open_image.call_args_list]
+    assert opened.count(str(source_path)) == 1
+
+    with get_session(db_path) as sesh:
+        objs = sesh.query(DetectedObject).all()
+        assert len(objs) == len(bboxes)
+        for obj in objs:
+            exif = PIL.Image.open(obj.path).getexif()
+            assert exif[270] == "Source image: 0.jpg"  # ImageDescription
+
+
+def run():
+    pytest.main([__file__])
+
+
+if __name__ == "__main__":
+    run()
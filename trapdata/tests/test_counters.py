@@ -0,0 +1,125 @@
+import pathlib
+
+import pytest
+import sqlalchemy as sa
+
+from trapdata.db.base import get_session
+from trapdata.db.models.counters import (
+    StageCounter,
+    get_stage_counters,
+    reconcile_stage_counters,
+)
+from trapdata.db.models.events import (
+    MonitoringSession,
+    get_or_create_monitoring_sessions,
+)
+from trapdata.db.models.detections import (
+    save_detected_objects,
+    save_classified_objects,
+    delete_objects_for_image,
+)
+from trapdata.db.models.queue import (
+    all_queues,
+    queue_status,
+    add_image_to_queue,
+    clear_all_queues,
+)
+from trapdata.ml.models.tracking import find_all_tracks
+
+
+IMAGE_BASE_DIRECTORY = pathlib.Path(__file__).parent / "images" / "vermont"
+
+
+def assert_counters_match(db_path):
+    """
+    The incrementally updated counters are the same as a full count.
+    """
+    assert get_stage_counters(db_path, IMAGE_BASE_DIRECTORY) == queue_status(
+        db_path, IMAGE_BASE_DIRECTORY
+    )
+
+
+def test_counters_follow_pipeline(db_path, user_data_path):
+    get_or_create_monitoring_sessions(db_path, IMAGE_BASE_DIRECTORY)
+    assert_counters_match(db_path)
+
+    queues = all_queues(db_path, IMAGE_BASE_DIRECTORY)
+    for queue in queues.values():
+        queue.add_unprocessed()
+    assert_counters_match(db_path)
+
+    image_queue = queues["Unprocessed images"]
+    images = image_queue.pull_n_from_queue(2)
+    image_ids = [image.id for image in images]
+    save_detected_objects(
+        db_path,
+        image_ids,
+        [
+            [{"bbox": [0, 0, 10, 10]}, {"bbox": [10, 10, 30, 30]}],
+            [{"bbox": [5, 5, 20, 20]}],
+        ],
+        user_data_path=user_data_path,
+    )
+    image_queue.complete(image_ids)
+    assert_counters_match(db_path)
+
+    # Detecting the same bounding box again replaces the previous detection
+    save_detected_objects(
+        db_path,
+        image_ids[:1],
+        [[{"bbox": [0, 0, 10, 10]}]],
+        user_data_path=user_data_path,
+        delete_existing=False,
+    )
+    assert_counters_match(db_path)
+
+    object_ids = queues["Detected objects"].claim(10)
+    save_classified_objects(
+        db_path,
+        object_ids,
+        [{"binary_label": "moth", "in_queue": True} for _ in object_ids],
+    )
+    assert_counters_match(db_path)
+
+    object_ids = queues["Detections without features"].claim(10)
+    save_classified_objects(
+        db_path,
+        object_ids,
+        [{"cnn_features": [1.0, 0.0]} for _ in object_ids],
+    )
+    assert_counters_match(db_path)
+
+    with get_session(db_path) as sesh:
+        for event in sesh.execute(sa.select(MonitoringSession)).scalars():
+            find_all_tracks(monitoring_session=event, session=sesh)
+    assert_counters_match(db_path)
+
+    delete_objects_for_image(db_path, image_ids[1])
+    add_image_to_queue(db_path, image_ids[1])
+    assert_counters_match(db_path)
+
+    clear_all_queues(db_path, IMAGE_BASE_DIRECTORY)
+    assert_counters_match(db_path)
+
+
+def test_reconcile_counters(db_path):
+    get_or_create_monitoring_sessions(db_path, IMAGE_BASE_DIRECTORY)
+    expected = get_stage_counters(db_path, IMAGE_BASE_DIRECTORY)
+
+    with get_session(db_path) as sesh:
+        sesh.execute(sa.update(StageCounter).values({"done": 100}))
+        sesh.commit()
+    assert get_stage_counters(db_path, IMAGE_BASE_DIRECTORY) != expected
+
+    with get_session(db_path) as sesh:
+        reconcile_stage_counters(sesh)
+        sesh.commit()
+    assert get_stage_counters(db_path, IMAGE_BASE_DIRECTORY) == expected
+
+
+def run():
+    pytest.main([__file__])
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,333 @@
+import io
+import json
+import pathlib
+import sqlite3
+import datetime
+from unittest import mock
+
+import pytest
+import sqlalchemy as sa
+
+from trapdata.db.base import get_engine, get_session
+from trapdata.db.models.detections import (
+    DetectedObject,
+    save_detected_objects,
+    save_classified_objects,
+    iter_detection_reports,
+    get_object_counts_for_image,
+    get_object_counts_for_images,
+    get_objects_for_image,
+    get_detections_for_image,
+    get_classifications_for_image,
+    get_species_for_image,
+)
+from trapdata.db.models.images import TrapImage, completely_classified
+from trapdata.db.models.events import (
+    MonitoringSession,
+    get_or_create_monitoring_sessions,
+)
+from trapdata.common.utils import write_records
+
+IMAGE_BASE_DIRECTORY = pathlib.Path(__file__).parent / "images" / "vermont"
+
+
+def test_save_detected_objects_batch(db_path, user_data_path):
+    get_or_create_monitoring_sessions(db_path, IMAGE_BASE_DIRECTORY)
+    with get_session(db_path) as sesh:
+        image_ids = (
+            sesh.execute(sa.select(TrapImage.id).order_by(TrapImage.timestamp))
+            .scalars()
+            .all()
+        )
+    assert len(image_ids) >= 2
+
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = get_engine(db_path)
+    sa.event.listen(engine, "before_cursor_execute", capture)
+    try:
+        # The data follows the order of the IDs, not the order of the images in the DB
+        save_detected_objects(
+            db_path,
+            list(reversed(image_ids)),
+            [
+                [{"bbox": [0, 0, 10, 10]}],
+                [{"bbox": [0, 0, 10, 10]}, {"bbox": [5, 5, 20, 20]}],
+            ],
+            user_data_path=user_data_path,
+        )
+    finally:
+        sa.event.remove(engine, "before_cursor_execute", capture)
+
+    inserts = [stmt for stmt in statements if stmt.startswith("INSERT INTO detections")]
+    assert len(inserts) == 1
+
+    with get_session(db_path) as sesh:
+        objs = sesh.execute(sa.select(DetectedObject)).unique().scalars().all()
+        counts = {image_id: 0 for image_id in image_ids}
+        for obj in objs:
+            counts[obj.image_id] += 1
+            assert obj.canonical
+            assert obj.area_pixels
+            assert pathlib.Path(obj.path).exists()
+        assert counts[image_ids[0]] == 2
+        assert counts[image_ids[1]] == 1
+
+        first = [obj for obj in objs if obj.image_id == image_ids[0]][0]
+        second = [obj for obj in objs if obj.image_id == image_ids[1]][0]
+        assert first.source_image_previous_frame is None
+        assert second.source_image_previous_frame == image_ids[0]
+
+        images = sesh.execute(sa.select(TrapImage)).unique().scalars().all()
+        assert all(image.last_processed and not image.in_queue for image in images)
+
+    # Detecting again replaces the previous detection of the same bounding box
+    save_detected_objects(
+        db_path,
+        image_ids[:1],
+        [[{"bbox": [0, 0, 10, 10]}]],
+        user_data_path=user_data_path,
+        delete_existing=False,
+    )
+    with get_session(db_path) as sesh:
+        bboxes = sesh.execute(
+            sa.select(DetectedObject.bbox, DetectedObject.canonical)
+            .where(DetectedObject.image_id == image_ids[0])
+            .order_by(DetectedObject.id)
+        ).all()
+        assert [tuple(row) for row in bboxes] == [
+            ([0, 0, 10, 10], False),
+            ([5, 5, 20, 20], True),
+            ([0, 0, 10, 10], True),
+        ]
+
+    # Or deletes all of the existing detections
+    save_detected_objects(db_path, image_ids[:1], [[]], user_data_path=user_data_path)
+    with get_session(db_path) as sesh:
+        count = sesh.execute(
+            sa.select(sa.func.count(DetectedObject.id)).where(
+                DetectedObject.image_id == image_ids[0]
+            )
+        ).scalar()
+        assert count == 0
+
+
+def test_crops_saved_without_lock(db_path, user_data_path):
+    get_or_create_monitoring_sessions(db_path, IMAGE_BASE_DIRECTORY)
+    with get_session(db_path) as sesh:
+        image_id = sesh.execute(sa.select(TrapImage.id)).scalars().first()
+
+    save_crop = DetectedObject.save_cropped_image_data
+
+    def save_crop_and_write(self, *args, **kwargs):
+        # Another connection can write while the crops are saved
+        conn = sqlite3.connect(db_path.split("///", 1)[1], timeout=0)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.rollback()
+        finally:
+            conn.close()
+        return save_crop(self, *args, **kwargs)
+
+    with mock.patch.object(
+        DetectedObject, "save_cropped_image_data", save_crop_and_write
+    ):
+        save_detected_objects(
+            db_path,
+            [image_id],
+            [[{"bbox": [0, 0, 10, 10]}]],
+            user_data_path=user_data_path,
+        )
+    with get_session(db_path) as sesh:
+        assert sesh.execute(sa.select(sa.func.count(DetectedObject.id))).scalar() == 1
+
+
+def test_save_classified_objects_by_id(db_path):
+    with get_session(db_path) as sesh:
+        objs = [DetectedObject(bbox=[i, i, 10, 10], in_queue=True) for i in range(3)]
+        sesh.add_all(objs)
+        sesh.commit()
+        object_ids = [obj.id for obj in objs]
+
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = get_engine(db_path)
+    sa.event.listen(engine, "before_cursor_execute", capture)
+    try:
+        # The data follows the order of the IDs, not the order of the objects in the DB
+        save_classified_objects(
+            db_path,
+            list(reversed(object_ids)),
+            [{"binary_label": f"label {i}", "in_queue": False} for i in range(3)],
+        )
+    finally:
+        sa.event.remove(engine, "before_cursor_execute", capture)
+
+    updates = [stmt for stmt in statements if stmt.startswith("UPDATE detections")]
+    assert len(updates) == 1
+    # Only the changed columns are written
+    assert "bbox" not in updates[0]
+
+    with get_session(db_path) as sesh:
+        rows = sesh.execute(
+            sa.select(
+                DetectedObject.binary_label,
+                DetectedObject.in_queue,
+                DetectedObject.bbox,
+            ).order_by(DetectedObject.id)
+        ).all()
+        assert [tuple(row) for row in rows] == [
+            ("label 2", False, [0, 0, 10, 10]),
+            ("label 1", False, [1, 1, 10, 10]),
+            ("label 0", False, [2, 2, 10, 10]),
+        ]
+
+
+def test_iter_detection_reports(db_path):
+    with get_session(db_path) as sesh:
+        now = datetime.datetime.now()
+        ms = MonitoringSession(base_directory="/tmp/trap", day=now.date())
+        other = MonitoringSession(base_directory="/tmp/other", day=now.date())
+        image = TrapImage(
+            monitoring_session=ms, base_path="/tmp/trap", path="a.jpg", timestamp=now
+        )
+        other_image = TrapImage(
+            monitoring_session=other, base_path="/tmp/other", path="b.jpg"
+        )
+        objs = [
+            DetectedObject(
+                image=image if i % 3 else other_image,
+                monitoring_session=ms if i % 3 else other,
+                bbox=[i, i, 10, 10],
+                binary_label="moth",
+                specific_label="Actias luna" if i % 2 else None,
+            )
+            for i in range(10)
+        ]
+        sesh.add_all([ms, other, image, other_image, *objs])
+        sesh.commit()
+        expected = [
+            obj.report_data() for obj in objs if obj.monitoring_session_id == ms.id
+        ]
+
+    # Pages smaller than the export are read one after another
+    reports = list(iter_detection_reports(db_path, "/tmp/trap", batch_size=2))
+    assert reports == expected
+
+    reports = list(
+        iter_detection_reports(db_path, "/tmp/trap", limit=3, offset=1, batch_size=2)
+    )
+    assert reports == expected[1:4]
+
+    after_id = expected[2]["id"]
+    reports = list(iter_detection_reports(db_path, "/tmp/trap", after_id=after_id))
+    assert reports == expected[3:]
+
+
+def test_write_records_resume():
+    records = [{"id": i, "bbox": [i, i, 10, 10], "label": None} for i in range(3)]
+
+    f = io.StringIO()
+    assert write_records(records[:2], f, format="csv") == 2
+    write_records(records[2:], f, format="csv", header=False)
+    lines = f.getvalue().splitlines()
+    assert lines[0] == '"id","bbox","label"'
+    assert lines[1:] == [
+        '0,"[0, 0, 10, 10]",""',
+        '1,"[1, 1, 10, 10]",""',
+        '2,"[2, 2, 10, 10]",""',
+    ]
+
+    f = io.StringIO()
+    write_records(records[:1], f, format="jsonl")
+    write_records(records[1:], f, format="jsonl")
+    assert [json.loads(line) for line in f.getvalue().splitlines()] == records
+
+    f = io.StringIO()
+    assert write_records(iter(records), f, format="json") == 3
+    assert json.loads(f.getvalue()) == records
+    f = io.StringIO()
+    write_records([], f, format="json")
+    assert json.loads(f.getvalue()) == []
+
+
+def test_object_counts_for_images(db_path):
+    with get_session(db_path) as sesh:
+        now = datetime.datetime.now()
+        ms = MonitoringSession(base_directory="/tmp", day=now.date())
+        empty = TrapImage(monitoring_session=ms, path="empty.jpg")
+        queued = TrapImage(
+            monitoring_session=ms, path="queued.jpg", last_processed=now, in_queue=True
+        )
+        partial = TrapImage(
+            monitoring_session=ms, path="partial.jpg", last_processed=now
+        )
+        complete = TrapImage(
+            monitoring_session=ms, path="complete.jpg", last_processed=now
+        )
+        images = [empty, queued, partial, complete]
+        labels = {
+            queued: [("moth", "Actias luna")],
+            partial: [("moth", "Actias luna"), ("moth", None), ("nonmoth", None)],
+            complete: [
+                ("moth", "Actias luna"),
+                ("moth", "Actias luna"),
+                ("moth", "Catocala relicta"),
+                ("nonmoth", None),
+            ],
+        }
+        objs = [
+            DetectedObject(
+                image=image,
+                monitoring_session=ms,
+                binary_label=binary_label,
+                specific_label=specific_label,
+            )
+            for image, image_labels in labels.items()
+            for binary_label, specific_label in image_labels
+        ]
+        sesh.add_all([ms, *images, *objs])
+        sesh.commit()
+        image_ids = [image.id for image in images]
+
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = get_engine(db_path)
+    sa.event.listen(engine, "before_cursor_execute", capture)
+    try:
+        counts = get_object_counts_for_images(db_path, image_ids + [1000])
+    finally:
+        sa.event.remove(engine, "before_cursor_execute", capture)
+    assert len(statements) == 1
+
+    # The same results as counting each statistic separately
+    for image_id in image_ids + [1000]:
+        assert counts[image_id] == {
+            "num_objects": get_objects_for_image(db_path, image_id).count(),
+            "num_detections": get_detections_for_image(db_path, image_id).count(),
+            "num_species": get_species_for_image(db_path, image_id).count(),
+            "num_classifications": get_classifications_for_image(
+                db_path, image_id
+            ).count(),
+            "completely_classified": completely_classified(db_path, image_id),
+        }
+        assert get_object_counts_for_image(db_path, image_id) == counts[image_id]
+    assert counts[image_ids[3]]["num_species"] == 2
+    assert counts[image_ids[3]]["completely_classified"]
+
+
+def run():
+    pytest.main([__file__])
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,178 @@
+import datetime
+
+import pytest
+
+from trapdata.db.base import get_session
+from trapdata.db.models.events import (
+    MonitoringSession,
+    save_monitoring_session,
+    get_monitoring_sessions_from_db,
+    get_monitoring_session_by_date,
+)
+from trapdata.db.models.images import TrapImage
+from trapdata.db.models.detections import (
+    DetectedObject,
+    save_detected_objects,
+    delete_objects_for_image,
+)
+from trapdata.tests.query_plans import capture_queries, assert_no_table_scans
+
+
+def create_events(db_path, base_directory, num_events, num_images):
+    with get_session(db_path) as sesh:
+        start = datetime.datetime(2023, 3, 1, 22)
+        for day in range(num_events):
+            ms = MonitoringSession(
+                base_directory=base_directory,
+                day=(start + datetime.timedelta(days=day)).date(),
+            )
+            images = [
+                TrapImage(
+                    monitoring_session=ms,
+                    path=f"{day}/{i}.jpg",
+                    timestamp=start + datetime.timedelta(days=day, minutes=i),
+                )
+                for i in range(num_images)
+            ]
+            objs = [
+                DetectedObject(image=image, monitoring_session=ms, bbox=[0, 0, 1, 1])
+                for image in images[day:]
+            ]
+            sesh.add_all([ms, *images, *objs])
+        sesh.commit()
+
+
+def test_update_all_aggregates(db_path):
+    create_events(db_path, "/deployment", num_events=3, num_images=4)
+    create_events(db_path, "/other", num_events=1, num_images=2)
+    with get_session(db_path) as sesh:
+        # An event without any images
+        sesh.add(MonitoringSession(base_directory="/deployment"))
+        # Stale cached values
+        sesh.query(MonitoringSession).update(
+            {"num_images": None, "num_detected_objects": None, "start_time": None}
+        )
+        sesh.commit()
+
+    # Reading the events does not write to the database
+    with capture_queries(db_path) as statements:
+        cached = get_monitoring_sessions_from_db(db_path, "/deployment")
+    assert not any("UPDATE" in stmt for stmt, _ in statements)
+    assert [event.num_images for event in cached] == [None] * 4
+
+    with capture_queries(db_path) as statements:
+        events = get_monitoring_sessions_from_db(
+            db_path, "/deployment", update_aggregates=True
+        )
+
+    # One grouped query and one UPDATE for all of the events, then the list
+    assert len(statements) == 3
+    selects = [(stmt, params) for stmt, params in statements if "UPDATE" not in stmt]
+    assert_no_table_scans(db_path, selects)
+    events = sorted(events, key=lambda event: event.id)
+    assert [event.num_images for event in events] == [4, 4, 4, 0]
+    assert [event.num_detected_objects for event in events] == [4, 3, 2, 0]
+    for event in events[:3]:
+        assert event.duration() == datetime.timedelta(minutes=3)
+    assert events[3].start_time is None
+
+    # The other deployment is left as it was
+    [other] = get_monitoring_sessions_from_db(db_path, "/other")
+    assert other.num_images is None
+
+    [event] = get_monitoring_session_by_date(
+        db_path, [datetime.date(2023, 3, 1)], "/other", update_aggregates=True
+    )
+    assert (event.num_images, event.num_detected_objects) == (2, 2)
+
+    with get_session(db_path) as sesh:
+        event = sesh.get(MonitoringSession, event.id)
+        sesh.add(TrapImage(monitoring_session=event, path="new.jpg"))
+        sesh.flush()
+        event.update_aggregates(sesh)
+        assert event.num_images == 3
+
+
+def scanned_session(base_directory, num_images, filesize=100):
+    start = datetime.datetime(2023, 3, 1, 22)
+    images = [
+        {
+            "path": f"{base_directory}/{i}.jpg",
+            "timestamp": start + datetime.timedelta(minutes=i),
+            "filesize": filesize,
+            "shape": (640, 480),
+        }
+        for i in range(num_images)
+    ]
+    return {
+        "base_directory": base_directory,
+        "day": start.date(),
+        "num_images": num_images,
+        "images": images,
+    }
+
+
+def test_save_monitoring_session(db_path):
+    session = scanned_session("/deployment", 50)
+    with capture_queries(db_path) as statements:
+        save_monitoring_session(db_path, "/deployment", session)
+    # The existing images are not looked up one at a time
+    assert len(statements) < 10
+
+    with get_session(db_path) as sesh:
+        images = sesh.query(TrapImage).order_by(TrapImage.timestamp).all()
+        assert [image.path for image in images] == [f"{i}.jpg" for i in range(50)]
+        assert {image.base_path for image in images} == {"/deployment"}
+        assert (images[0].width, images[0].height) == (640, 480)
+        [event] = sesh.query(MonitoringSession).all()
+        assert event.num_images == 50
+        for image in images[:2]:
+            image.last_processed = datetime.datetime.now()
+        sesh.commit()
+
+    # Only the new images are added when the night is scanned again
+    session = scanned_session("/deployment", 52)
+    session["images"][0]["filesize"] = 200
+    save_monitoring_session(db_path, "/deployment", session)
+    with get_session(db_path) as sesh:
+        assert sesh.query(TrapImage).count() == 52
+        assert sesh.query(TrapImage).filter_by(filesize=200).count() == 0
+
+    # And the changed images are processed again if their filesize is checked
+    save_monitoring_session(db_path, "/deployment", session, check_filesize=True)
+    with get_session(db_path) as sesh:
+        assert sesh.query(TrapImage).count() == 52
+        [changed] = sesh.query(TrapImage).filter_by(filesize=200).all()
+        assert changed.path == "0.jpg"
+        assert changed.last_processed is None
+        processed = sesh.query(TrapImage).filter(TrapImage.last_processed.isnot(None))
+        assert [image.path for image in processed] == ["1.jpg"]
+
+
+def test_detections_update_aggregates(
+    db_path, image_directory, user_data_path, queue_images
+):
+    queue_images(2)
+    save_detected_objects(
+        db_path,
+        [1, 2],
+        [
+            [{"bbox": [0, 0, 10, 10]}, {"bbox": [5, 5, 15, 15]}],
+            [{"bbox": [0, 0, 5, 5]}],
+        ],
+        user_data_path=user_data_path,
+    )
+    [event] = get_monitoring_sessions_from_db(db_path, image_directory)
+    assert (event.num_images, event.num_detected_objects) == (2, 3)
+
+    delete_objects_for_image(db_path, 1)
+    [event] = get_monitoring_sessions_from_db(db_path, image_directory)
+    assert event.num_detected_objects == 1
+
+
+def run():
+    pytest.main([__file__])
+
+
+if __name__ == "__main__":
+    run()
@@ -9,13 +9,57 @@ from trapdata.common.filemanagement import (
     find_images,
     construct_exif,
     get_exif,
+    get_image_dimensions,
+    get_image_timestamp_with_timezone,
+    read_jpeg_header,
     EXIF_DATETIME_STR_FORMAT,
 )
 
-
 TEST_IMAGES = pathlib.Path(__file__).parent / "images"
 
 
+def test_read_jpeg_header(tmp_path, save_test_image):
+    paths = list(TEST_IMAGES.glob("**/*.jpg")) + [
+        save_test_image(tmp_path, "offset.jpg", offset=-4),
+        save_test_image(tmp_path, "positive_offset.jpg", offset=2),
+        save_test_image(tmp_path, "progressive.jpg", progressive=True),
+    ]
+    for path in paths:
+        with open(path, "rb") as f:
+            shape, tags = read_jpeg_header(f)
+        assert shape == get_image_dimensions(path)
+        exif = get_exif(path)
+        for name in ("DateTime", "TimeZoneOffset"):
+            assert tags.get(name) == exif.get(name), path
+
+
+def test_find_images(tmp_path, save_test_image):
+    for i in range(20):
+        save_test_image(tmp_path, f"{i:02}.jpg", offset=-4)
+    # Read with PIL instead
+    save_test_image(tmp_path, "no_header.jpeg", exif=False)
+    pathlib.Path(tmp_path, "not_an_image.jpg").write_bytes(b"nope")
+
+    images = list(find_images(tmp_path, num_workers=4))
+    assert [image["path"].name for image in images] == [
+        image["path"].name for image in find_images(tmp_path, num_workers=1)
+    ]
+    assert len(images) == 20
+    for image in images:
+        path = image["path"]
+        assert image["shape"] == get_image_dimensions(path)
+        assert image["timestamp"] == get_image_timestamp_with_timezone(path)
+        assert image["filesize"] == path.stat().st_size
+    assert images[0]["timestamp"].utcoffset() == datetime.timedelta(hours=-4)
+
+    unordered = find_images(tmp_path, num_workers=4, ordered=False)
+    assert sorted(image["path"].name for image in unordered) == sorted(
+        image["path"].name for image in images
+    )
+    all_images = list(find_images(tmp_path, skip_bad_exif=False))
+    assert len(all_images) == 22
+
+
 def run():
     logger.info(f"Using test images from: {TEST_IMAGES}")
     saved_images = []
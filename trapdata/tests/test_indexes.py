@@ -0,0 +1,198 @@
+import datetime
+
+import pytest
+import sqlalchemy as sa
+from alembic import command as alembic
+
+from trapdata.db.base import get_engine, get_session, get_alembic_config
+from trapdata.db.models.events import MonitoringSession
+from trapdata.db.models.images import TrapImage
+from trapdata.db.models.detections import DetectedObject, get_object_counts_for_images
+from trapdata.db.models.tracks import Track, update_tracks
+from trapdata.db.models.queue import (
+    all_queues,
+    queue_counts,
+    queue_status,
+    unprocessed_counts,
+)
+from trapdata.tests.query_plans import (
+    INDEXES,
+    capture_queries,
+    assert_no_table_scans,
+    indexes_used,
+)
+
+
+def test_queue_query_plans(db_path):
+    with capture_queries(db_path) as statements:
+        for queue in all_queues(db_path, "/tmp").values():
+            queue.queue_count()
+            queue.unprocessed_count()
+            queue.done_count()
+            queue.add_unprocessed()
+            queue.pull_n_from_queue(2)
+            queue.clear_queue()
+
+    # Several indexes cover the queue queries, which one is used depends on
+    # the statistics gathered by the database
+    assert_no_table_scans(db_path, statements)
+    used = indexes_used(db_path, statements)
+    assert "ix_monitoring_sessions_base_directory_day" in used
+    assert used & INDEXES["images"]
+    assert used & INDEXES["detections"]
+
+
+def test_queue_count_plans(db_path):
+    with capture_queries(db_path) as statements:
+        queue_counts(db_path)
+        unprocessed_counts(db_path)
+
+    assert {
+        "ix_images_queued",
+        "ix_images_unprocessed",
+        "ix_detections_queued",
+    } <= indexes_used(db_path, statements)
+
+
+def test_queue_status_plan(db_path):
+    with get_session(db_path) as sesh:
+        now = datetime.datetime.now()
+        ms = MonitoringSession(base_directory="/tmp", day=now.date())
+        images = [
+            TrapImage(monitoring_session=ms, path=f"{i}.jpg", in_queue=i < 2)
+            for i in range(3)
+        ]
+        images[2].last_processed = now
+        objs = [
+            DetectedObject(
+                image=images[2],
+                monitoring_session=ms,
+                bbox=[i, i, 10, 10],
+                in_queue=True,
+                binary_label="moth" if i else None,
+                canonical=True,
+            )
+            for i in range(3)
+        ]
+        sesh.add_all([ms, *images, *objs])
+        sesh.commit()
+
+    with capture_queries(db_path) as statements:
+        status = queue_status(db_path, "/tmp")
+
+    assert len(statements) == 1
+    assert_no_table_scans(db_path, statements)
+    for name, queue in all_queues(db_path, "/tmp").items():
+        assert status[name] == {
+            "unprocessed": queue.unprocessed_count(),
+            "queued": queue.queue_count(),
+            "done": queue.done_count(),
+        }
+    assert status["Unprocessed images"] == {"unprocessed": 2, "queued": 2, "done": 1}
+
+
+def test_playback_query_plans(db_path):
+    with get_session(db_path) as sesh:
+        now = datetime.datetime.now()
+        ms = MonitoringSession(base_directory="/tmp", day=now.date())
+        image = TrapImage(monitoring_session=ms, path="image.jpg", timestamp=now)
+        obj = DetectedObject(
+            image=image,
+            monitoring_session=ms,
+            timestamp=now,
+            sequence_id="test",
+            sequence_frame=0,
+        )
+        sesh.add_all([ms, image, obj])
+        sesh.flush()
+        update_tracks(sesh)
+        sesh.commit()
+
+        with capture_queries(db_path) as statements:
+            image.previous_image(sesh)
+            image.next_image(sesh)
+            obj.track_info(sesh)
+            obj.best_sibling(sesh)
+            get_object_counts_for_images(db_path, [image.id])
+
+    assert_no_table_scans(db_path, statements)
+    assert {
+        "ix_images_timestamp",
+        "ix_detections_image_id",
+        "ix_tracks_sequence_id",
+    } <= indexes_used(db_path, statements)
+
+
+def test_migrations_match_models(db_path, monkeypatch):
+    """
+    Existing databases get the same indexes from the migrations that new
+    databases get from the model definitions, the canonical detections
+    are filled in, the features are converted to binary, the tracks
+    are filled in and the detections get their time of change.
+    """
+    engine = get_engine(db_path)
+    with engine.begin() as conn:
+        for table, names in INDEXES.items():
+            for name in names:
+                if table not in ("jobs", "tracks", "manifest_files"):
+                    conn.execute(sa.text(f"DROP INDEX {name}"))
+        conn.execute(sa.text("ALTER TABLE detections DROP COLUMN canonical"))
+        conn.execute(sa.text("ALTER TABLE detections DROP COLUMN updated_at"))
+        conn.execute(sa.text("DROP TABLE jobs"))
+        conn.execute(sa.text("DROP TABLE stage_counters"))
+        conn.execute(sa.text("DROP TABLE tracks"))
+        conn.execute(sa.text("DROP TABLE manifest_files"))
+        conn.execute(sa.text("ALTER TABLE detections DROP COLUMN cnn_features"))
+        conn.execute(sa.text("ALTER TABLE detections ADD COLUMN cnn_features JSON"))
+        conn.execute(
+            sa.text(
+                "INSERT INTO detections (id, image_id, bbox, cnn_features, "
+                "specific_label, specific_label_score, sequence_id, sequence_frame) "
+                "VALUES "
+                "(1, 1, '[0, 0, 10, 10]', NULL, NULL, NULL, NULL, NULL), "
+                "(2, 1, '[0, 0, 10, 10]', NULL, NULL, NULL, NULL, NULL), "
+                "(3, 1, '[5, 5, 10, 10]', '[0.5, 0.25]', 'a', 0.5, 'seq', 0), "
+                "(4, 2, '[0, 0, 10, 10]', NULL, 'b', 0.9, 'seq', 1), "
+                "(5, 2, NULL, NULL, NULL, NULL, NULL, NULL)"
+            )
+        )
+
+    # The migration environment reads the database URL from the app settings
+    monkeypatch.setenv("AMI_DATABASE_URL", db_path)
+    alembic_cfg = get_alembic_config(db_path)
+    alembic.stamp(alembic_cfg, "1544478c3031")
+    alembic.upgrade(alembic_cfg, "head")
+
+    inspector = sa.inspect(engine)
+    for table, names in INDEXES.items():
+        assert names <= {index["name"] for index in inspector.get_indexes(table)}
+
+    with get_session(db_path) as sesh:
+        canonical_ids = sesh.execute(
+            sa.select(DetectedObject.id).where(DetectedObject.canonical.is_(True))
+        ).scalars()
+        assert sorted(canonical_ids) == [2, 3, 4]
+
+        features = sesh.execute(
+            sa.select(DetectedObject.cnn_features).order_by(DetectedObject.id)
+        ).scalars()
+        assert [None if f is None else f.tolist() for f in features] == [
+            None,
+            None,
+            [0.5, 0.25],
+            None,
+            None,
+        ]
+
+        [track] = sesh.execute(sa.select(Track)).scalars()
+        assert track.sequence_id == "seq"
+        assert track.num_frames == track.num_detections == 2
+        assert (track.best_detection_id, track.best_label) == (4, "b")
+
+
+def run():
+    pytest.main([__file__])
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,190 @@
+import os
+import datetime
+import multiprocessing
+
+import pytest
+import sqlalchemy as sa
+
+from trapdata.db import Base
+from trapdata.db.base import get_engine, get_session
+from trapdata.db.models.events import MonitoringSession
+from trapdata.db.models.images import TrapImage
+from trapdata.db.models.jobs import Job, JobStatus
+from trapdata.db.models.detections import DetectedObject, save_detected_objects
+from trapdata.db.models.queue import (
+    ImageQueue,
+    DetectedObjectQueue,
+    UntrackedObjectsQueue,
+)
+
+BASE_DIRECTORY = "/tmp/test_jobs"
+
+
+def create_queue(db_path: str, num_images: int = 5) -> ImageQueue:
+    with get_session(db_path) as sesh:
+        ms = MonitoringSession(base_directory=BASE_DIRECTORY, day=datetime.date.today())
+        sesh.add(ms)
+        sesh.add_all(
+            [
+                TrapImage(monitoring_session=ms, path=f"{i}.jpg", in_queue=True)
+                for i in range(num_images)
+            ]
+        )
+        sesh.commit()
+    return ImageQueue(db_path, BASE_DIRECTORY)
+
+
+def get_jobs(queue: ImageQueue) -> list[Job]:
+    with get_session(queue.db_path) as sesh:
+        return sesh.execute(sa.select(Job).order_by(Job.item_id)).scalars().all()
+
+
+def expire_leases(queue: ImageQueue):
+    with get_session(queue.db_path) as sesh:
+        sesh.execute(
+            sa.update(Job).values(
+                {"lease_expires_at": datetime.datetime.now() - queue.lease_duration}
+            )
+        )
+        sesh.commit()
+
+
+def claim_all(db_path: str, batch_size: int) -> list[int]:
+    queue = ImageQueue(db_path, BASE_DIRECTORY)
+    claimed = []
+    while item_ids := queue.claim(batch_size):
+        claimed += item_ids
+    return claimed
+
+
+def assert_concurrent_claims_do_not_overlap(db_path: str):
+    num_images, num_workers = 200, 4
+    create_queue(db_path, num_images)
+    ctx = multiprocessing.get_context("fork")
+    with ctx.Pool(num_workers) as pool:
+        results = pool.starmap(claim_all, [(db_path, 10)] * num_workers)
+
+    claimed = [item_id for result in results for item_id in result]
+    assert len(claimed) == len(set(claimed)) == num_images
+    assert len(get_jobs(ImageQueue(db_path, BASE_DIRECTORY))) == num_images
+
+
+def test_claims_do_not_overlap(db_path):
+    queue = create_queue(db_path)
+    first = queue.claim(2)
+    second = queue.claim(2)
+    third = queue.claim(2)
+    assert first == [1, 2]
+    assert second == [3, 4]
+    assert third == [5]
+    assert queue.claim(2) == []
+    assert all(job.status == JobStatus.claimed.value for job in get_jobs(queue))
+
+    records = ImageQueue(queue.db_path, BASE_DIRECTORY).pull_n_from_queue(2)
+    assert records == []
+
+
+def test_concurrent_claims_do_not_overlap(db_path):
+    assert_concurrent_claims_do_not_overlap(db_path)
+
+
+def test_concurrent_claims_do_not_overlap_postgres():
+    """
+    Run the workers against a PostgreSQL database, where claims use
+    FOR UPDATE SKIP LOCKED. Set AMI_TEST_POSTGRES_URL to an empty database.
+    """
+    db_path = os.environ.get("AMI_TEST_POSTGRES_URL")
+    if not db_path:
+        pytest.skip("AMI_TEST_POSTGRES_URL is not set")
+    engine = get_engine(db_path)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    try:
+        assert_concurrent_claims_do_not_overlap(db_path)
+    finally:
+        Base.metadata.drop_all(engine)
+
+
+def test_complete_removes_jobs(db_path):
+    queue = create_queue(db_path)
+    item_ids = queue.claim(3)
+    queue.complete(item_ids[:2])
+    assert [job.item_id for job in get_jobs(queue)] == item_ids[2:]
+
+
+def test_expired_leases_are_reclaimed(db_path):
+    queue = create_queue(db_path, num_images=2)
+    assert queue.claim(2) == [1, 2]
+    expire_leases(queue)
+    queue.renew([2])
+
+    assert queue.claim(2) == [1]
+    jobs = get_jobs(queue)
+    assert [job.attempts for job in jobs] == [2, 1]
+    assert all(job.status == JobStatus.claimed.value for job in jobs)
+
+
+def test_failed_items_are_excluded_until_requeued(db_path):
+    queue = create_queue(db_path, num_images=1)
+    for _ in range(queue.max_attempts):
+        assert queue.claim(1) == [1]
+        expire_leases(queue)
+
+    assert queue.claim(1) == []
+    [job] = get_jobs(queue)
+    assert job.status == JobStatus.failed.value
+    assert job.attempts == queue.max_attempts
+
+    queue.add_unprocessed()
+    assert get_jobs(queue) == []
+    assert queue.claim(1) == [1]
+
+
+def test_released_items_are_claimed_again(db_path):
+    queue = create_queue(db_path, num_images=2)
+    assert queue.claim(2) == [1, 2]
+    queue.release([1])
+    assert queue.claim(2) == [1]
+
+    for _ in range(queue.max_attempts - 1):
+        queue.release([1])
+        queue.claim(1)
+    queue.release([1])
+    assert queue.claim(1) == []
+    assert get_jobs(queue)[0].status == JobStatus.failed.value
+
+
+def test_clear_queue_removes_jobs(db_path):
+    queue = create_queue(db_path)
+    queue.claim(2)
+    queue.clear_queue()
+    assert get_jobs(queue) == []
+    assert queue.queue_count() == 0
+    assert queue.claim(2) == []
+
+
+def test_redetected_objects_remove_jobs(
+    db_path, image_directory, user_data_path, queue_images
+):
+    queue_images(1)
+    save_detected_objects(db_path, [1], [[{"bbox": [0, 0, 10, 10]}]], user_data_path)
+    queue = DetectedObjectQueue(db_path, image_directory)
+    assert len(queue.claim(1)) == 1
+
+    # The claimed object is deleted when the image is detected again
+    save_detected_objects(db_path, [1], [[{"bbox": [5, 5, 15, 15]}]], user_data_path)
+    assert get_jobs(queue) == []
+    assert len(queue.claim(1)) == 1
+
+
+def test_untracked_objects_are_filtered(db_path):
+    queue = UntrackedObjectsQueue(db_path, BASE_DIRECTORY)
+    assert queue.pull_n_from_queue(1, where=DetectedObject.image_id.in_([])) == []
+
+
+def run():
+    pytest.main([__file__])
+
+
+if __name__ == "__main__":
+    run()
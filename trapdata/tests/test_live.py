@@ -0,0 +1,125 @@
+import datetime
+
+import pytest
+
+from trapdata.db.base import get_session
+from trapdata.db.models.detections import DetectedObject
+from trapdata.db.models.tracks import Track
+from trapdata.db.models.events import get_or_create_monitoring_sessions
+from trapdata.db.models.queue import ImageQueue, queue_status
+from trapdata.db.models.counters import get_stage_counters
+from trapdata.pipeline import LivePipeline
+from trapdata.watch import ImageWatcher
+
+
+def test_live_pipeline(db_path, image_directory, save_test_image, fixed_models):
+    pipeline = LivePipeline(db_path, image_directory, fixed_models())
+    watcher = ImageWatcher(
+        db_path,
+        image_directory,
+        queue=True,
+        polling=True,
+        settle_seconds=0,
+        on_new_images=pipeline.process_images,
+    )
+    watcher.start()
+
+    night = datetime.datetime(2022, 6, 22, 21, 0)
+    for i in range(2):
+        save_test_image(
+            image_directory, f"{i}.jpg", timestamp=night + datetime.timedelta(minutes=i)
+        )
+        watcher.check()
+        [image_id] = watcher.check()
+
+        with get_session(db_path) as sesh:
+            [obj] = sesh.query(DetectedObject).filter_by(image_id=image_id).all()
+            assert obj.binary_label == "moth"
+            assert obj.specific_label == "Actias luna"
+            assert obj.cnn_features is not None
+            assert obj.sequence_id and obj.sequence_frame == i
+            assert not obj.in_queue
+
+    # The object in the second image continues the track of the first
+    with get_session(db_path) as sesh:
+        [track] = sesh.query(Track).all()
+        assert track.num_frames == 2
+        assert track.best_label == "Actias luna"
+
+    status = queue_status(db_path, image_directory)
+    assert all(counts["queued"] == 0 for counts in status.values())
+    assert get_stage_counters(db_path, image_directory) == status
+
+
+def test_live_pipeline_skips_failed_images(
+    db_path, image_directory, save_test_image, fixed_models
+):
+    pipeline = LivePipeline(db_path, image_directory, fixed_models())
+    watcher = ImageWatcher(
+        db_path,
+        image_directory,
+        queue=True,
+        polling=True,
+        settle_seconds=0,
+        max_wait_seconds=0,
+        on_new_images=pipeline.process_images,
+    )
+    watcher.start()
+
+    night = datetime.datetime(2022, 6, 22, 21, 0)
+    # An image that was never completely written
+    filepath = save_test_image(image_directory, "0.jpg", timestamp=night)
+    data = filepath.read_bytes()
+    filepath.write_bytes(data[: len(data) - 200])
+    watcher.check()
+    [failed_id] = watcher.check()
+
+    # The next images are still processed
+    save_test_image(
+        image_directory, "1.jpg", timestamp=night + datetime.timedelta(minutes=1)
+    )
+    watcher.check()
+    [image_id] = watcher.check()
+    with get_session(db_path) as sesh:
+        assert sesh.query(DetectedObject).filter_by(image_id=failed_id).count() == 0
+        [obj] = sesh.query(DetectedObject).filter_by(image_id=image_id).all()
+        assert obj.specific_label == "Actias luna"
+
+
+def test_live_pipeline_processes_queued_images(
+    db_path, image_directory, save_test_image, fixed_models
+):
+    night = datetime.datetime(2022, 6, 22, 21, 0)
+    save_test_image(image_directory, "0.jpg", timestamp=night)
+    get_or_create_monitoring_sessions(db_path, image_directory)
+    # Left in the queue by an interrupted run
+    ImageQueue(db_path, image_directory).add_unprocessed()
+    # Added while the directory was not watched
+    save_test_image(
+        image_directory, "1.jpg", timestamp=night + datetime.timedelta(minutes=1)
+    )
+
+    pipeline = LivePipeline(db_path, image_directory, fixed_models())
+    watcher = ImageWatcher(
+        db_path,
+        image_directory,
+        queue=True,
+        polling=True,
+        on_new_images=pipeline.process_images,
+    )
+    watcher.rescan()
+    assert len(watcher.queued_image_ids()) == 2
+    watcher.process_queued()
+
+    assert watcher.queued_image_ids() == []
+    with get_session(db_path) as sesh:
+        [track] = sesh.query(Track).all()
+        assert track.num_frames == 2
+
+
+def run():
+    pytest.main([__file__])
+
+
+if __name__ == "__main__":
+    run()
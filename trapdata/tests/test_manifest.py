@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from trapdata.db.base import get_session
+from trapdata.db.models.images import TrapImage
+from trapdata.db.models import manifest
+from trapdata.db.models.events import (
+    get_or_create_monitoring_sessions,
+    rescan_monitoring_sessions,
+)
+from trapdata.common.filemanagement import find_images
+
+
+def test_manifest(db_path, image_directory, save_test_image):
+    (image_directory / "night").mkdir()
+    for i in range(10):
+        save_test_image(image_directory / "night", f"{i}.jpg", offset=-4)
+    save_test_image(image_directory, "no_date.jpg", exif=False)
+
+    delta = manifest.update_manifest(db_path, image_directory, num_workers=4)
+    assert len(delta.new) == 11
+    assert not delta.modified and not delta.removed
+    images = list(manifest.manifest_images(db_path, image_directory))
+    assert images == sorted(find_images(image_directory), key=lambda i: str(i["path"]))
+
+    # Only the new & modified files are read again
+    save_test_image(image_directory / "night", "new.jpg", offset=-4)
+    modified = image_directory / "night" / "0.jpg"
+    save_test_image(image_directory / "night", "0.jpg", offset=-4, quality=50)
+    stat = modified.stat()
+    os.utime(modified, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    (image_directory / "night" / "1.jpg").unlink()
+
+    read = []
+    read_image_metadata = manifest.read_image_metadata
+    manifest.read_image_metadata = lambda path, *args, **kwargs: (
+        read.append(path.name) or read_image_metadata(path, *args, **kwargs)
+    )
+    try:
+        delta = manifest.update_manifest(db_path, image_directory)
+    finally:
+        manifest.read_image_metadata = read_image_metadata
+    assert (delta.new, delta.modified) == (["night/new.jpg"], ["night/0.jpg"])
+    assert delta.removed == ["night/1.jpg"]
+    assert delta.num_unchanged == 9
+    assert sorted(read) == ["0.jpg", "new.jpg"]
+    [image] = [
+        image
+        for image in manifest.manifest_images(db_path, image_directory)
+        if image["path"] == modified
+    ]
+    assert image["filesize"] == modified.stat().st_size
+
+    assert not manifest.update_manifest(db_path, image_directory)
+
+
+def test_rescan_monitoring_sessions(db_path, image_directory, save_test_image):
+    for i in range(3):
+        save_test_image(image_directory, f"{i}.jpg")
+    [event] = get_or_create_monitoring_sessions(db_path, image_directory)
+    assert event.num_images == 3
+
+    save_test_image(image_directory, "3.jpg")
+    delta = rescan_monitoring_sessions(db_path, image_directory)
+    assert delta.new == ["3.jpg"]
+    with get_session(db_path) as sesh:
+        assert sesh.query(TrapImage).count() == 4
+
+    [event] = get_or_create_monitoring_sessions(db_path, image_directory, rescan=True)
+    assert event.num_images == 4
+
+
+def run():
+    pytest.main([__file__])
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,152 @@
+import time
+import datetime
+
+import pytest
+
+from trapdata.db.base import get_session
+from trapdata.db.models.events import MonitoringSession
+from trapdata.db.models.images import TrapImage
+from trapdata.db.models.detections import (
+    DetectedObject,
+    get_object_counts_for_image,
+    get_unique_objects_for_image,
+)
+from trapdata.db.models.tracks import update_tracks
+from trapdata.ui.prefetch import FramePrefetcher, load_frames
+
+
+def create_frames(db_path, num_images: int) -> list[int]:
+    with get_session(db_path) as sesh:
+        start = datetime.datetime.now()
+        ms = MonitoringSession(base_directory="/tmp", day=start.date())
+        images = [
+            TrapImage(
+                monitoring_session=ms,
+                base_path="/tmp",
+                path=f"{i}.jpg",
+                timestamp=start + datetime.timedelta(minutes=i),
+            )
+            for i in range(num_images)
+        ]
+        objs = []
+        for i, image in enumerate(images):
+            # One track through all of the images, with its best label in the middle
+            objs.append(
+                DetectedObject(
+                    image=image,
+                    monitoring_session=ms,
+                    bbox=[0, 0, 10, 10],
+                    timestamp=image.timestamp,
+                    binary_label="moth",
+                    specific_label=f"species {i}",
+                    specific_label_score=1 - abs(i - num_images // 2) / num_images,
+                    sequence_id="track",
+                    sequence_frame=i,
+                )
+            )
+            # And an object outside of any track, detected twice
+            objs.append(
+                DetectedObject(
+                    image=image,
+                    monitoring_session=ms,
+                    bbox=[5, 5, 20, 20],
+                    timestamp=image.timestamp,
+                    canonical=False,
+                )
+            )
+            objs.append(
+                DetectedObject(
+                    image=image,
+                    monitoring_session=ms,
+                    bbox=[5, 5, 20, 20],
+                    timestamp=image.timestamp,
+                )
+            )
+        sesh.add_all([ms, *images, *objs])
+        sesh.flush()
+        update_tracks(sesh)
+        sesh.commit()
+        return [image.id for image in images]
+
+
+def test_load_frames(db_path):
+    image_ids = create_frames(db_path, 5)
+    frames = load_frames(db_path, image_ids)
+
+    with get_session(db_path) as sesh:
+        for image_id in image_ids:
+            frame = frames[image_id]
+            assert frame.image.id == image_id
+            assert frame.image_path == frame.image.absolute_path
+            assert frame.stats == get_object_counts_for_image(db_path, image_id)
+
+            # The same annotations the playback used to query for each object
+            objs = get_unique_objects_for_image(db_path, image_id)
+            annotations = frame.annotations
+            assert [a.detected_object.id for a in annotations] == [o.id for o in objs]
+            for annotation, obj in zip(annotations, objs):
+                assert annotation.best_sibling.id == obj.best_sibling(sesh).id
+                assert annotation.track_info == obj.track_info(sesh)
+            assert annotations[0].best_sibling.specific_label == "species 2"
+
+
+def wait_for(condition, timeout=10):
+    start = time.time()
+    while not condition():
+        assert time.time() - start < timeout, "Timed out waiting for the prefetcher"
+        time.sleep(0.01)
+
+
+def test_frame_prefetcher(db_path):
+    image_ids = create_frames(db_path, 30)
+    frames = FramePrefetcher(db_path, image_ids, radius=3, max_size=10, batch_size=2)
+    try:
+        frames.get(image_ids[10])
+        neighbours = image_ids[7:10] + image_ids[11:14]
+        wait_for(lambda: all(image_id in frames.frames for image_id in neighbours))
+
+        # Moving through the frames keeps the cache bounded
+        for image_id in image_ids[10:25]:
+            assert frames.get(image_id).image.id == image_id
+        wait_for(lambda: image_ids[27] in frames.frames)
+        assert len(frames.frames) <= 10
+        assert image_ids[10] not in frames.frames
+
+        # Invalidated frames are loaded again
+        with get_session(db_path) as sesh:
+            sesh.get(TrapImage, image_ids[24]).in_queue = True
+            sesh.commit()
+        assert not frames.get(image_ids[24]).image.in_queue
+        frames.invalidate(image_ids[24])
+        assert image_ids[24] not in frames.frames
+        assert frames.get(image_ids[24]).image.in_queue
+    finally:
+        frames.close()
+    frames.worker.join(timeout=10)
+    assert not frames.worker.is_alive()
+
+
+def test_prefetched_frames_expire(db_path):
+    image_ids = create_frames(db_path, 5)
+    frames = FramePrefetcher(db_path, image_ids, radius=2, max_age_seconds=0.5)
+    try:
+        frames.get(image_ids[2])
+        wait_for(lambda: image_ids[3] in frames.frames)
+        assert not frames.get(image_ids[3]).image.in_queue
+
+        # The pipeline saves new results for a frame that was already prefetched
+        with get_session(db_path) as sesh:
+            sesh.get(TrapImage, image_ids[3]).in_queue = True
+            sesh.commit()
+        time.sleep(0.5)
+        assert frames.get(image_ids[3]).image.in_queue
+    finally:
+        frames.close()
+
+
+def run():
+    pytest.main([__file__])
+
+
+if __name__ == "__main__":
+    run()
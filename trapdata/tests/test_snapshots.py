@@ -0,0 +1,130 @@
+import datetime
+
+import numpy as np
+import pytest
+import sqlalchemy as sa
+
+from trapdata.db.base import get_session
+from trapdata.db.models.events import MonitoringSession
+from trapdata.db.models.images import TrapImage
+from trapdata.db.models.detections import DetectedObject, save_classified_objects
+from trapdata.db.models.tracks import update_tracks
+from trapdata.db import snapshots
+
+
+def add_detections(db_path, ms_id, num_objects, features=True):
+    with get_session(db_path) as sesh:
+        now = datetime.datetime.now()
+        image = TrapImage(
+            monitoring_session_id=ms_id, path="image.jpg", last_processed=now
+        )
+        sesh.add(image)
+        sesh.flush()
+        sesh.add_all(
+            [
+                DetectedObject(
+                    image_id=image.id,
+                    monitoring_session_id=ms_id,
+                    bbox=[i, i, 10, 10],
+                    timestamp=now,
+                    specific_label=f"species {i}",
+                    specific_label_score=i / 10,
+                    sequence_id="track" if i < 2 else None,
+                    sequence_frame=i if i < 2 else None,
+                    cnn_features=np.full(4, i, dtype=np.float32) if features else None,
+                    notes={"note": i},
+                )
+                for i in range(num_objects)
+            ]
+        )
+        sesh.flush()
+        update_tracks(sesh)
+        sesh.commit()
+        return image.id
+
+
+def test_snapshots(db_path, tmp_path):
+    pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    directory = tmp_path / "snapshots"
+    with get_session(db_path) as sesh:
+        ms = MonitoringSession(base_directory="/tmp", day=datetime.date.today())
+        sesh.add(ms)
+        sesh.commit()
+        ms_id = ms.id
+    first_image_id = add_detections(db_path, ms_id, 3)
+
+    counts = snapshots.write_snapshot(db_path, directory, batch_size=2)
+    assert counts == {"images": 1, "detections": 3, "events": 1, "tracks": 1}
+
+    detections = pq.read_table(f"{directory}/detections").to_pylist()
+    assert [obj["bbox"] for obj in detections] == [[i, i, 10, 10] for i in range(3)]
+    assert detections[2]["cnn_features"] == [2.0] * 4
+    assert detections[2]["notes"] == '{"note": 2}'
+    [track] = pq.read_table(f"{directory}/tracks").to_pylist()
+    assert track["num_frames"] == 2
+    assert track["best_label"] == "species 1"
+
+    # Only the new rows & the images processed again are appended
+    add_detections(db_path, ms_id, 2, features=False)
+    with get_session(db_path) as sesh:
+        sesh.execute(
+            sa.update(TrapImage)
+            .where(TrapImage.id == first_image_id)
+            .values(last_processed=datetime.datetime.now())
+        )
+        sesh.commit()
+    counts = snapshots.write_snapshot(db_path, directory, incremental=True)
+    assert counts["images"] == 2
+    assert counts["detections"] == 2
+
+    detections = pq.read_table(f"{directory}/detections")
+    assert detections.num_rows == 5
+    assert pq.read_table(f"{directory}/events").num_rows == 1
+
+    # Classifications saved to existing detections are appended
+    save_classified_objects(db_path, [1], [{"binary_label": "moth"}])
+    counts = snapshots.write_snapshot(db_path, directory, incremental=True)
+    assert counts["detections"] == 1
+    detections = pq.read_table(f"{directory}/detections").to_pylist()
+    assert detections[-1]["id"] == 1
+    assert detections[-1]["binary_label"] == "moth"
+
+    # A full snapshot replaces the parts
+    counts = snapshots.write_snapshot(db_path, directory)
+    assert pq.read_table(f"{directory}/images").num_rows == counts["images"] == 2
+
+
+def test_snapshot_schema_does_not_depend_on_features(db_path, tmp_path):
+    pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    directory = tmp_path / "snapshots"
+    with get_session(db_path) as sesh:
+        ms = MonitoringSession(base_directory="/tmp", day=datetime.date.today())
+        sesh.add(ms)
+        sesh.commit()
+        ms_id = ms.id
+
+    # No features have been extracted for the first part
+    add_detections(db_path, ms_id, 2, features=False)
+    snapshots.write_snapshot(db_path, directory)
+    add_detections(db_path, ms_id, 2)
+    snapshots.write_snapshot(db_path, directory, incremental=True)
+
+    detections = pq.read_table(f"{directory}/detections").to_pylist()
+    assert [obj["cnn_features"] for obj in detections] == [
+        None,
+        None,
+        [0.0] * 4,
+        [1.0] * 4,
+    ]
+
+
+def run():
+    pytest.main([__file__])
+
+
+if __name__ == "__main__":
+    run()
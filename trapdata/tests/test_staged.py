@@ -0,0 +1,78 @@
+import pytest
+
+from trapdata.db.base import get_session
+from trapdata.db.models.detections import DetectedObject
+from trapdata.db.models.queue import queue_status
+from trapdata.db.models.counters import get_stage_counters
+from trapdata.ml.models.classification import SpeciesClassifier
+from trapdata.pipeline import StagedPipeline
+
+
+def fail(batch):
+    raise RuntimeError("Out of memory")
+
+
+def assert_all_processed(db_path, directory, num_images):
+    status = queue_status(db_path, directory)
+    # Tracking runs after the stages
+    assert all(
+        counts["queued"] == 0
+        for name, counts in status.items()
+        if name != "Untracked detections"
+    )
+    assert get_stage_counters(db_path, directory) == status
+    with get_session(db_path) as sesh:
+        objs = sesh.query(DetectedObject).all()
+        assert len(objs) == num_images
+        assert all(obj.specific_label and obj.cnn_features is not None for obj in objs)
+
+
+def test_staged_pipeline(db_path, image_directory, queue_images, fixed_models):
+    queue_images(7)
+    pipeline = StagedPipeline(
+        db_path,
+        image_directory,
+        fixed_models(batch_size=2),
+        workers={"binary_classification": 2, "species_classification": 3},
+        queue_size=1,
+    )
+    pipeline.run()
+    assert_all_processed(db_path, image_directory, 7)
+
+
+def test_staged_pipeline_resumes_after_error(
+    db_path, image_directory, queue_images, fixed_models
+):
+    queue_images(4)
+    models = fixed_models(batch_size=2)
+    for model in models:
+        if isinstance(model, SpeciesClassifier):
+            model.model = fail
+    pipeline = StagedPipeline(
+        db_path,
+        image_directory,
+        models,
+        workers={"species_classification": 2},
+    )
+    try:
+        pipeline.run()
+    except RuntimeError:
+        pass
+    else:
+        assert False, "The error of a stage is raised"
+
+    status = queue_status(db_path, image_directory)
+    assert status["Unclassified objects"]["queued"] > 0
+
+    # The items that were not processed are still in the queues of the database
+    StagedPipeline(db_path, image_directory, fixed_models(batch_size=2)).run()
+    status = queue_status(db_path, image_directory)
+    assert status["Unclassified objects"]["queued"] == 0
+
+
+def run():
+    pytest.main([__file__])
+
+
+if __name__ == "__main__":
+    run()
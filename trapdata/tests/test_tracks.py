@@ -0,0 +1,108 @@
+import datetime
+
+import pytest
+import sqlalchemy as sa
+
+from trapdata.db.base import get_session
+from trapdata.db.models.events import MonitoringSession
+from trapdata.db.models.images import TrapImage
+from trapdata.db.models.detections import (
+    DetectedObject,
+    save_classified_objects,
+    delete_objects_for_image,
+    get_unique_species_by_track,
+)
+from trapdata.db.models.tracks import Track, update_tracks
+
+
+def create_track(db_path, num_frames: int) -> tuple[int, list[int], list[int]]:
+    with get_session(db_path) as sesh:
+        start = datetime.datetime.now()
+        ms = MonitoringSession(base_directory="/tmp", day=start.date())
+        images = [
+            TrapImage(
+                monitoring_session=ms,
+                path=f"{i}.jpg",
+                timestamp=start + datetime.timedelta(minutes=i),
+            )
+            for i in range(num_frames)
+        ]
+        objs = [
+            DetectedObject(
+                image=image,
+                monitoring_session=ms,
+                bbox=[0, 0, 10, 10],
+                timestamp=image.timestamp,
+                specific_label=f"species {i}",
+                specific_label_score=(i + 1) / 10,
+                sequence_id="track",
+                sequence_frame=i,
+            )
+            for i, image in enumerate(images)
+        ]
+        sesh.add_all([ms, *images, *objs])
+        sesh.flush()
+        update_tracks(sesh, monitoring_session_id=ms.id)
+        sesh.commit()
+        return ms.id, [image.id for image in images], [o.id for o in objs]
+
+
+def get_track(db_path) -> Track:
+    with get_session(db_path) as sesh:
+        return sesh.execute(sa.select(Track)).scalars().one()
+
+
+def test_tracks(db_path):
+    ms_id, image_ids, object_ids = create_track(db_path, 3)
+    track = get_track(db_path)
+    assert track.monitoring_session_id == ms_id
+    assert track.num_frames == track.num_detections == 3
+    assert track.best_detection_id == object_ids[2]
+    assert (track.best_label, track.best_score) == ("species 2", 0.3)
+    assert (track.end_time - track.start_time) == datetime.timedelta(minutes=2)
+
+    with get_session(db_path) as sesh:
+        obj = sesh.get(DetectedObject, object_ids[0])
+        assert obj.track_length(sesh) == 3
+        assert obj.best_sibling(sesh).id == object_ids[2]
+        ms = sesh.get(MonitoringSession, ms_id)
+        [row] = get_unique_species_by_track(db_path, ms)
+        assert row["label"] == "species 2"
+        assert row["sequence_frame_count"] == 3
+        assert [e["score"] for e in row["examples"]] == [0.3, 0.2, 0.1]
+
+
+def test_track_writers(db_path):
+    ms_id, image_ids, object_ids = create_track(db_path, 3)
+
+    # Classifying the detections again changes the best label of their track
+    save_classified_objects(
+        db_path,
+        [object_ids[0]],
+        [{"specific_label": "species 9", "specific_label_score": 0.9}],
+    )
+    track = get_track(db_path)
+    assert (track.best_detection_id, track.best_label) == (object_ids[0], "species 9")
+
+    # The track is shortened when the detections of an image are deleted
+    delete_objects_for_image(db_path, image_ids[0])
+    track = get_track(db_path)
+    assert track.num_detections == 2
+    assert (track.best_detection_id, track.best_label) == (object_ids[2], "species 2")
+
+    # And removed when its detections are cleared from sequences
+    save_classified_objects(
+        db_path,
+        object_ids[1:],
+        [{"sequence_id": None, "sequence_frame": None}] * 2,
+    )
+    with get_session(db_path) as sesh:
+        assert sesh.execute(sa.select(sa.func.count(Track.id))).scalar() == 0
+
+
+def run():
+    pytest.main([__file__])
+
+
+if __name__ == "__main__":
+    run()
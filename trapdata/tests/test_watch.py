@@ -0,0 +1,96 @@
+import datetime
+from unittest import mock
+
+import pytest
+
+from trapdata.db.base import get_session
+from trapdata.db.models.events import (
+    MonitoringSession,
+    get_or_create_monitoring_sessions,
+)
+from trapdata.db.models.images import TrapImage
+from trapdata.db.models.manifest import ManifestFile
+from trapdata.watch import ImageWatcher, DirectoryPoller
+
+
+def test_directory_poller(image_directory, save_test_image):
+    save_test_image(image_directory, "existing.jpg")
+    poller = DirectoryPoller(image_directory)
+    assert poller.poll() == []
+
+    new = save_test_image(image_directory, "new.jpg")
+    (image_directory / "notes.txt").write_text("")
+    (image_directory / "night").mkdir()
+    nested = save_test_image(image_directory / "night", "nested.jpg")
+    assert sorted(poller.poll()) == sorted([new, nested])
+    assert poller.poll() == []
+
+
+def test_watch(db_path, image_directory, save_test_image, tmp_path):
+    night = datetime.datetime(2022, 6, 22, 20, 0)
+    save_test_image(image_directory, "0.jpg", timestamp=night)
+    [event] = get_or_create_monitoring_sessions(db_path, image_directory)
+
+    watcher = ImageWatcher(
+        db_path, image_directory, queue=True, polling=True, settle_seconds=0
+    )
+    watcher.start()
+
+    # A partially written image is not added until it is complete
+    complete = save_test_image(
+        tmp_path, "1.jpg", timestamp=night + datetime.timedelta(hours=1)
+    ).read_bytes()
+    partial = image_directory / "1.jpg"
+    partial.write_bytes(complete[:-100])
+    assert watcher.check() == []
+    assert watcher.check() == []
+    partial.write_bytes(complete)
+    assert watcher.check() == []
+    assert len(watcher.check()) == 1
+
+    # Images from another night start a new monitoring session
+    (image_directory / "later").mkdir()
+    save_test_image(
+        image_directory / "later", "2.jpg", timestamp=night + datetime.timedelta(days=3)
+    )
+    assert watcher.check() == []
+    assert len(watcher.check()) == 1
+    assert watcher.check() == []
+
+    with get_session(db_path) as sesh:
+        events = sesh.query(MonitoringSession).order_by(MonitoringSession.day).all()
+        assert [e.num_images for e in events] == [2, 1]
+        assert events[0].id == event.id
+        assert events[0].end_time == night + datetime.timedelta(hours=1)
+        queued = sesh.query(TrapImage.path).filter(TrapImage.in_queue.is_(True))
+        assert sorted(path for path, in queued) == ["1.jpg", "later/2.jpg"]
+        assert sesh.query(ManifestFile).count() == 3
+
+
+def test_watch_retries_failed_saves(db_path, image_directory, save_test_image):
+    night = datetime.datetime(2022, 6, 22, 20, 0)
+    save_test_image(image_directory, "0.jpg", timestamp=night)
+    get_or_create_monitoring_sessions(db_path, image_directory)
+
+    watcher = ImageWatcher(db_path, image_directory, polling=True, settle_seconds=0)
+    watcher.start()
+    save_test_image(
+        image_directory, "1.jpg", timestamp=night + datetime.timedelta(hours=1)
+    )
+    assert watcher.check() == []
+
+    # The error is logged and the image is saved by a later check
+    with mock.patch("trapdata.watch.save_new_images", side_effect=RuntimeError):
+        assert watcher.check() == []
+    assert list(watcher.pending) == [image_directory / "1.jpg"]
+    assert watcher.check() == []
+    assert len(watcher.check()) == 1
+    assert watcher.pending == {}
+
+
+def run():
+    pytest.main([__file__])
+
+
+if __name__ == "__main__":
+    run()
@@ -29,6 +29,8 @@ from kivy.properties import (
 from trapdata.settings import Settings, ValidationError
 from trapdata import logger
 from trapdata import ml
+from trapdata.db import configure_engines
+from trapdata.common.cache import crop_cache
 from trapdata.db.models.events import (
     get_monitoring_sessions_from_db,
     export_monitoring_sessions,
@@ -209,10 +211,14 @@ class TrapDataApp(App):
         """
         self.app_settings = Settings(_env_file=None)  # noqa
         print(self.app_settings)
+        configure_engines(**self.app_settings.database_options())
+        crop_cache.resize(self.app_settings.crop_cache_size)
 
     def on_config_change(self, config, section, key, value):
         if key == "image_base_path":
             self.image_base_path = value
+        if key == "crop_cache_size":
+            crop_cache.resize(int(value))
         self.refresh_app_settings()
         return super().on_config_change(config, section, key, value)
 
@@ -278,6 +284,18 @@ class TrapDataApp(App):
                 "localization_batch_size": 2,
                 "classification_batch_size": 20,
                 "num_workers": 1,
+                "database_pool_size": 5,
+                "database_max_overflow": 10,
+                "database_pool_pre_ping": 1,
+                "database_lock_retries": 5,
+                "database_lock_retry_delay": 0.1,
+                "sqlite_journal_mode": "wal",
+                "sqlite_synchronous": "normal",
+                "sqlite_mmap_size": 256 * 1024 * 1024,
+                "sqlite_cache_size": -64 * 1024,
+                "sqlite_temp_store": "memory",
+                "sqlite_busy_timeout": 10,
+                "crop_cache_size": 0,
             },
         )
         # config.write()
@@ -21,19 +21,14 @@ from kivy.uix.screenmanager import Screen
 from trapdata import logger
 from trapdata import constants
 from trapdata.common.utils import format_timedelta_hours
-from trapdata.db.base import get_session_class
 from trapdata.db.models.events import (
     get_monitoring_session_image_ids,
     MonitoringSession,
 )
-from trapdata.db.models.images import TrapImage, get_image_with_objects
-from trapdata.db.models.detections import (
-    DetectedObject,
-    get_object_counts_for_image,
-    delete_objects_for_image,
-    get_unique_objects_for_image,
-)
+from trapdata.db.models.images import TrapImage
+from trapdata.db.models.detections import delete_objects_for_image
 from trapdata.db.models.queue import add_image_to_queue, clear_all_queues
+from trapdata.ui.prefetch import Annotation, FramePrefetcher
 from trapdata.common.utils import get_sequential_sample
 
 
@@ -79,7 +74,7 @@ def update_title(widget: Label, image: TrapImage):
 
 class AnnotatedImage(Widget):
     image_path: pathlib.Path = ObjectProperty()
-    annotations: list[DetectedObject] = ListProperty()
+    annotations: list[Annotation] = ListProperty()
     image: TrapImage = ObjectProperty()
     stats: dict = ObjectProperty()
     bg = ObjectProperty()
@@ -146,7 +141,8 @@ class AnnotatedImage(Widget):
         # )
 
         color = [1, 1, 1, 1]
-        for i, annotation in enumerate(self.annotations):
+        for i, frame_annotation in enumerate(self.annotations):
+            annotation = frame_annotation.detected_object
             if not annotation.bbox:
                 logger.warn(f"No bbox for detected object {annotation.id}. Skipping.")
                 continue
@@ -171,12 +167,8 @@ class AnnotatedImage(Widget):
             y1 += y_offset
             y2 += y_offset
 
-            app = App.get_running_app()
-            Session = get_session_class(app.db_path)
-            with Session() as session:
-                best_annotation = annotation.best_sibling(session)
-                # track_length = annotation.track_length(session)
-                track_info = annotation.track_info(session)
+            best_annotation = frame_annotation.best_sibling
+            track_info = frame_annotation.track_info
 
             if best_annotation.binary_label == constants.NEGATIVE_BINARY_LABEL:
                 label_text = ""
@@ -241,6 +233,7 @@ class ImagePlaybackScreen(Screen):
     image_ids = ListProperty()
     fps = NumericProperty(defaultvalue=DEFAULT_FPS)
     clock = ObjectProperty(allownone=True)
+    frames = ObjectProperty(allownone=True)
 
     def reload(self, ms, image_id: Optional[int] = None):
         self.current_sample = None
@@ -248,6 +241,9 @@ class ImagePlaybackScreen(Screen):
         self.image_ids = [
             img.id for img in get_monitoring_session_image_ids(app.db_path, ms)
         ]
+        if self.frames:
+            self.frames.close()
+        self.frames = FramePrefetcher(app.db_path, self.image_ids)
         preview: PreviewWindow = self.ids.image_preview
         preview.reset()
         if image_id:
@@ -328,13 +324,16 @@ class PreviewWindow(RelativeLayout):
             self.add_widget(self.image_widget)
 
     def refresh(self, *args):
-        self.load_sample(self.current_sample.id)
+        self.load_sample(self.current_sample.id, refresh=True)
 
-    def load_sample(self, image_id):
-        # Refetch image with associated detected objects
-        app = App.get_running_app()
-        image = get_image_with_objects(app.db_path, image_id)
-        stats = get_object_counts_for_image(app.db_path, image_id)
+    def load_sample(self, image_id, refresh=False):
+        # The frames around the current one are loaded in the background
+        frames: FramePrefetcher = self.parent.parent.frames
+        if refresh:
+            # Refetch image with associated detected objects
+            frames.invalidate(image_id)
+        frame = frames.get(image_id)
+        image, stats = frame.image, frame.stats
 
         # @TODO is there a more reliable way to reference the info bar?
         info_bar = self.parent.parent.ids.info_bar
@@ -344,10 +343,8 @@ class PreviewWindow(RelativeLayout):
         update_title(title_bar, image)
 
         image_widget = AnnotatedImage(
-            image_path=image.absolute_path,
-            annotations=get_unique_objects_for_image(
-                db_path=app.db_path, image_id=image_id
-            ),
+            image_path=frame.image_path,
+            annotations=frame.annotations,
             size=self.size,
             pos_hint={"bottom": 0},
             image=image,
@@ -0,0 +1,234 @@
+import time
+import pathlib
+import threading
+import collections
+from dataclasses import dataclass
+from typing import Any, Optional, Sequence
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from trapdata import logger
+from trapdata.db.base import get_session
+from trapdata.db.models.images import TrapImage
+from trapdata.db.models.detections import (
+    DetectedObject,
+    get_best_siblings,
+    get_track_info,
+    get_object_counts_for_images,
+)
+
+
+@dataclass
+class Annotation:
+    detected_object: DetectedObject
+    # The object in the same track with the highest species classification score
+    best_sibling: DetectedObject
+    track_info: dict[str, Any]
+
+
+@dataclass
+class Frame:
+    """
+    Everything the playback screen needs to show an image.
+    """
+
+    image: TrapImage
+    image_path: pathlib.Path
+    annotations: list[Annotation]
+    stats: dict[str, Any]
+
+
+def load_frames(db_path: str, image_ids: Sequence[int]) -> dict[int, Frame]:
+    """
+    Load the frames of several images with a fixed number of queries.
+    """
+    with get_session(db_path) as sesh:
+        images = (
+            sesh.execute(
+                sa.select(TrapImage)
+                .where(TrapImage.id.in_(image_ids))
+                .options(orm.noload(TrapImage.detected_objects))
+            )
+            .unique()
+            .scalars()
+            .all()
+        )
+        objects = (
+            sesh.execute(
+                sa.select(DetectedObject)
+                .where(
+                    DetectedObject.image_id.in_(image_ids)
+                    & DetectedObject.canonical.is_(True)
+                )
+                .order_by(DetectedObject.id)
+            )
+            .unique()
+            .scalars()
+            .all()
+        )
+        best_siblings = get_best_siblings(sesh, objects)
+        track_info = get_track_info(sesh, objects)
+
+    annotations = collections.defaultdict(list)
+    for obj in objects:
+        annotations[obj.image_id].append(
+            Annotation(obj, best_siblings[obj.id], track_info[obj.id])
+        )
+    stats = get_object_counts_for_images(db_path, image_ids)
+    return {
+        image.id: Frame(
+            image=image,
+            image_path=image.absolute_path,
+            annotations=annotations[image.id],
+            stats=stats[image.id],
+        )
+        for image in images
+    }
+
+
+class FramePrefetcher:
+    """
+    Keep the frames around the current one of the playback in a bounded LRU cache.
+
+    `get` returns a frame from the cache (or loads it right away) and asks a worker
+    thread to load the next & previous `radius` frames, in batches, nearest first.
+    When the playback moves on, the frames the worker has not loaded yet for the
+    previous position are skipped.
+
+    Frames are loaded again once they are older than `max_age_seconds`, so the
+    detections & labels saved by the pipeline while the playback is open are shown.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        image_ids: Sequence[int],
+        radius: int = 20,
+        max_size: int = 100,
+        batch_size: int = 10,
+        max_age_seconds: float = 5,
+    ):
+        self.db_path = db_path
+        self.image_ids = list(image_ids)
+        self.positions = {image_id: i for i, image_id in enumerate(self.image_ids)}
+        self.radius = radius
+        self.max_size = max(max_size, radius * 2 + 1)
+        self.batch_size = batch_size
+        self.max_age_seconds = max_age_seconds
+
+        # Each frame with the time it started loading
+        self.frames: collections.OrderedDict[int, tuple[Frame, float]] = (
+            collections.OrderedDict()
+        )
+        self.lock = threading.Lock()
+        self.requested = threading.Condition(self.lock)
+        self.center: Optional[int] = None
+        # Incremented when frames are invalidated, so frames that started loading
+        # before are not cached
+        self.generation = 0
+        self.invalidated: dict[int, int] = {}
+        self.cleared = 0
+        self.closed = False
+        self.worker = threading.Thread(
+            target=self._run, name="FramePrefetcher", daemon=True
+        )
+        self.worker.start()
+
+    def get(self, image_id: int) -> Frame:
+        with self.lock:
+            frame = self._fresh(image_id)
+            if frame:
+                self.frames.move_to_end(image_id)
+            generation = self.generation
+        if not frame:
+            loaded_at = time.monotonic()
+            frame = load_frames(self.db_path, [image_id])[image_id]
+            self._add({image_id: frame}, generation, loaded_at)
+        self.prefetch(image_id)
+        return frame
+
+    def prefetch(self, image_id: int):
+        with self.lock:
+            self.center = image_id
+            self.requested.notify()
+
+    def invalidate(self, image_id: Optional[int] = None):
+        """
+        Drop a frame from the cache (or all of them) after it changed in the database.
+        """
+        with self.lock:
+            self.generation += 1
+            if image_id is None:
+                self.cleared = self.generation
+                self.frames.clear()
+            else:
+                self.invalidated[image_id] = self.generation
+                self.frames.pop(image_id, None)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.requested.notify()
+
+    def _fresh(self, image_id: int) -> Optional[Frame]:
+        """
+        Return a cached frame unless it is too old. Called with the lock held.
+        """
+        frame, loaded_at = self.frames.get(image_id, (None, 0))
+        if frame and time.monotonic() - loaded_at > self.max_age_seconds:
+            del self.frames[image_id]
+            return None
+        return frame
+
+    def _add(self, frames: dict[int, Frame], generation: int, loaded_at: float):
+        with self.lock:
+            for image_id, frame in frames.items():
+                if max(self.cleared, self.invalidated.get(image_id, 0)) > generation:
+                    continue
+                self.frames[image_id] = (frame, loaded_at)
+                self.frames.move_to_end(image_id)
+            while len(self.frames) > self.max_size:
+                self.frames.popitem(last=False)
+
+    def _neighbours(self, image_id: int) -> list[int]:
+        position = self.positions.get(image_id)
+        if position is None:
+            return []
+        neighbours = []
+        for distance in range(1, self.radius + 1):
+            for i in (position + distance, position - distance):
+                if 0 <= i < len(self.image_ids):
+                    neighbours.append(self.image_ids[i])
+        return neighbours
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while self.center is None and not self.closed:
+                    self.requested.wait()
+                if self.closed:
+                    return
+                center, self.center = self.center, None
+                neighbours = self._neighbours(center)
+                # The frames around the current one are the last to be evicted
+                for image_id in reversed(neighbours):
+                    if self._fresh(image_id):
+                        self.frames.move_to_end(image_id)
+                missing = [
+                    image_id for image_id in neighbours if image_id not in self.frames
+                ]
+
+            for i in range(0, len(missing), self.batch_size):
+                with self.lock:
+                    if self.closed or self.center is not None:
+                        # The playback moved on
+                        break
+                    generation = self.generation
+                loaded_at = time.monotonic()
+                try:
+                    frames = load_frames(self.db_path, missing[i : i + self.batch_size])
+                except Exception as e:
+                    logger.error(f"Could not prefetch frames: {e}")
+                    break
+                self._add(frames, generation, loaded_at)
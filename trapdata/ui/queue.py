@@ -13,6 +13,7 @@ from kivy.clock import Clock
 
 from trapdata import logger
 from trapdata.db.models.queue import all_queues
+from trapdata.db.models.counters import get_stage_counters
 
 
 Builder.load_file(str(pathlib.Path(__file__).parent / "queue.kv"))
@@ -97,6 +98,7 @@ class QueueStatusTable(BoxLayout):
         app = App.get_running_app()
 
         queues = list(all_queues(app.db_path, app.image_base_path).items())
+        counts = get_stage_counters(app.db_path, app.image_base_path)
 
         def hacky_status(queue, previous_queue=None):
             # Temporary solution until we have a process for each queue
@@ -133,9 +135,9 @@ class QueueStatusTable(BoxLayout):
             rows.append(
                 [
                     name.replace(" ", " \n"),
-                    queue.unprocessed_count(),
-                    queue.queue_count(),
-                    queue.done_count(),
+                    counts[name]["unprocessed"],
+                    counts[name]["queued"],
+                    counts[name]["done"],
                     status,
                     [add_button, clear_button],
                 ]
@@ -0,0 +1,348 @@
+"""
+Add the images uploaded to the directory of a deployment to the database as they
+arrive, without scanning the whole directory again.
+
+Uses filesystem events from the `watch` extra (`pip install trapdata[watch]`) if
+it is installed, otherwise polls the modification times of the directories.
+"""
+
+import os
+import time
+import pathlib
+import threading
+from typing import Optional, Any, Callable
+
+import sqlalchemy as sa
+
+from trapdata import logger
+from trapdata import constants
+from trapdata.db.base import get_session
+from trapdata.common.types import FilePath
+from trapdata.common.filemanagement import read_image_metadata
+from trapdata.db.models.events import save_new_images, rescan_monitoring_sessions
+from trapdata.db.models.manifest import (
+    ManifestDelta,
+    manifest_values,
+    save_manifest_files,
+)
+from trapdata.db.models.images import TrapImage
+from trapdata.db.models.queue import ImageQueue, all_queues
+
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+
+JPEG_EOI_MARKER = b"\xff\xd9"
+
+
+def is_image_path(path: FilePath) -> bool:
+    return str(path).lower().endswith(constants.SUPPORTED_IMAGE_EXTENSIONS)
+
+
+def is_complete_jpeg(filepath: pathlib.Path) -> bool:
+    """
+    Check that a JPEG has been written completely, up to its end of image marker.
+    """
+    try:
+        with open(filepath, "rb") as f:
+            f.seek(-len(JPEG_EOI_MARKER), os.SEEK_END)
+            return f.read() == JPEG_EOI_MARKER
+    except OSError:
+        return False
+
+
+class DirectoryPoller:
+    """
+    Find the files added to a directory tree by checking the modification time
+    of each of its directories. Only the directories that changed are listed again.
+    """
+
+    def __init__(self, base_directory: FilePath):
+        self.base_directory = pathlib.Path(base_directory)
+        self.directories: dict[pathlib.Path, tuple[int, set[str]]] = {}
+        self._update(self.base_directory, report=False)
+
+    def _update(self, directory: pathlib.Path, report: bool) -> list[pathlib.Path]:
+        try:
+            # Before listing, so files added meanwhile are found by the next poll
+            mtime_ns = directory.stat().st_mtime_ns
+            entries = list(os.scandir(directory))
+        except (FileNotFoundError, NotADirectoryError):
+            self.directories.pop(directory, None)
+            return []
+        previous = self.directories.get(directory, (None, set()))[1]
+        self.directories[directory] = (mtime_ns, {entry.name for entry in entries})
+
+        new_files = []
+        for entry in entries:
+            if entry.name in previous:
+                continue
+            path = directory / entry.name
+            if entry.is_dir():
+                # Every file in a new directory is new
+                new_files += self._update(path, report)
+            elif report and is_image_path(path):
+                new_files.append(path)
+        return new_files
+
+    def poll(self) -> list[pathlib.Path]:
+        new_files = []
+        for directory, (mtime_ns, _) in list(self.directories.items()):
+            try:
+                changed = directory.stat().st_mtime_ns != mtime_ns
+            except FileNotFoundError:
+                self.directories.pop(directory, None)
+                continue
+            if changed:
+                new_files += self._update(directory, report=True)
+        return new_files
+
+
+class ImageEventHandler:
+    """
+    Pass the images created, written or moved into the watched directory
+    to the watcher.
+    """
+
+    def __init__(self, watcher: "ImageWatcher"):
+        self.watcher = watcher
+
+    def dispatch(self, event):
+        if event.is_directory:
+            return
+        path = getattr(event, "dest_path", None) or event.src_path
+        if event.event_type in ("created", "modified", "moved", "closed"):
+            if is_image_path(path):
+                self.watcher.add(path)
+
+
+class ImageWatcher:
+    """
+    Watch the directory of a deployment and save the new images to their
+    monitoring sessions as soon as they are completely written.
+
+    An image is saved once its size and modification time have not changed for
+    `settle_seconds` and it ends with the JPEG end of image marker, or has not
+    changed for `max_wait_seconds` without it. The IDs of the new images are
+    passed to `on_new_images`, e.g. to process them right away. Errors of
+    saving the images or of `on_new_images` are logged and the watcher goes on;
+    the images that could not be saved are tried again by the next check.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        base_directory: FilePath,
+        queue: bool = False,
+        polling: bool = False,
+        settle_seconds: float = 2.0,
+        max_wait_seconds: float = 60.0,
+        interval_seconds: float = 1.0,
+        on_new_images: Optional[Callable[[list[int]], Any]] = None,
+        batch_size: int = 10,
+    ):
+        self.db_path = db_path
+        self.base_directory = pathlib.Path(base_directory)
+        self.queue = queue
+        self.polling = polling or Observer is None
+        self.settle_seconds = settle_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.interval_seconds = interval_seconds
+        self.on_new_images = on_new_images
+        # The number of queued images passed to `on_new_images` at a time on startup
+        self.batch_size = batch_size
+
+        # The size & modification time of each new file, and since when it has not changed
+        self.pending: dict[pathlib.Path, Optional[tuple[tuple[int, int], float]]] = {}
+        self.lock = threading.Lock()
+        self.poller: Optional[DirectoryPoller] = None
+        self.observer = None
+
+    def add(self, filepath: FilePath):
+        with self.lock:
+            self.pending.setdefault(pathlib.Path(filepath), None)
+
+    def start(self):
+        if self.polling:
+            if Observer is None:
+                logger.info("Filesystem events are not available, polling instead")
+            self.poller = DirectoryPoller(self.base_directory)
+        else:
+            self.observer = Observer()
+            self.observer.schedule(
+                ImageEventHandler(self), str(self.base_directory), recursive=True
+            )
+            self.observer.start()
+
+    def stop(self):
+        if self.observer:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+
+    def ready_files(self) -> list[tuple[pathlib.Path, os.stat_result]]:
+        """
+        Return the pending files that have been written completely.
+        """
+        now = time.monotonic()
+        ready = []
+        with self.lock:
+            pending = list(self.pending.items())
+        for filepath, state in pending:
+            try:
+                stat = filepath.stat()
+            except FileNotFoundError:
+                # e.g. a temporary file that was renamed
+                with self.lock:
+                    self.pending.pop(filepath, None)
+                continue
+            key = (stat.st_size, stat.st_mtime_ns)
+            if state is None or state[0] != key:
+                with self.lock:
+                    self.pending[filepath] = (key, now)
+                continue
+            unchanged_seconds = now - state[1]
+            if unchanged_seconds < self.settle_seconds:
+                continue
+            if not is_complete_jpeg(filepath):
+                if unchanged_seconds < self.max_wait_seconds:
+                    continue
+                logger.warning(f"Image has no end of image marker: {filepath}")
+            with self.lock:
+                self.pending.pop(filepath, None)
+            ready.append((filepath, stat))
+        return ready
+
+    def save(self, files: list[tuple[pathlib.Path, os.stat_result]]) -> list[int]:
+        """
+        Save the images to the database and the manifest of the directory.
+        Returns the IDs of the new images.
+        """
+        images: list[dict[str, Any]] = []
+        manifest_files = []
+        for filepath, stat in files:
+            try:
+                image = read_image_metadata(filepath, filepath, skip_bad_exif=False)
+            except OSError as e:
+                logger.warning(f"Could not read image {filepath}: {e}")
+                continue
+            manifest_files.append(
+                manifest_values(self.base_directory, filepath, stat, image)
+            )
+            if image["timestamp"]:
+                images.append(image)
+
+        # Before the images, so saving both again after an error does no harm
+        with get_session(self.db_path) as sesh:
+            save_manifest_files(sesh, manifest_files)
+            sesh.commit()
+        return save_new_images(
+            self.db_path, self.base_directory, images, queue=self.queue
+        )
+
+    def check(self) -> list[int]:
+        """
+        Look for new images once and save the ones that are ready.
+        """
+        if self.poller:
+            for filepath in self.poller.poll():
+                self.add(filepath)
+        ready = self.ready_files()
+        if not ready:
+            return []
+        try:
+            image_ids = self.save(ready)
+        except Exception as e:
+            logger.exception(f"Could not save images, trying again later: {e}")
+            # Saved again by the next check, as soon as they are found ready
+            with self.lock:
+                for filepath, _ in ready:
+                    self.pending.setdefault(filepath, None)
+            return []
+        if image_ids:
+            self.notify(image_ids)
+        return image_ids
+
+    def notify(self, image_ids: list[int]):
+        if not self.on_new_images:
+            return
+        try:
+            self.on_new_images(image_ids)
+        except Exception as e:
+            # The claims on the items that failed are released, so they are left
+            # in the queues for the next run
+            logger.exception(f"Could not process images {image_ids}: {e}")
+
+    def rescan(self) -> ManifestDelta:
+        """
+        Add the images that changed while the directory was not watched. With
+        `queue`, they are added to the processing queue too.
+        """
+        with get_session(self.db_path) as sesh:
+            last_id = sesh.execute(sa.select(sa.func.max(TrapImage.id))).scalar()
+        delta = rescan_monitoring_sessions(self.db_path, self.base_directory)
+        if self.queue and (delta.new or delta.modified):
+            # New images are saved with higher IDs, modified ones as unprocessed
+            changed = (TrapImage.id > (last_id or 0)) | TrapImage.path.in_(
+                delta.modified
+            )
+            ImageQueue(self.db_path, self.base_directory).add_unprocessed(where=changed)
+        return delta
+
+    def queued_image_ids(self) -> list[int]:
+        """
+        Return the IDs of the images with items in the queue of any stage, e.g.
+        added by the rescan or left by an interrupted run, in order of time.
+        """
+        queues = all_queues(self.db_path, self.base_directory).values()
+        with get_session(self.db_path) as sesh:
+            return (
+                sesh.execute(
+                    sa.select(TrapImage.id)
+                    .where(
+                        TrapImage.id.in_(
+                            sa.union(*[queue.queued_image_ids() for queue in queues])
+                        )
+                    )
+                    .order_by(TrapImage.timestamp, TrapImage.id)
+                )
+                .scalars()
+                .all()
+            )
+
+    def process_queued(self, stop: Optional[threading.Event] = None):
+        """
+        Pass the images that are already queued to `on_new_images` in batches.
+        """
+        if not self.on_new_images:
+            return
+        image_ids = self.queued_image_ids()
+        if image_ids:
+            logger.info(f"Processing {len(image_ids)} queued images first")
+        for i in range(0, len(image_ids), self.batch_size):
+            if stop and stop.is_set():
+                break
+            self.notify(image_ids[i : i + self.batch_size])
+
+    def run(self, rescan: bool = True, stop: Optional[threading.Event] = None):
+        """
+        Watch the directory until `stop` is set. With `rescan`, the images that
+        changed while the directory was not watched are added first. With `queue`,
+        the queued images are then passed to `on_new_images`.
+        """
+        stop = stop or threading.Event()
+        logger.info(f"Watching '{self.base_directory}' for new images")
+        self.start()
+        try:
+            if rescan:
+                # After starting to watch, so no images are missed in between
+                self.rescan()
+            if self.queue:
+                self.process_queued(stop)
+            while not stop.is_set():
+                self.check()
+                stop.wait(self.interval_seconds)
+        finally:
+            self.stop()